@@ -19,55 +19,14 @@ then
     exit 1
 fi
 
-# How many CPUS does the computer have(Some ugly stuff here but it works)
-CPUS=$(grep '^processor' /proc/cpuinfo | wc -l)
-# If CPUS comes back empty just use 1
-if [ -z "$CPUS" ]
-then
-    CPUS=1
-fi
-echo "Using $CPUS cpus"
-
 # Where to place all analysis output directories
 PROJDIR=Projects
 
-# Loop over each of our samplenames and references
-# File needs to be either space or tab delimeted
-# Samplename ReferencePath
-# Excluding any lines that begin with a #
-mkdir -p $PROJDIR
-
-# Run in parallel
-# Ignore lines beginning with #
-# Remove windows newlines
-grep -v '^#' $sample_ref_map_file | sed 's/\r//' | while read sample reference
-do
-    # Make sure that sample was set
-    if [ -z "${sample}" ]
-    then
-        echo "${sample_ref_map_file} must have an incorrect line. Could not read samplename" >&2
-        continue
-    fi
-    # Make sure that reference was set
-    if [ -z "${reference}" ]
-    then
-        echo "${sample_ref_map_file} must have an incorrect line. Could not read reference" >&2
-        continue
-    elif [ ! -f "${reference}" ]
-    then
-        echo "${reference} is not a file that can be read. Skipping ${sample}" >&2
-        continue
-    fi
-    # If the sample already has been run
-    #  then don't rerun it
-    if [ -d ${PROJDIR}/${sample} ]
-    then
-        echo "Skipping ${sample} because it already exists" >&2
-        continue
-    fi
-
-    echo runsample ${reads_by_sample}/${sample} ${reference} ${sample} -od ${PROJDIR}/${sample} $RUNSAMPLEOPTIONS
-done | xargs -n 6 -P $CPUS -I CMD bash -c CMD
+# Run every sample in the samplesheet
+# runsamplesheet shares the cpus and memory between the samples it runs at the
+# same time, skips samples that already finished and reads the samplesheet
+# the same way this script used to(space or tab delimited, # lines ignored)
+runsamplesheet ${reads_by_sample} ${sample_ref_map_file} -od ${PROJDIR} $RUNSAMPLEOPTIONS
 
 # Graph all samples
 graphs.sh -norecreate
@@ -18,7 +18,7 @@ def cols( bamfile, regionstr, *args, **kwargs ):
     ''' Generator for mpileup columns '''
     piles = samtools.mpileup( bamfile, regionstr, args[0], args[1] )
     for pile in piles:
-        yield samtools.MPileupColumn( pile )
+        yield samtools.pileup_column( pile )
 
 def parse_args( args=sys.argv[1:] ):
     import argparse
@@ -5,17 +5,21 @@ import filehandle
 import logging
 log = logging.getLogger(__name__)
 
-def samtobam( sam, outbam ):
+def samtobam( sam, outbam, uncompressed=False ):
     '''
         Use samtools to convert a sam file to a bam file
         outbam will be overwritten if it already exists
 
         @sam - file path or file object(even pipe) of sam file input to convert
         @outbam - file path or file object(even pipe) of bam output destination
+        @uncompressed - Write uncompressed bam(cheaper when piping into sortbam)
 
         @returns outbam or the file descriptor of the object
     '''
-    cmd = ['samtools','view','-Sb','-']
+    if uncompressed:
+        cmd = ['samtools','view','-Sbu','-']
+    else:
+        cmd = ['samtools','view','-Sb','-']
     log.info('Running {0}'.format(' '.join(cmd)))
     # Determine if sam is a filepath or file like object
     if isinstance(sam,str):
@@ -45,7 +49,7 @@ def samtobam( sam, outbam ):
         log.debug("Returning processes stdout value")
         return p.stdout
 
-def sortbam( bam, outbam ):
+def sortbam( bam, outbam, level=None ):
     '''
         Sorts a bam file using samtools
         outbam cannot be a pipe because samtools index won't allow it
@@ -53,10 +57,14 @@ def sortbam( bam, outbam ):
 
         @sam - file path or file object(even pipe) of sam file input to convert
         @outbam - file path
+        @level - Compression level of outbam(samtools default if None)
 
         @returns outbam or the file descriptor of the object
     '''
-    cmd = ['samtools','sort','-f','-']
+    cmd = ['samtools','sort','-f']
+    if level is not None:
+        cmd += ['-l',str(level)]
+    cmd.append( '-' )
     log.info('Running {0}'.format(' '.join(cmd)))
 
     # Determine if sam is a filepath or file like object
@@ -76,12 +84,15 @@ def sortbam( bam, outbam ):
     p.wait()
     return outbam
 
-def mergebams( sortedbams, mergedbam ):
+def mergebams( sortedbams, mergedbam, header=None, threads=1 ):
     '''
         Merges the given sortedbams into a file specified by mergedbam
 
         @param sortedbams - List of sorted bam files to merge(Maybe don't even need to sort them?)
         @param mergedbam - Output file for samtools merge
+        @param header - Sam file whose header is used for mergedbam instead of the header
+            of the first bam(samtools merge -h)
+        @param threads - How many threads samtools uses to compress mergedbam
 
         @returns the path to mergedbam
     '''
@@ -89,7 +100,12 @@ def mergebams( sortedbams, mergedbam ):
         raise ValueError( "Merging bams requires >= 2 bam files to merge. {0} was given".format(sortedbams) )
 
     print sortedbams
-    cmd = ['samtools','merge',mergedbam] + sortedbams
+    cmd = ['samtools','merge']
+    if header is not None:
+        cmd += ['-h',header]
+    if threads > 1:
+        cmd += ['-@',str(threads)]
+    cmd += [mergedbam] + sortedbams
     log.info('Running {0}'.format(' '.join(cmd)))
 
     p = subprocess.Popen( cmd )
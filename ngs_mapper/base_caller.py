@@ -1,17 +1,29 @@
-from ngs_mapper.samtools import MPileupColumn, mpileup, parse_regionstring
+from ngs_mapper.samtools import MPileupColumn, mpileup, parse_regionstring, idxstats, fan_out, PILEUP_BACKENDS
+from ngs_mapper.samtools import MAX_QUAL, QUALS, base_hists, hist_count, hist_sum, downsample_column
+from ngs_mapper.bqd import QualDepth
+from ngs_mapper.bam_to_qualdepth import set_unmapped_mapped_reads
 from ngs_mapper.alphabet import iupac_amb
 
 import sys
 import argparse
 import re
 from StringIO import StringIO
-from os.path import basename
+from os.path import basename, dirname, exists, getmtime
 import os
 import multiprocessing
 import time
+import tempfile
+import copy
+import json
+from collections import deque
 
 import vcf
 from Bio import SeqIO
+import numpy as np
+try:
+    import pysam
+except ImportError:
+    pysam = None
 
 # The header for the vcf
 VCF_HEAD = '''##fileformat=VCFv4.2
@@ -27,6 +39,154 @@ VCF_HEAD = '''##fileformat=VCFv4.2
 ##INFO=<ID=HPOLY,Number=0,Type=Flag,Description="Is a homopolymer">
 #CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	{0}'''
 
+# Available base calling engines that can be selected with --engine
+ENGINES = ('python', 'numpy')
+
+# Keys in a stats dictionary that do not represent a base
+STATS_KEYS = ('depth','mqualsum','bqualsum')
+
+# Header line for the END info field that gap block rows use
+END_INFO_HEAD = '##INFO=<ID=END,Number=1,Type=Integer,Description="End position of a block of positions without coverage">'
+
+# Header line for the DS info field that rows called from a downsampled column have
+DS_INFO_HEAD = '##INFO=<ID=DS,Number=0,Type=Flag,Description="RC, AC and CBD were estimated from a random downsample of the column. DP is the depth of the whole column">'
+
+# INFO fields in the order they are defined in VCF_HEAD(+ END_INFO_HEAD and DS_INFO_HEAD) which is the order they are written in
+INFO_ORDER = ('DP','RC','RAQ','PRC','AC','AAQ','PAC','CBD','CB','HPOLY','END','DS')
+
+def gap_block_header(vcf_template):
+    '''
+    Adds the END info header line to a vcf header template so that gap block rows
+    are described
+
+    :param str vcf_template: VCF Header template(string)
+
+    @returns vcf header template with END_INFO_HEAD before the #CHROM line
+    '''
+    return vcf_template.replace('\n#CHROM', '\n' + END_INFO_HEAD + '\n#CHROM', 1)
+
+def downsample_header(vcf_template):
+    '''
+    Adds the DS info header line to a vcf header template so that rows called from
+    downsampled columns are described
+
+    :param str vcf_template: VCF Header template(string)
+
+    @returns vcf header template with DS_INFO_HEAD before the #CHROM line
+    '''
+    return vcf_template.replace('\n#CHROM', '\n' + DS_INFO_HEAD + '\n#CHROM', 1)
+
+class VcfRow(object):
+    '''
+    Lightweight stand in for vcf.model._Record that only has the fields
+    that base_caller fills in. ID, QUAL and FILTER are always missing(.)
+    '''
+    __slots__ = ('CHROM','POS','REF','ALT','INFO')
+    ID = None
+    QUAL = None
+    FILTER = None
+    FORMAT = None
+    samples = ()
+
+    def __init__(self, CHROM, POS, REF, ALT, INFO):
+        self.CHROM = CHROM
+        self.POS = POS
+        self.REF = REF
+        self.ALT = ALT
+        self.INFO = INFO
+
+class VcfWriter(object):
+    '''
+    Writes base_caller rows(VcfRow or vcf.model._Record) directly to a stream
+    The output is identical to what vcf.Writer would write, but rows are formatted with
+    a single string format instead of going through the csv module and generic
+    field formatting
+
+    :param file stream: Open file like object to write to
+    :param str template: VCF header template(string). None does not write a header
+    '''
+    def __init__(self, stream, template=VCF_HEAD):
+        self.stream = stream
+        if template is None:
+            return
+        # Let pyvcf write the header so it is identical to the header it would write
+        vcf_head = StringIO(template)
+        vcf_head.name = 'header.vcf'
+        vcf.Writer(stream, template=vcf.Reader(vcf_head))
+
+    def write_record(self, record):
+        ''' write a record to the stream '''
+        alt = record.ALT
+        if isinstance(alt, list):
+            alt = ','.join([str(a) for a in alt])
+        self.stream.write('{0}\t{1}\t.\t{2}\t{3}\t.\t.\t{4}\n'.format(
+            record.CHROM, record.POS, record.REF, alt, self._format_info(record.INFO)
+        ))
+
+    def write_blank(self, chrom, pos, ref, call='-', hpoly=False, end=None):
+        '''
+        Write a row that is identical to what blank_vcf_row would produce without
+        having to build the row first
+
+        :param str chrom: Reference name
+        :param int pos: 1-based position
+        :param str ref: Reference base
+        :param str call: What to set the CB info field to
+        :param bool hpoly: Set the HPOLY flag
+        :param int end: Set END to make this row a block that covers pos through end
+        '''
+        self.stream.write('{0}\t{1}\t.\t{2}\t.\t.\t.\tDP=0;RC=0;RAQ=0;PRC=0;CBD=0;CB={3}{4}{5}\n'.format(
+            chrom, pos, ref, call, ';HPOLY' if hpoly else '', ';END={0}'.format(end) if end else ''
+        ))
+
+    def _format_info(self, info):
+        if not info:
+            return '.'
+        keys = [k for k in INFO_ORDER if k in info]
+        if len(keys) != len(info):
+            keys += sorted(k for k in info if k not in INFO_ORDER)
+        fields = []
+        for key in keys:
+            value = info[key]
+            vtype = type(value)
+            if vtype is int or vtype is str:
+                fields.append(key + '=' + str(value))
+            elif vtype is bool:
+                fields.append(key if value else '')
+            elif vtype is list:
+                fields.append(key + '=' + ','.join(['.' if v is None else str(v) for v in value]))
+            elif value is None:
+                fields.append(key + '=.')
+            else:
+                fields.append(key + '=' + str(value))
+        return ';'.join(fields)
+
+    def flush(self):
+        ''' Flush the stream '''
+        self.stream.flush()
+
+    def close(self):
+        ''' Close the stream '''
+        self.stream.close()
+
+def bgzip_index(vcffile):
+    '''
+    Compress vcffile with bgzip and build a tabix index for it.
+    The uncompressed vcffile is removed
+
+    Uses pysam if it is installed otherwise the bgzip and tabix executables
+
+    :param str vcffile: Path to uncompressed vcf
+
+    @returns path to the compressed vcf(vcffile + .gz)
+    '''
+    if pysam is not None:
+        return pysam.tabix_index(vcffile, preset='vcf', force=True)
+    import subprocess
+    subprocess.check_call(['bgzip', '-f', vcffile])
+    subprocess.check_call(['tabix', '-f', '-p', 'vcf', vcffile + '.gz'])
+    return vcffile + '.gz'
+
 def timeit(func):
     def wrapper(*args, **kwargs):
         import time; st = time.time()
@@ -37,8 +197,33 @@ def timeit(func):
 
 def main():
     args = parse_args()
-    if args.regionstr is not None:
-        generate_vcf(
+    vcfhead = VCF_HEAD.format(basename(args.bamfile))
+    if args.gap_blocks:
+        vcfhead = gap_block_header(vcfhead)
+    if args.downsample:
+        vcfhead = downsample_header(vcfhead)
+    # Other pileup consumers that share the pileup pass with the base calling
+    consumers = []
+    if args.qualdepth:
+        consumers.append(QualDepth())
+    if args.save_stats:
+        consumers.append(column_stats_writer(args.save_stats))
+    if args.from_stats:
+        vcf_output_file = generate_vcf_from_stats(
+            args.from_stats,
+            args.reffile,
+            args.vcf_output_file,
+            args.minbq,
+            args.maxd,
+            args.mind,
+            args.minth,
+            args.biasth,
+            args.bias,
+            vcfhead,
+            args.gap_blocks
+       )
+    elif args.regionstr is not None:
+        vcf_output_file = generate_vcf(
             args.bamfile,
             args.reffile,
             args.regionstr,
@@ -49,11 +234,17 @@ def main():
             args.minth,
             args.biasth,
             args.bias,
-            VCF_HEAD.format(basename(args.bamfile)),
-            True
+            vcfhead,
+            True,
+            args.engine,
+            args.pileup_backend,
+            gap_blocks=args.gap_blocks,
+            consumers=consumers,
+            downsample=args.downsample,
+            seed=args.seed
        )
     else:
-        generate_vcf_multithreaded(
+        vcf_output_file = generate_vcf_multithreaded(
                 args.bamfile,
                 args.reffile,
                 args.vcf_output_file,
@@ -64,67 +255,234 @@ def main():
                 args.biasth,
                 args.bias,
                 args.threads,
-                VCF_HEAD.format(basename(args.bamfile)),
+                vcfhead,
+                args.engine,
+                args.pileup_backend,
+                args.gap_blocks,
+                consumers,
+                args.downsample,
+                args.seed
        )
+    if args.bgzip:
+        bgzip_index(vcf_output_file)
+    if args.qualdepth:
+        write_qualdepth(args.bamfile, consumers[0], args.qualdepth)
+    if args.save_stats:
+        consumers[-1].close()
+
+def write_qualdepth(bamfile, qualdepth, outfile):
+    '''
+    Write the qualdepth json that graphsample uses from a QualDepth consumer
+
+    :param str bamfile: Path to the bam file the QualDepth was built from
+    :param QualDepth qualdepth: QualDepth that has seen all pileup columns
+    :param str outfile: Where to write the json
+
+    @returns outfile
+    '''
+    stats = qualdepth.qualdepth()
+    set_unmapped_mapped_reads(bamfile, stats)
+    with open(outfile, 'w') as fh:
+        json.dump(stats, fh)
+    return outfile
+
+def generate_vcf_from_stats(statsfile, reffile, vcf_output_file, minbq, maxd, mind, minth, biasth, bias, vcfhead=VCF_HEAD, gap_blocks=False):
+    '''
+    Generate the vcf from a column statistics file that was saved with --save-stats
+    instead of piling up the bam again. Every region in the file is called in the
+    same order it was written so the output is identical to calling the bam with
+    the same thresholds. The columns are always called with the numpy engine which
+    works on the quality histograms directly(both engines produce identical output)
+
+    :param str statsfile: Path to file written by write_column_stats
+    :param str reffile: Reference the statistics were piled up against
+
+    All other parameters are the same as generate_vcf
+
+    @returns vcf_output_file
+    '''
+    reference = index_reference(reffile)
+    with open(vcf_output_file, 'w') as fho:
+        fho.write(vcfhead + '\n')
+        for regionstr, columns in read_column_stats(statsfile):
+            generate_vcf(
+                None, reffile, regionstr, fho, minbq, maxd, mind, minth, biasth, bias,
+                None, True, 'numpy', reference=reference, gap_blocks=gap_blocks, piles=columns
+            )
+    return vcf_output_file
 
-def generate_vcf_multithreaded(bamfile, reffile, vcf_output_file, minbq, maxd, mind, minth, biasth, bias, threads, vcfhead=VCF_HEAD):
+def generate_vcf_multithreaded(bamfile, reffile, vcf_output_file, minbq, maxd, mind, minth, biasth, bias, threads, vcfhead=VCF_HEAD, engine='python', backend='samtools', gap_blocks=False, consumers=(), downsample=None, seed=0):
     '''
-    Generate vcf for each ref and split each ref into pieces
+    Generate vcf for all references by splitting them into region chunks that a pool of
+    at most threads worker processes picks up as they finish previous chunks.
+    Chunks are balanced by the amount of mapped reads on each reference(see region_chunks).
+    The workers hand the vcf rows of every chunk back and they are written to
+    vcf_output_file in reference order(see ordered_results)
+
+    Each chunk feeds its pileup columns to its own copy of consumers(see generate_vcf) and
+    the copies are merged back into consumers in reference order with their update method
+
+    Columns are downsampled the same way no matter how the references are chunked(see
+    samtools.downsample_column) so the output does not depend on threads
     '''
     # Generate name if not given
     if vcf_output_file is None:
         vcf_output_file = bamfile + '.vcf'
-    # Store the temp file names to concat together later
-    map_args = []
-    # Temporary name suffix because tmpfile is too good of an idea
-    i = 0
-
-    procs = []
-    for refrecord in SeqIO.parse(reffile,'fasta'):
-        reflen = len(refrecord.seq)+1
-
-        # Will break reference into chunks depending on how many threads
-        chunksize = reflen/threads
-        
-        # Make regionstr to match chunks
-        for start in range(1, reflen, chunksize):
-            vcf_tmp_filename = "{0}.{1}".format(vcf_output_file,i)
-            end = start + chunksize - 1
-            regionstr = '{0}:{1}-{2}'.format(refrecord.id,start,end)
-            
-            complete_ref = False
-            if end == reflen:
-                complete_ref = True
-
-            args = (bamfile, reffile, regionstr, vcf_tmp_filename, minbq, maxd, mind, minth, biasth, bias, vcfhead)#, complete_ref)
-            map_args.append(args)
-            # Create and start a new process
-            p = multiprocessing.Process(target=generate_vcf, args=args)
-            p.start()
-            procs.append(p)
-            #generate_vcf(*args)
-            i += 1
-
-        # Wait for all processes to finish
-        for p in procs:
-            p.join()
 
-    with open(vcf_output_file, 'w') as fho:
-        # Write the head
-        fho.write(vcfhead + '\n')
-        # Cat all tmpfiles and remove them
-        for args in map_args:
-            f = args[3]
-            # Write tmp file contents to master file
-            with open(f) as fhr:
-                # Burn off header
-                for line in VCF_HEAD.splitlines():
-                    fhr.readline()
-                fho.write(fhr.read())
-                # Remove temp file
-                os.unlink(f)
+    refs = [(rec.id, len(rec.seq)) for rec in SeqIO.parse(reffile, 'fasta')]
+    # Make sure the homopolymer cache is built once up front so the workers only load it
+    index_reference(reffile)
+    chunks = region_chunks(refs, threads, mapped_reads(bamfile))
+    # Consumers are copied as each chunk is handed out
+    chunk_args = (
+        (bamfile, reffile, regionstr, minbq, maxd, mind, minth, biasth, bias, engine, backend, gap_blocks,
+         copy.deepcopy(consumers), downsample, seed)
+        for regionstr in chunks
+    )
+
+    pool = multiprocessing.Pool(threads, _init_worker, (reffile,))
+    try:
+        with open(vcf_output_file, 'w') as fho:
+            # Write the head
+            fho.write(vcfhead + '\n')
+            for rows, chunk_consumers in ordered_results(pool, _vcf_chunk, chunk_args, threads * CHUNKS_IN_FLIGHT):
+                fho.write(rows)
+                for consumer, chunk_consumer in zip(consumers, chunk_consumers):
+                    consumer.update(chunk_consumer)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
     return vcf_output_file
 
+def ordered_results(pool, func, args, window):
+    '''
+    Same as pool.imap(func, args) except that only window tasks are handed to the pool
+    before their results are taken back. Chunks that finish while an earlier chunk is
+    still running wait in memory so this keeps how many of them there can be bounded
+
+    :param multiprocessing.Pool pool: Pool to run func in
+    :param function func: Function to call with every item of args
+    :param iterable args: Arguments for func(consumed as tasks are handed out)
+    :param int window: Most tasks to have in the pool at once
+
+    @returns generator of func results in the same order as args
+    '''
+    pending = deque()
+    for arg in args:
+        pending.append(pool.apply_async(func, (arg,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+# Number of chunks to create for each thread so that workers that finish early
+# can pick up more work
+CHUNKS_PER_THREAD = 4
+# Most reference bases in a single chunk. The rows of a whole chunk are kept in memory
+# so this keeps them small even for long references
+MAX_CHUNK_BASES = 50000
+# Chunks per thread that can be handed to the pool before their rows are written
+CHUNKS_IN_FLIGHT = 2
+
+def region_chunks(refs, threads, counts=None):
+    '''
+    Splits references into region strings so that each chunk has roughly the same
+    amount of work in it.
+
+    The total amount of chunks is threads * CHUNKS_PER_THREAD(or 1 per reference when
+    only 1 thread is used) and each reference gets a share of them proportional to how
+    many reads are mapped to it. Every reference gets at least 1 chunk and no chunk is
+    longer than MAX_CHUNK_BASES. References without any bases are skipped.
+    If counts is not given then reference length is used instead of read counts.
+
+    :param list refs: [(refname, reflength),...] in the order they should be output
+    :param int threads: How many workers will process the chunks
+    :param dict counts: refname -> mapped read count
+
+    @returns list of region strings in reference order
+    '''
+    refs = [(refname, reflen) for refname, reflen in refs if reflen > 0]
+    if threads <= 1:
+        # Only split up references that are longer than MAX_CHUNK_BASES
+        totalchunks = 0
+    else:
+        totalchunks = threads * CHUNKS_PER_THREAD
+    if counts:
+        weights = [counts.get(refname, 0) for refname, reflen in refs]
+    else:
+        weights = [reflen for refname, reflen in refs]
+    totalweight = float(sum(weights)) or 1.0
+
+    regions = []
+    for (refname, reflen), weight in zip(refs, weights):
+        numchunks = int(round(totalchunks * weight / totalweight))
+        numchunks = max(1, -(-reflen // MAX_CHUNK_BASES), min(numchunks, reflen))
+        chunksize = -(-reflen // numchunks)
+        for start in range(1, reflen + 1, chunksize):
+            end = min(start + chunksize - 1, reflen)
+            regions.append('{0}:{1}-{2}'.format(refname, start, end))
+    return regions
+
+def mapped_reads(bamfile):
+    '''
+    Get the amount of mapped reads for every reference in an indexed bam file
+
+    :param str bamfile: Path to indexed bam
+
+    @returns dictionary of refname -> mapped read count which is empty if the
+        counts could not be determined
+    '''
+    try:
+        return dict((ref, mapped) for ref, length, mapped, unmapped in idxstats(bamfile))
+    except (OSError, ValueError):
+        return {}
+
+def index_reference(reffile):
+    '''
+    Index reference file and find all homopolymers in it
+
+    :param str reffile: Path to reference fasta
+
+    @returns tuple(refseqs, hpolys) where refseqs is the SeqIO.index for reffile
+        and hpolys is hpoly_index for refseqs
+    '''
+    # All the references indexed by the seq.id(first string after the > in the file until the first space)
+    refseqs = SeqIO.index(reffile, 'fasta')
+    # Homopolymers for references
+    hpolys = hpoly_index(reffile, refseqs, 3)
+    return refseqs, hpolys
+
+# Reference index for the current worker process. Set by _init_worker
+_worker_reference = None
+
+def _init_worker(reffile):
+    '''
+    Pool initializer so each worker process only indexes the reference once
+    '''
+    global _worker_reference
+    _worker_reference = index_reference(reffile)
+
+def _vcf_chunk(args):
+    '''
+    Pool worker that generates the vcf rows(without header) for a single region chunk
+
+    :param tuple args: (bamfile, reffile, regionstr, minbq, maxd, mind, minth, biasth, bias,
+        engine, backend, gap_blocks, consumers, downsample, seed)
+
+    @returns tuple(string of vcf rows, consumers)
+    '''
+    bamfile, reffile, regionstr, minbq, maxd, mind, minth, biasth, bias, engine, backend, gap_blocks, consumers, downsample, seed = args
+    out = StringIO()
+    generate_vcf(
+        bamfile, reffile, regionstr, out, minbq, maxd, mind, minth, biasth, bias,
+        None, complete_ref=False, engine=engine, backend=backend, reference=_worker_reference,
+        gap_blocks=gap_blocks, consumers=consumers, downsample=downsample, seed=seed
+    )
+    return out.getvalue(), consumers
+
 def parse_args(args=sys.argv[1:]):
     from ngs_mapper import config
     conf_parser, args, config, configfile = config.get_config_argparse(args)
@@ -232,7 +590,89 @@ def parse_args(args=sys.argv[1:]):
         help=defaults['threads']['help']
    )
 
+    parser.add_argument(
+        '--engine',
+        dest='engine',
+        choices=ENGINES,
+        default=defaults['engine']['default'],
+        help=defaults['engine']['help']
+   )
+
+    parser.add_argument(
+        '--pileup-backend',
+        dest='pileup_backend',
+        choices=PILEUP_BACKENDS,
+        default=defaults['pileup_backend']['default'],
+        help=defaults['pileup_backend']['help']
+   )
+
+    parser.add_argument(
+        '--bgzip',
+        dest='bgzip',
+        action='store_true',
+        default=defaults['bgzip']['default'],
+        help=defaults['bgzip']['help']
+   )
+
+    parser.add_argument(
+        '--qualdepth',
+        dest='qualdepth',
+        default=None,
+        help='Also write the qualdepth json that graphsample uses to this path from the ' \
+            'same pileup pass that is used for base calling[Default: Do not write it]'
+   )
+
+    parser.add_argument(
+        '--save-stats',
+        dest='save_stats',
+        default=None,
+        help='Also write the base counts and quality histograms of every pileup column ' \
+            'to this path so the bam can be called again with different thresholds ' \
+            'using --from-stats[Default: Do not write it]'
+   )
+
+    parser.add_argument(
+        '--from-stats',
+        dest='from_stats',
+        default=None,
+        help='Call bases from a file that was written with --save-stats instead of piling ' \
+            'up the bam. The bam is only used to name the sample in the vcf and the ' \
+            'regions are the ones the file was written with[Default: Pile up the bam]'
+   )
+
+    parser.add_argument(
+        '--gap-blocks',
+        dest='gap_blocks',
+        action='store_true',
+        default=defaults['gap_blocks']['default'],
+        help=defaults['gap_blocks']['help']
+   )
+
+    parser.add_argument(
+        '--downsample',
+        dest='downsample',
+        default=defaults['downsample']['default'],
+        type=int,
+        help=defaults['downsample']['help']
+   )
+
+    parser.add_argument(
+        '--seed',
+        dest='seed',
+        default=defaults['seed']['default'],
+        type=int,
+        help=defaults['seed']['help']
+   )
+
     args = parser.parse_args(args)
+    if args.from_stats and (args.qualdepth or args.save_stats):
+        parser.error('--qualdepth and --save-stats need the bam to be piled up and cannot be used with --from-stats')
+    if args.from_stats and args.downsample:
+        parser.error('--downsample needs the bam to be piled up and cannot be used with --from-stats')
+    if args.downsample is not None and args.downsample < 0:
+        parser.error('--downsample has to be >= 0')
+    if args.seed < 0:
+        parser.error('--seed has to be >= 0')
     if args.vcf_output_file is None:
         args.vcf_output_file = args.bamfile + '.vcf'
 
@@ -242,8 +682,9 @@ def mark_lq(stats, minbq, mind, refbase):
     '''
     Goes through all keys in the stats dictionary that are not in ('depth','mqualsum','bqualsum')
     which should be keys that represent nucleotide bases. Those keys then point to a dictionary
-    that contain 'mapq': [] and 'baseq': []
-    Creating a new base called N or ? depending on the overall depth
+    that contain 'baseq': qual_hist(and optionally 'firstq')
+    The part of each histogram that is < minbq is moved to a new base called N or ? depending
+    on the overall depth
 
         - N for < mind & not refbase
         - Base for < mind & refbase
@@ -251,6 +692,9 @@ def mark_lq(stats, minbq, mind, refbase):
 
     If the base is the reference base and < mind then the base will be preserved to bias the reference in low coverage areas
 
+    Bases are added in the order their qualities are first seen. firstq decides if the base or
+    the low quality base it is split into comes first. Without firstq the base comes first
+
     :param str stats: Stats dictionary returned from stats_at_refpos.stats
     :param str minbq: The mininum base quality to determine if a quality should belong to N
     :param str mind: The minimum depth threshold. If the depth is < this then lq will be labeled N otherwise they will be labeled ? for trimming purposes
@@ -262,31 +706,33 @@ def mark_lq(stats, minbq, mind, refbase):
     stats2['mqualsum'] = stats['mqualsum']
     stats2['bqualsum'] = stats['bqualsum']
 
+    hq = QUALS >= minbq
     for base, quals in stats.iteritems():
         # Only interested in base stats in this loop
         if base not in ('depth','mqualsum','bqualsum'):
-            # generates a list called bquals
             bquals = quals['baseq']
-            # loop to examine the quality score and identifyes bases with a quality score less than the minbq
-            for q in bquals:
-                # Copy base so we can modify if needed without destroying original base
-                k = base
-                if q < minbq:
-                    # Determine base to use since this base is low quality
-                    if stats2['depth'] < mind:
-                        if base != refbase:
-                            # N since low qual and low depth
-                            k = 'N'
-                        else:
-                            # Bias reference base
-                            k = base
-                    else:
-                        # Base is unknown
-                        k = '?'
+            # Determine base to use for the low quality part
+            if stats2['depth'] < mind:
+                if base != refbase:
+                    # N since low qual and low depth
+                    lqbase = 'N'
+                else:
+                    # Bias reference base
+                    lqbase = base
+            else:
+                # Base is unknown
+                lqbase = '?'
+            parts = [(base, np.where(hq, bquals, 0)), (lqbase, np.where(hq, 0, bquals))]
+            if quals.get('firstq', minbq) < minbq:
+                parts.reverse()
+            for k, hist in parts:
+                if not hist.any():
+                    continue
                 # adds the N to the nucleotides (A C G T and N)
                 if k not in stats2:
-                    stats2[k] = {'baseq':[]}
-                stats2[k]['baseq'].append(q)
+                    stats2[k] = {'baseq':hist}
+                else:
+                    stats2[k]['baseq'] = stats2[k]['baseq'] + hist
     return stats2
 
 def hpoly_list(refseqs, minlength=3):
@@ -302,17 +748,112 @@ def hpoly_list(refseqs, minlength=3):
         hpolys[seq] = [(m.group(0),m.start()+1,m.end()) for m in matches]
     return hpolys
 
+def hpoly_bitmap(hpolys, refseqs):
+    '''
+    Convert hpoly_list output into a boolean array for each sequence that is indexed
+    by 1-based reference position so looking up a position is a single index
+
+    :param dict hpolys: hpoly_list output
+    :param str refseqs: Bio.SeqIO.index'd fasta
+
+    @returns dictionary of seqid -> numpy bool array of length len(seq)+1
+    '''
+    bitmaps = {}
+    for seqid, polys in hpolys.iteritems():
+        bitmap = np.zeros(len(refseqs[seqid].seq) + 1, dtype=bool)
+        for nucs, start, end in polys:
+            bitmap[start:end+1] = True
+        bitmaps[seqid] = bitmap
+    return bitmaps
+
+def save_hpoly_bitmap(bitmaps, cachefile):
+    '''
+    Save hpoly_bitmap output to cachefile(.npz)
+    The file is written to a temp file first and then renamed so that
+    concurrent runs never see a partial file
+
+    :param dict bitmaps: hpoly_bitmap output
+    :param str cachefile: Path to save to
+    '''
+    seqids = sorted(bitmaps)
+    lengths = [len(bitmaps[seqid]) for seqid in seqids]
+    if seqids:
+        bits = np.packbits(np.concatenate([bitmaps[seqid] for seqid in seqids]))
+    else:
+        bits = np.zeros(0, dtype=np.uint8)
+    fh = tempfile.NamedTemporaryFile(dir=dirname(cachefile) or '.', suffix='.npz', delete=False)
+    try:
+        np.savez(fh, seqids=np.array(seqids, dtype=str), lengths=np.array(lengths, dtype=np.int64), bits=bits)
+        fh.close()
+        os.rename(fh.name, cachefile)
+    except:
+        fh.close()
+        os.unlink(fh.name)
+        raise
+
+def load_hpoly_bitmap(cachefile):
+    '''
+    Load bitmaps that were saved with save_hpoly_bitmap
+
+    :param str cachefile: Path to .npz cache file
+
+    @returns dictionary of seqid -> numpy bool array
+    '''
+    cache = np.load(cachefile)
+    lengths = cache['lengths']
+    bits = np.unpackbits(cache['bits'])[:lengths.sum()].astype(bool)
+    bitmaps = {}
+    offset = 0
+    for seqid, length in zip(cache['seqids'], lengths):
+        bitmaps[str(seqid)] = bits[offset:offset+length]
+        offset += length
+    return bitmaps
+
+def hpoly_index(reffile, refseqs, minlength=3):
+    '''
+    Returns hpoly_bitmap for refseqs which is cached next to the reference(and its .fai)
+    as <reffile>.hpoly<minlength>.npz. The cache is rebuilt if the reference is newer than it
+
+    :param str reffile: Path to reference that refseqs was indexed from
+    :param str refseqs: Bio.SeqIO.index'd fasta
+    :param int minlength: Minimum length of homopolymers
+
+    @returns dictionary of seqid -> numpy bool array
+    '''
+    cachefile = '{0}.hpoly{1}.npz'.format(reffile, minlength)
+    try:
+        if getmtime(cachefile) >= getmtime(reffile):
+            return load_hpoly_bitmap(cachefile)
+    except (OSError, IOError, ValueError, KeyError):
+        # Missing or unreadable cache
+        pass
+    bitmaps = hpoly_bitmap(hpoly_list(refseqs, minlength), refseqs)
+    if exists(reffile):
+        try:
+            save_hpoly_bitmap(bitmaps, cachefile)
+        except (OSError, IOError):
+            # Reference directory may not be writable
+            pass
+    return bitmaps
+
 def is_hpoly(hpolylist, seqid, curpos):
     '''
     Identifies if a position is contained inside of a homopolymer
+
+    :param dict hpolylist: hpoly_list or hpoly_index output
+    :param str seqid: Sequence id
+    :param int curpos: 1-based position in the sequence
     '''
     l = hpolylist[seqid]
+    # Bitmaps are a single lookup
+    if isinstance(l, np.ndarray):
+        return 0 < curpos < len(l) and bool(l[curpos])
     for polys in l:
         if curpos >= polys[1] and curpos <= polys[2]:
             return True
     return False
 
-def generate_vcf(bamfile, reffile, regionstr, vcf_output_file, minbq, maxd, mind=10, minth=0.8, biasth=50, bias=10, vcf_template=VCF_HEAD, complete_ref=False):
+def generate_vcf(bamfile, reffile, regionstr, vcf_output_file, minbq, maxd, mind=10, minth=0.8, biasth=50, bias=10, vcf_template=VCF_HEAD, complete_ref=False, engine='python', backend='samtools', reference=None, gap_blocks=False, consumers=(), piles=None, downsample=None, seed=0):
     '''
     Generates a vcf file from a given vcf_template file
 
@@ -331,89 +872,157 @@ def generate_vcf(bamfile, reffile, regionstr, vcf_output_file, minbq, maxd, mind
     :param float minth: Minimum percentage for a base to be called
     :param int biasth: What quality value(>=) should be considered to be bias towards
     :param str bias: For every base >= biasth add bias more of those bases
-    :param str vcf_template: VCF Header template(string)
+    :param str vcf_template: VCF Header template(string). None only writes the rows
     :param bool complete_ref: If True, then complete all the way to the end position in regionstr
+    :param str engine: Which base calling engine to use(One of ENGINES)
+    :param str backend: Which pileup backend to use(One of samtools.PILEUP_BACKENDS)
+    :param tuple reference: (refseqs, hpolys) as returned by index_reference to use instead of
+        indexing reffile again
+    :param bool gap_blocks: Write stretches without coverage as single rows with END set(see write_gap)
+    :param list consumers: Other pileup consumers(such as bqd.QualDepth) that get every pileup
+        column of the region as well so the bam only has to be read once(see samtools.fan_out)
+    :param list piles: Columns of the region(such as ColumnStats from read_column_stats) to
+        call instead of piling up bamfile. consumers are not used then
+    :param int downsample: Call columns deeper than this from a random downsample of this many
+        bases(see samtools.downsample_column). DP of those rows is the depth of the whole
+        column and the other counts are scaled up to it(see scale_counts). consumers still
+        get every base. The pileup itself is not limited since mpileup -d would keep the
+        reads that start first instead of a random sample
+    :param int seed: Seed for the random downsample
+
+    vcf_output_file may also be an open file like object in which case it is written to
+    but not closed
 
     @returns path to vcf_output_file
     '''
     #print regionstr
-    # All the references indexed by the seq.id(first string after the > in the file until the first space)
-    refseqs = SeqIO.index(reffile, 'fasta')
-    # Homopolymers for references
-    hpolys = hpoly_list(refseqs, 3)
-    # Our pretend file object that has vcf stuff in it
-    vcf_head = StringIO(vcf_template)
-    vcf_head.name = 'header.vcf'
+    # Function that generates a vcf row for each pileup column
+    vcf_row = row_generator(engine)
+    # All the references indexed by the seq.id and the homopolymers for them
+    if reference is None:
+        reference = index_reference(reffile)
+    refseqs, hpolys = reference
     # Where to write the output file to
     if vcf_output_file is None:
         output_path = bamfile + '.vcf'
     else:
         output_path = vcf_output_file
     # The vcf writer object
-    fh = open(output_path, 'w')
-    out_vcf = vcf.Writer(
-        fh,
-        template=vcf.Reader(vcf_head)
-    )
+    if hasattr(output_path, 'write'):
+        fh = output_path
+    else:
+        fh = open(output_path, 'w')
+    out_vcf = VcfWriter(fh, vcf_template)
 
 
-    # Get the iterator for an mpileupcal
-    # Do not exclude any bases by setting minmq and minbq to 0 and maxdepth to 100000
-    piles = mpileup(bamfile, regionstr, 0, 0, 100000)
+    if piles is None:
+        # Consumers that write down which region their columns belong to
+        for consumer in consumers:
+            if hasattr(consumer, 'start_region'):
+                consumer.start_region(regionstr)
+        # Get the iterator for an mpileupcal
+        # Do not exclude any bases by setting minmq and minbq to 0 and maxdepth to 100000
+        piles = fan_out(mpileup(bamfile, regionstr, 0, 0, 100000, backend), consumers)
 
     # Parse the region string for later
     parsed_regionstr = parse_regionstring(regionstr)
     # Get the reference name to work with
     refname = parsed_regionstr[0]
-    refseq = refseqs[refname].seq
+    refseq = str(refseqs[refname].seq)
     # The end of the ref may be restricted via regionstr
     # Lets user specify region start less than 1
     refstart = max(parsed_regionstr[1], 1)
-    # Set refstart to 0 if regionstring start is 1
-    # so that the first base gets inserted with blank_vcf_rows
-    if refstart == 1:
-        refstart = 0
     # Lets user specify region end past length of region
     refend = min(parsed_regionstr[2], len(refseq))
     # Last position stores the last position seen
-    lastpos = refstart
+    # Start one before refstart so that the first base of the region gets inserted
+    # with blank_vcf_rows if it has no coverage(regions do not always start at 1)
+    lastpos = refstart - 1
 
     # Loop through each pileup row
-    for pilestr in piles:
-        # Generate the handy pileup column object
-        col = MPileupColumn(pilestr)
+    for col in piles:
         # Current position in alignment
         curpos = col.pos
-        # The reference we are iterating on
-        for rec in blank_vcf_rows(col.ref, refseq, lastpos, curpos, '-'):
-            if is_hpoly(hpolys, col.ref, rec.POS):
-                rec.INFO['HPOLY'] = True
-            out_vcf.write_record(rec)
+        # Fill in positions without coverage
+        write_gap(out_vcf, col.ref, refseq, hpolys, lastpos, curpos, gap_blocks)
+        fullcol = col
+        if downsample:
+            col = downsample_column(col, downsample, seed)
         # Generate the vcf row for that column
-        row = generate_vcf_row(col, refseq, minbq, maxd, mind, minth, biasth, bias)
+        row = vcf_row(col, refseq, minbq, maxd, mind, minth, biasth, bias)
         if is_hpoly(hpolys, col.ref, curpos):
             if row.INFO['CB'] == 'N':
-                row = generate_vcf_row(col, refseq, 10, maxd, 2, 0.5, biasth, bias)
+                row = vcf_row(col, refseq, 10, maxd, 2, 0.5, biasth, bias)
             row.INFO['HPOLY'] = True
+        if col is not fullcol:
+            scale_counts(row, fullcol.depth, col.depth)
         # Write the record to the vcf file
         out_vcf.write_record(row)
         # Set last position seen
         lastpos = row.POS
 
     # Insert blank vcf records from last position in mpileup to the end of regionstring
-    for rec in blank_vcf_rows(refname, refseq, lastpos, refend+1, '-'):
-        if is_hpoly(hpolys, refname, rec.POS):
-            rec.INFO['HPOLY'] = True
-        out_vcf.write_record(rec)
+    write_gap(out_vcf, refname, refseq, hpolys, lastpos, refend + 1, gap_blocks)
 
-    # Close the file
-    out_vcf.close()
+    # Close the file unless it was handed to us already open
+    if fh is output_path:
+        out_vcf.flush()
+    else:
+        out_vcf.close()
 
     return output_path
 
+def scale_counts(row, depth, sampled):
+    '''
+    Sets DP of a row that was called from a downsampled column to the depth of the whole
+    column, scales the base counts(RC, AC and CBD) up by the same factor and sets the DS flag.
+    The percentages and average qualities are already estimates for the whole column and
+    are left alone
+
+    :param VcfRow row: Row generated from the downsampled column
+    :param int depth: Depth of the whole column
+    :param int sampled: Depth of the downsampled column
+    '''
+    info = row.INFO
+    factor = depth / float(sampled)
+    info['DP'] = depth
+    for key in ('RC', 'CBD'):
+        info[key] = int(round(info[key] * factor))
+    if 'AC' in info:
+        info['AC'] = [int(round(count * factor)) for count in info['AC']]
+    info['DS'] = True
+
+def write_gap(out_vcf, refname, refseq, hpolys, frompos, topos, blocks=False, call='-'):
+    '''
+    Writes blank rows(the same as blank_vcf_rows) straight to out_vcf for all positions
+    between frompos and topos(not inclusive)
+
+    If blocks is True then each stretch of positions that are all homopolymer or all
+    not homopolymer is written as a single gVCF style block row at the first position
+    of the stretch with END set to the last position of the stretch.
+
+    :param VcfWriter out_vcf: Where to write the rows
+    :param str refname: Reference name
+    :param str refseq: Reference sequence to get reference base from
+    :param dict hpolys: hpoly_index output
+    :param int frompos: Last position seen in the alignment(1 based)
+    :param int topos: Current position in the alignment(1 based)
+    :param bool blocks: Write block rows
+    :param str call: What to set the CB info field to
+    '''
+    pos = frompos + 1
+    while pos < topos:
+        hpoly = is_hpoly(hpolys, refname, pos)
+        end = pos
+        if blocks:
+            while end + 1 < topos and is_hpoly(hpolys, refname, end + 1) == hpoly:
+                end += 1
+        out_vcf.write_blank(refname, pos, refseq[pos-1], call, hpoly, end if end > pos else None)
+        pos = end + 1
+
 def blank_vcf_rows(refname, refseq, frompos, topos, call='-'):
     '''
-    Returns a list of blank vcf rows for all positions that are missing
+    Generates blank vcf rows for all positions that are missing
     between frompos and topos.
 
     Not inclusive of topos or frompos
@@ -421,27 +1030,19 @@ def blank_vcf_rows(refname, refseq, frompos, topos, call='-'):
     The blank rows should represent a gap in the alignment and be called whatever
     call is set too
 
-    :param str refname: Reference name to set _Record.CHROM
+    :param str refname: Reference name to set VcfRow.CHROM
     :param str refseq: Reference sequence to get reference base from
     :param int topos: Current position in the alignment(1 based)
     :param int frompos: Last position seen in the alignment(1 based)
     :param str call: - What to set the CB info field to(Default to:)
     :param bool includeend: Include end base position
 
-    @returns a list of vcf.model._Record objects filled out with the DP,RC,RAQ,PRC,CBD=0 and CB=call
+    @returns generator of VcfRow objects filled out with the DP,RC,RAQ,PRC,CBD=0 and CB=call
     '''
-    #print refname
-    #print 'Topos: {0}'.format(topos)
-    #print 'formpos: {0}'.format(frompos)
-    # Blank record list
-    records = []
     # Only do records between frompos and topos
-    for i in range(frompos + 1, topos):
+    for i in xrange(frompos + 1, topos):
         # Reference base at current position
-        rec = blank_vcf_row(refname, refseq, i, call)
-        records.append(rec)
-
-    return records
+        yield blank_vcf_row(refname, refseq, i, call)
 
 def blank_vcf_row(refname, refseq, pos, call='-'):
     '''
@@ -451,7 +1052,7 @@ def blank_vcf_row(refname, refseq, pos, call='-'):
     :param str pos: Reference position to get the reference base from(1 indexed)
     :param str call: What to set the CB info field to
 
-    @returns a vcf.model._Record
+    @returns a VcfRow
     '''
     info = dict(
         DP=0,
@@ -461,37 +1062,33 @@ def blank_vcf_row(refname, refseq, pos, call='-'):
         CB=call,
         CBD=0
     )
-    record = vcf.model._Record(refname, pos, None, refseq[pos-1], '.', None, None, info, None, None)
-    return record
+    return VcfRow(refname, pos, refseq[pos-1], '.', info)
 
 def bias_hq(stats, biasth=50, bias=10):
     '''
     Biases high quality reads in stats so that they are more likely to be selected later on.
-    Essentially duplicates quality scores(baseq values) by a factor of bias.
+    Essentially multiplies the counts of quality scores(baseq histogram bins) >= biasth by a factor of bias.
     Given the example::
 
-        stats = { 'A': {'baseq':[40,40,40]}, 'C': {'baseq':[50,50,50,50,50,50,50]} }
+        stats = { 'A': {'baseq':qual_hist([40,40,40])}, 'C': {'baseq':qual_hist([50,50,50,50,50,50,50])} }
 
     Without any biasing the called base would likely be called an M as there is no majority of C's
     since A is 30% and C is 70%(Assuming 0.8 minth which requires 80% to be called)
     With bias_hq(stats, 50, 2) you would end up with 3 A's and 14 C's or 18% A and 82% C so C
     would be more correctly called for the consensus
 
-    bias will round the length of the created list to the nearest integer so if the length of a
-    baseq is say 10 and the bias is 1.25 the resulting baseq list will be 13 in length(addition of 3 baseq)
-
     :param dict stats: Should most likely be a stats2 dictionary although stats would work as well
     :param int biasth: What quality value(>=) should be considered to be bias towards
     :param int bias: How much to bias aka, how much to multiply the # of quals >= biasth(has to be int >= 1)
 
     :rtype: dict
-    :return: stats2 formatted dictionary with all baseq lists appended to with the bias amount
+    :return: stats2 formatted dictionary with all baseq histograms biased by the bias amount
     '''
     if bias < 1 or int(bias) != bias:
         raise ValueError("bias was set to {0} which is less than 1. Cannot bias on a factor < 1".format(bias))
 
-    # Because we are adding onto the existing list this needs to be one less
-    bias = int(bias) - 1
+    # How many times every quality counts
+    weights = np.where(QUALS >= biasth, int(bias), 1)
 
     stats2 = {'depth': 0}
 
@@ -501,13 +1098,9 @@ def bias_hq(stats, biasth=50, bias=10):
             if k != 'depth':
                 stats2[k] = v
             continue
-        stats2[k] = {}
-        bquals = v['baseq']
-        # New list of all baseq >= biasth biased by a factor of bias
-        duplist = [d for d in bquals if d >= biasth] * bias
-        stats2[k]['baseq'] = v['baseq'] + duplist
-        stats2[k]['mapq'] = v.get('mapq', [])
-        stats2['depth'] += len(stats2[k]['baseq'])
+        stats2[k] = dict(v)
+        stats2[k]['baseq'] = v['baseq'] * weights
+        stats2['depth'] += hist_count(stats2[k]['baseq'])
     return stats2
 
 def pile_stats(mpileupcol, refbase, minbq, mind, biasth, bias):
@@ -530,7 +1123,7 @@ def pile_stats(mpileupcol, refbase, minbq, mind, biasth, bias):
     # are equal to or above the min depth
     if stats2['depth'] >= mind:
         if '?' in stats2:
-            stats2['depth'] -= len(stats2['?']['baseq'])
+            stats2['depth'] -= hist_count(stats2['?']['baseq'])
             del stats2['?']
 
     return stats2
@@ -548,7 +1141,7 @@ def generate_vcf_row(mpileupcol, refseq, minbq, maxd, mind=10, minth=0.8, biasth
     :param int biasth: What quality value(>=) should be considered to be bias towards
     :param int bias: How much to bias aka, how much to multiply the # of quals >= biasth(has to be int >= 1)
 
-    @returns a vcf.model._Record
+    @returns a VcfRow
     '''
     # The base position should be the same as the second item in the parsed region string
     start = mpileupcol.pos
@@ -578,12 +1171,12 @@ def generate_vcf_row(mpileupcol, refseq, minbq, maxd, mind=10, minth=0.8, biasth
     # Maybe reference base isn't in stats
     if rb in stats2:
         refstats = stats2[rb]
-        # Reference Count is length of the base qualities list
-        info['RC'] = len(refstats['baseq'])
-        # Reference Average Quality is the sum of base qualities / length
-        info['RAQ'] = int(round(sum(refstats['baseq']) / float(len(refstats['baseq'])), 0))
-        # Percentage Reference Count is len of qualities / depth
-        info['PRC'] = int(round((100.0 * len(refstats['baseq'])) / float(stats2['depth']), 0))
+        # Reference Count is how many base qualities there are
+        info['RC'] = hist_count(refstats['baseq'])
+        # Reference Average Quality is the sum of base qualities / count
+        info['RAQ'] = int(round(hist_sum(refstats['baseq']) / float(info['RC']), 0))
+        # Percentage Reference Count is count of qualities / depth
+        info['PRC'] = int(round((100.0 * info['RC']) / float(stats2['depth']), 0))
     else:
         info['RC'] = 0
         info['RAQ'] = 0
@@ -603,9 +1196,7 @@ def generate_vcf_row(mpileupcol, refseq, minbq, maxd, mind=10, minth=0.8, biasth
         alt_bases = '.'
 
     # need to record each line of the vcf file.
-    record = vcf.model._Record(mpileupcol.ref, start, None, rb, alt_bases, None, None, info, None, None)
-
-    return record
+    return VcfRow(mpileupcol.ref, start, rb, alt_bases, info)
 
 def caller(stats2, minbq, maxd, mind=10, minth=0.8):
     '''
@@ -629,7 +1220,7 @@ def caller(stats2, minbq, maxd, mind=10, minth=0.8):
     # Else we will determine if the N's are the majority now
     # defines if the base is an N
     if '?' in stats2:
-        nlen = len(stats2['?']['baseq'])
+        nlen = hist_count(stats2['?']['baseq'])
         np = nlen/(stats2['depth']*1.0)
         if np > (1-minth):
             return ('N', nlen)
@@ -641,7 +1232,7 @@ def call_on_pct(stats2, minth=0.8):
     any base where it is in %total >= minth.
 
     Base quality is not used to make the determination, but instead the number of quality scores
-    in the baseq list is used as it depicts the depth of that base. The quality scores are not used
+    in the baseq histogram is used as it depicts the depth of that base. The quality scores are not used
     as the stats dictionary should already be run through the label_n function.
 
     :param str stats2: Stats dictionary returned from mark_lq or stats_at_refpos.stats
@@ -657,15 +1248,15 @@ def call_on_pct(stats2, minth=0.8):
     for base, quals in stats2.iteritems():
         # Only interested in base stats in this loop
         if base not in ('depth','mqualsum','bqualsum'):
-            # Quick alias for quals['baseq']
-            bquals = quals['baseq']    
+            # Depth of the current base
+            bcount = hist_count(quals['baseq'])
             # Percentage of current base compared to total depth
-            np_2 = len(bquals)/(stats2['depth']*1.0)
+            np_2 = bcount/(stats2['depth']*1.0)
             # fix for proper calculations with float
             # If basepercent is greater than minimum threashold
             if np_2 > round((1-minth),2):
                 nt_list += base
-                count += len(bquals)
+                count += bcount
     dnalist = sorted(nt_list)
     try:
         return (iupac_amb(dnalist), count)
@@ -705,13 +1296,436 @@ def info_stats(stats, rb):
     for base, quals in stats.iteritems():
         if base  not in ('depth','mqualsum','bqualsum',rb):
             # identify the alternitive bases in stats 2        
+            bcount = hist_count(quals['baseq'])
             # data for the alternitive count
-            info['AC'].append(len(quals['baseq']))
+            info['AC'].append(bcount)
             # data for the alternitive avarage quality
-            info['AAQ'].append(int(round((sum(quals['baseq'])*1.0)/len(quals['baseq']))))
+            info['AAQ'].append(int(round((hist_sum(quals['baseq'])*1.0)/bcount)))
             # data for the percentage reference count
-            info['PAC'].append(int(round((len(quals['baseq'])*100.0)/(stats['depth']))))
+            info['PAC'].append(int(round((bcount*100.0)/(stats['depth']))))
             # base data
             info['bases'].append(base)
                                      
     return info
+
+def row_generator(engine):
+    '''
+    Returns the function that generates a vcf row for the given engine
+
+    Both engines accept the same arguments as generate_vcf_row and produce
+    identical records
+
+    :param str engine: One of ENGINES
+
+    @returns generate_vcf_row or generate_vcf_row_numpy
+    '''
+    if engine == 'python':
+        return generate_vcf_row
+    elif engine == 'numpy':
+        return generate_vcf_row_numpy
+    raise ValueError(
+        "{0} is not a valid engine. Must be one of {1}".format(engine, ', '.join(ENGINES))
+    )
+
+def column_arrays(mpileupcol):
+    '''
+    Returns the bases and base qualities of an mpileup column as numpy arrays
+
+    Bases are returned as their ascii codes so they can be used directly as indexes
+    into fixed size(256) count arrays
+
+    :param str mpileupcol: samtools.MPileupColumn
+
+    @returns tuple(bases, quals) where bases is a uint8 array and quals is an int array
+    '''
+    bases = mpileupcol.base_array
+    quals = mpileupcol.bqual_array.astype(np.int64)
+    assert len(quals) == mpileupcol.depth, "Somehow length of bases != length of Base Qualities"
+    return bases, quals
+
+# First line of a column statistics file(see write_column_stats)
+COLUMN_STATS_HEAD = '##base_caller column statistics'
+
+class ColumnStats(object):
+    '''
+    Sufficient statistics of a pileup column for base calling
+
+    Every base in the column has a histogram of its base qualities. The bases are
+    kept in the order they first appear in the column along with the quality of
+    that first appearance since that decides the order alternate bases are written
+    to the vcf(see pile_stats_hist). That is all that is needed to call the column
+    with any minbq, mind, minth, biasth or bias, so the numpy engine can call a
+    ColumnStats in place of the MPileupColumn it was built from.
+
+    :param str ref: Reference name
+    :param int pos: 1-based reference position
+    :param list seen: [(base, first quality),...] in the order the bases first appear
+    :param numpy.array hists: len(seen) x MAX_QUAL + 1 array of quality counts(see samtools.base_hists)
+    '''
+    __slots__ = ('ref', 'pos', 'seen', 'hists')
+
+    def __init__(self, ref, pos, seen, hists):
+        self.ref = ref
+        self.pos = pos
+        self.seen = seen
+        self.hists = hists
+
+    @classmethod
+    def from_arrays(klass, ref, pos, bases, quals):
+        '''
+        Build from the arrays that column_arrays returns
+
+        @returns ColumnStats
+        '''
+        codes, first, hists = base_hists(bases, quals)
+        seen = [(chr(b), int(quals[i])) for b, i in zip(codes, first)]
+        return klass(ref, pos, seen, hists)
+
+    @classmethod
+    def from_column(klass, mpileupcol):
+        '''
+        Build from an MPileupColumn or return mpileupcol if it already is a ColumnStats
+
+        @returns ColumnStats
+        '''
+        if isinstance(mpileupcol, klass):
+            return mpileupcol
+        bases, quals = column_arrays(mpileupcol)
+        return klass.from_arrays(mpileupcol.ref, mpileupcol.pos, bases, quals)
+
+    @classmethod
+    def from_line(klass, line):
+        '''
+        Parse a line that str(ColumnStats) created
+
+        @returns ColumnStats
+        '''
+        fields = line.rstrip('\n').split('\t')
+        seen = []
+        counts = []
+        for field in fields[2:]:
+            base, firstq, hist = field.split(':')
+            seen.append((base, int(firstq)))
+            counts.append([[int(x) for x in qc.split('=')] for qc in hist.split(',')])
+        hists = np.zeros((len(seen), MAX_QUAL + 1), dtype=np.int64)
+        for row, qcs in enumerate(counts):
+            for q, c in qcs:
+                hists[row, q] = c
+        return klass(fields[0], int(fields[1]), seen, hists)
+
+    @property
+    def depth(self):
+        return int(self.hists.sum())
+
+    def __str__(self):
+        '''
+        Tab separated reference, position and base:first quality:quality=count,...
+        for every base with only the qualities that have a count
+        '''
+        fields = [self.ref, str(self.pos)]
+        for (base, firstq), hist in zip(self.seen, self.hists):
+            counts = ','.join('{0}={1}'.format(q, hist[q]) for q in np.flatnonzero(hist))
+            fields.append('{0}:{1}:{2}'.format(base, firstq, counts))
+        return '\t'.join(fields)
+
+class ColumnStatsCollector(object):
+    '''
+    Pileup consumer(see samtools.fan_out) that writes the ColumnStats line of every column
+    along with a #region line for every region it is handed(see generate_vcf)
+
+    Lines are written to stream as soon as they are made. Without a stream the lines
+    are kept in memory. Copies(deepcopy or pickle such as the ones handed to pool
+    workers) never have a stream so they only hold the lines of their own region until
+    they are written out by update on the collector they came from
+
+    :param file stream: Open file to write the lines to(see column_stats_writer)
+    '''
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.lines = []
+
+    def __getstate__(self):
+        return {'stream': None, 'lines': self.lines}
+
+    def _write(self, line):
+        if self.stream is None:
+            self.lines.append(line)
+        else:
+            self.stream.write(line + '\n')
+
+    def start_region(self, regionstr):
+        ''' Columns added after this belong to regionstr '''
+        self._write('#region\t' + regionstr)
+
+    def add(self, col):
+        ''' Add a single pileup column '''
+        self._write(str(ColumnStats.from_column(col)))
+
+    def update(self, other):
+        ''' Add the lines of other after the lines of this collector '''
+        for line in other.lines:
+            self._write(line)
+
+    def close(self):
+        ''' Close stream '''
+        if self.stream is not None:
+            self.stream.close()
+
+def column_stats_writer(outfile):
+    '''
+    ColumnStatsCollector that writes straight to a new column statistics file
+
+    :param str outfile: Where to write the statistics
+
+    @returns ColumnStatsCollector that has to be closed once all regions are added
+    '''
+    fh = open(outfile, 'w')
+    fh.write(COLUMN_STATS_HEAD + '\n')
+    return ColumnStatsCollector(fh)
+
+def write_column_stats(collector, outfile):
+    '''
+    Write the lines of a ColumnStatsCollector that kept them in memory
+
+    :param ColumnStatsCollector collector: Collector that has seen all regions
+    :param str outfile: Where to write the statistics
+
+    @returns outfile
+    '''
+    with open(outfile, 'w') as fh:
+        fh.write(COLUMN_STATS_HEAD + '\n')
+        for line in collector.lines:
+            fh.write(line + '\n')
+    return outfile
+
+def read_column_stats(statsfile):
+    '''
+    Read a file that was written with write_column_stats one region at a time
+
+    :param str statsfile: Path to column statistics file
+
+    @returns generator of (regionstr, [ColumnStats,...]) in the order they were written
+    '''
+    with open(statsfile) as fh:
+        if fh.readline().rstrip('\n') != COLUMN_STATS_HEAD:
+            raise ValueError("{0} is not a base_caller column statistics file".format(statsfile))
+        regionstr = None
+        columns = []
+        for line in fh:
+            if line.startswith('#region\t'):
+                if regionstr is not None:
+                    yield regionstr, columns
+                regionstr = line.rstrip('\n').split('\t')[1]
+                columns = []
+            elif not line.startswith('#'):
+                columns.append(ColumnStats.from_line(line))
+        if regionstr is not None:
+            yield regionstr, columns
+
+def pile_stats_numpy(bases, quals, refbase, minbq, mind, biasth, bias):
+    '''
+    Numpy equivalent of pile_stats that reduces every base to a count and quality sum
+    instead of a stats dictionary of quality histograms
+
+    The column is reduced to a ColumnStats and called with pile_stats_hist
+
+    :param numpy.array bases: ascii codes of the bases from column_arrays
+    :param numpy.array quals: base qualities from column_arrays
+
+    All other parameters are the same as pile_stats_hist
+
+    @returns stats dictionary
+    '''
+    return pile_stats_hist(ColumnStats.from_arrays(None, None, bases, quals), refbase, minbq, mind, biasth, bias)
+
+def pile_stats_hist(colstats, refbase, minbq, mind, biasth, bias):
+    '''
+    Computes the pile_stats statistics from the quality histograms of a ColumnStats
+
+    Each base in the returned dictionary points to a [count, qualsum] list where count
+    is the number of (biased) bases and qualsum is the sum of their qualities. The depth key
+    is the total (biased) depth after low quality bases have been removed or marked.
+
+    pile_stats builds its dictionary from base_stats, bias_hq and mark_lq which each
+    create a new dictionary from the previous one. The same insertions are replayed here
+    so that iterating the returned dictionary gives the bases in exactly the same order
+    as pile_stats would(this is the order alternate bases are written to the vcf).
+
+    :param ColumnStats colstats: Statistics of the column
+    :param str refbase: Reference base
+    :param int minbq: minimum base quality to be considered or turned into an N
+    :param int mind: Minimum depth decides if low quality bases are N's or if they are removed
+    :param int biasth: What quality value(>=) should be considered to be bias towards
+    :param int bias: How much to bias aka, how much to multiply the # of quals >= biasth(has to be int >= 1)
+
+    @returns stats dictionary
+    '''
+    if bias < 1 or int(bias) != bias:
+        raise ValueError("bias was set to {0} which is less than 1. Cannot bias on a factor < 1".format(bias))
+
+    # How many times each quality counts after biasing high quality bases
+    weights = np.where(QUALS >= biasth, int(bias), 1)
+    counts = colstats.hists * weights
+    sums = counts * QUALS
+    hq = QUALS >= minbq
+    lq = ~hq
+    # Biased counts and quality sums for each base split by high/low quality
+    hq_counts = counts[:, hq].sum(axis=1)
+    hq_sums = sums[:, hq].sum(axis=1)
+    lq_counts = counts[:, lq].sum(axis=1)
+    lq_sums = sums[:, lq].sum(axis=1)
+    depth = int(counts.sum())
+    rows = dict((b, row) for row, (b, q) in enumerate(colstats.seen))
+
+    # Replay base_stats
+    base_stats = {'depth':None,'mqualsum':None,'bqualsum':None}
+    for b, q in colstats.seen:
+        base_stats[b] = q
+    # Replay bias_hq
+    biased = {'depth':None}
+    for k, v in base_stats.iteritems():
+        if k != 'depth':
+            biased[k] = v
+    # Replay mark_lq while filling in the counts
+    stats = {}
+    stats['depth'] = depth
+    stats['mqualsum'] = None
+    stats['bqualsum'] = None
+    for base, firstq in biased.iteritems():
+        if base in STATS_KEYS:
+            continue
+        row = rows[base]
+        if depth < mind:
+            if base != refbase:
+                lqbase = 'N'
+            else:
+                lqbase = base
+        else:
+            lqbase = '?'
+        hqstat = (base, hq_counts[row], hq_sums[row])
+        lqstat = (lqbase, lq_counts[row], lq_sums[row])
+        # Whichever quality class the first base falls into gets inserted first
+        if firstq < minbq:
+            bstats = (lqstat, hqstat)
+        else:
+            bstats = (hqstat, lqstat)
+        for k, count, qualsum in bstats:
+            if count:
+                if k not in stats:
+                    stats[k] = [0, 0]
+                stats[k][0] += int(count)
+                stats[k][1] += int(qualsum)
+
+    # Remove low quality bases since we are equal to or above the min depth
+    if stats['depth'] >= mind:
+        if '?' in stats:
+            stats['depth'] -= stats['?'][0]
+            del stats['?']
+
+    return stats
+
+def caller_numpy(stats, minth=0.8):
+    '''
+    Equivalent of caller/call_on_pct for a stats dictionary from pile_stats_numpy
+
+    :param dict stats: Stats dictionary returned from pile_stats_numpy
+    :param float minth: minimum percentage that a base needs to be present in order to be called non-ambiguous
+
+    @returns the called base and the depth for the called base
+    '''
+    if '?' in stats:
+        nlen = stats['?'][0]
+        np_ = nlen/(stats['depth']*1.0)
+        if np_ > (1-minth):
+            return ('N', nlen)
+    nt_list = ''
+    count = 0
+    for base, counts in stats.iteritems():
+        if base not in STATS_KEYS:
+            np_2 = counts[0]/(stats['depth']*1.0)
+            if np_2 > round((1-minth),2):
+                nt_list += base
+                count += counts[0]
+    dnalist = sorted(nt_list)
+    try:
+        return (iupac_amb(dnalist), count)
+    except ValueError as e:
+        if dnalist:
+            ndepth = count
+        else:
+            ndepth = stats.get('depth', 0)
+        return ('N', ndepth)
+
+def info_stats_numpy(stats, rb):
+    '''
+    Equivalent of info_stats for a stats dictionary from pile_stats_numpy
+
+    :param dict stats: Stats dictionary returned from pile_stats_numpy
+    :param str rb: Reference base to ignore in the outputted dictionary
+
+    @returns info dictionary with AC,AAQ, PAC and bases keys filled out
+    '''
+    info = {
+        'AC' : [],
+        'AAQ' : [],
+        'PAC' : [],
+        'bases' : []
+    }
+    for base, counts in stats.iteritems():
+        if base not in ('depth','mqualsum','bqualsum',rb):
+            count, qualsum = counts
+            info['AC'].append(count)
+            info['AAQ'].append(int(round((qualsum*1.0)/count)))
+            info['PAC'].append(int(round((count*100.0)/(stats['depth']))))
+            info['bases'].append(base)
+    return info
+
+def generate_vcf_row_numpy(mpileupcol, refseq, minbq, maxd, mind=10, minth=0.8, biasth=50, bias=10):
+    '''
+    Numpy engine version of generate_vcf_row
+
+    Instead of going through base_stats, bias_hq and mark_lq, the column is converted into
+    quality histograms(see ColumnStats) once and all statistics are computed from those.
+    mpileupcol may also be a ColumnStats.
+    The returned record is identical to the one generate_vcf_row would return.
+
+    All parameters are identical to generate_vcf_row
+
+    @returns a VcfRow
+    '''
+    start = mpileupcol.pos
+    rb = refseq[start-1].upper()
+
+    stats = pile_stats_hist(ColumnStats.from_column(mpileupcol), rb, minbq, mind, biasth, bias)
+
+    info = {}
+    alt_info = info_stats_numpy(stats, rb)
+    alt_bases = alt_info['bases']
+    if alt_bases != []:
+        info['AC'] = alt_info['AC']
+        info['AAQ'] = alt_info['AAQ']
+        info['PAC'] = alt_info['PAC']
+
+    info['DP'] = stats['depth']
+    if rb in stats:
+        count, qualsum = stats[rb]
+        info['RC'] = count
+        info['RAQ'] = int(round(qualsum / float(count), 0))
+        info['PRC'] = int(round((100.0 * count) / float(stats['depth']), 0))
+    else:
+        info['RC'] = 0
+        info['RAQ'] = 0
+        info['PRC'] = 0
+
+    cb, cbd = caller_numpy(stats, minth)
+    # Re-evaluate an N call if gaps are involved
+    if '*' in stats and cb == 'N':
+        cb, cbd = caller_numpy(stats, 0.51)
+
+    info['CB'] = cb
+    info['CBD'] = cbd
+
+    if not alt_bases:
+        alt_bases = '.'
+
+    return VcfRow(mpileupcol.ref, start, rb, alt_bases, info)
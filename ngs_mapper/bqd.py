@@ -8,6 +8,7 @@ from collections import namedtuple
 from itertools import izip
 
 from matplotlib.lines import Line2D
+import numpy as np
 
 import log
 import samtools
@@ -36,14 +37,14 @@ def parse_pileup( pileup ):
         - avgquals - average quality at each base position
         - length - length of assembly
 
-    @pileup - file like object that returns lines from samtools mpileup
+    @pileup - file like object that returns lines from samtools mpileup or MPileupColumn objects
 
     @returns dictionary {'ref1': {maxd:0,mind:0,maxq:0,minq:0,depths:[],avgquals:[],length:0}, 'ref2':...}
     '''
     refs = {}
     lastpos = {}
     for line in pileup:
-        mcol = samtools.MPileupColumn(line)
+        mcol = samtools.pileup_column(line)
 
         # Initialize new reference
         if mcol.ref not in refs:
@@ -71,6 +72,104 @@ def parse_pileup( pileup ):
 
     return refs
 
+class QualDepth(object):
+    '''
+    Pileup consumer that builds the same statistics as parse_pileup one column at a time
+    so it can share a single pileup pass with other consumers(see samtools.fan_out)
+
+    Columns should come from an unfiltered pileup(minmq=0, minbq=0). Reads below minmq
+    and bases below minbq are removed from every column here so that qualdepth returns
+    exactly what parse_pileup( samtools.nogap_mpileup( bamfile, minmq=minmq, minbq=minbq ) )
+    would. That means a column only counts if at least one read in it passes minmq and
+    positions before the last counted column of a reference are filled in with 0 depth.
+
+    QualDepth objects built from consecutive regions can be combined with update
+
+    @param minmq - Minimum mapping quality of reads to include
+    @param minbq - Minimum base quality of bases to include
+    '''
+    def __init__( self, minmq=20, minbq=25 ):
+        self.minmq = minmq
+        self.minbq = minbq
+        # refname -> {'positions':[], 'depths':[], 'avgquals':[], 'maxq':, 'minq':}
+        self.refs = {}
+
+    def _ref( self, refname ):
+        if refname not in self.refs:
+            self.refs[refname] = {
+                'positions': [],
+                'depths': [],
+                'avgquals': [],
+                'maxq': 0,
+                'minq': 1000
+            }
+        return self.refs[refname]
+
+    def add( self, col ):
+        '''
+        Add a single pileup column
+
+        @param col - MPileupColumn
+        '''
+        bquals = col.bqual_array
+        mquals = np.array( col.mquals, dtype=np.int64 )
+        keep = bquals >= self.minbq
+        if len(mquals) == len(bquals):
+            mapped = mquals >= self.minmq
+            # samtools mpileup -q drops the read entirely so the column is not output
+            if not mapped.any():
+                return
+            keep &= mapped
+        bquals = bquals[keep]
+        ref = self._ref( col.ref )
+        ref['positions'].append( col.pos )
+        ref['depths'].append( len(bquals) )
+        if len(bquals):
+            ref['avgquals'].append( round( np.mean( bquals ), 2 ) )
+            ref['maxq'] = max( ref['maxq'], int(bquals.max()) )
+            ref['minq'] = min( ref['minq'], int(bquals.min()) )
+        else:
+            ref['avgquals'].append( float('nan') )
+
+    def update( self, other ):
+        '''
+        Append the columns from another QualDepth that was built from positions
+        after the positions in this one
+
+        @param other - QualDepth
+        '''
+        for refname, theirs in other.refs.iteritems():
+            ours = self._ref( refname )
+            for key in ('positions', 'depths', 'avgquals'):
+                ours[key].extend( theirs[key] )
+            ours['maxq'] = max( ours['maxq'], theirs['maxq'] )
+            ours['minq'] = min( ours['minq'], theirs['minq'] )
+
+    def qualdepth( self ):
+        '''
+        @returns the same dictionary as parse_pileup
+        '''
+        refs = {}
+        for refname, ref in self.refs.iteritems():
+            if not ref['positions']:
+                continue
+            length = ref['positions'][-1]
+            depths = [0] * length
+            avgquals = [float('nan')] * length
+            for pos, depth, avgqual in izip( ref['positions'], ref['depths'], ref['avgquals'] ):
+                depths[pos-1] = depth
+                avgquals[pos-1] = avgqual
+            refs[refname] = {
+                'maxd': max(depths),
+                'mind': min(depths),
+                'maxq': ref['maxq'],
+                'minq': ref['minq'],
+                'depths': depths,
+                'avgquals': avgquals,
+                'length': length
+            }
+        return refs
+
 # Named tuple to store each region in
 CoverageRegion = namedtuple('CoverageRegion', ['start','end','type'])
 
@@ -6,6 +6,9 @@ import re
 import log
 from Bio import SeqIO
 import gzip
+import signal
+import subprocess
+from distutils.spawn import find_executable
 
 logger = log.setup_logger(__name__, log.get_config())
 
@@ -161,16 +164,85 @@ def file_handle(filepath):
     else:
         return (open(filepath, 'rb'), ext[1:])
 
+def open_reads(filepath, threads=2):
+    '''
+    Open a read file to stream through all of its reads
+
+    .gz(and bgzip) files are decompressed as they are read instead of being
+    unpacked first. When pigz is installed it decompresses them in its own
+    process using threads threads, otherwise gzip.open is used
+
+    :param str filepath: path to read file
+    :param int threads: how many threads pigz can use
+    :return: opened filelike object
+    '''
+    if not filepath.endswith('.gz'):
+        return open(filepath, 'rb')
+    pigz = find_executable('pigz')
+    if pigz is None:
+        return gzip.open(filepath, 'rb')
+    return PigzFile(pigz, filepath, threads)
+
+def _restore_sigpipe():
+    '''
+    Python ignores SIGPIPE and child processes inherit that so put back the
+    default action before pigz starts
+    '''
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+class PigzFile(object):
+    '''
+    Read only file object for the decompressed contents of a gzip file that
+    pigz decompresses in the background
+    '''
+    def __init__(self, pigz, filepath, threads=2):
+        self.name = filepath
+        self.proc = subprocess.Popen(
+            [pigz, '-dc', '-p', str(threads), filepath],
+            stdout=subprocess.PIPE, bufsize=-1, preexec_fn=_restore_sigpipe
+        )
+        self.fh = self.proc.stdout
+
+    def __getattr__(self, attr):
+        return getattr(self.fh, attr)
+
+    def __iter__(self):
+        return iter(self.fh)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''
+        Close the output and wait for pigz
+
+        :raises: IOError if pigz could not decompress the file
+        '''
+        if self.proc.returncode is not None:
+            return
+        self.fh.close()
+        # Closing before the end kills pigz with SIGPIPE(negative returncode)
+        # which is not an error
+        if self.proc.wait() > 0:
+            raise IOError("pigz could not decompress {0}".format(self.name))
+
 def is_sanger_readfile( filepath ):
     '''
     Inspect the top read in the file and see if the quality encoding
     max > 40
     '''
-    if not filepath.endswith( '.fastq' ):
+    if not filepath.endswith( ('.fastq', '.fastq.gz') ):
         return False
 
-    reads = SeqIO.parse( filepath, 'fastq' )
-    r1 = next( reads )._per_letter_annotations['phred_quality']
+    fh, ext = file_handle(filepath)
+    try:
+        reads = SeqIO.parse( fh, 'fastq' )
+        r1 = next( reads )._per_letter_annotations['phred_quality']
+    finally:
+        fh.close()
 
     return max(r1) > 40
 
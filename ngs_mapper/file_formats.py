@@ -3,6 +3,7 @@ import os, sys
 from functools import partial
 from glob import glob
 import gzip
+import shutil
 from Bio import SeqIO
 from . import log
 
@@ -41,18 +42,30 @@ def convert_ab1(dir, outdir):
         SeqIO.convert(abi, 'abi', dest, 'fastq')
 
 def convert_gzips(dir, outdir):
+    '''
+    Unpack compressed read files that are not fastq. Compressed fastq files are
+    linked by link_fastqs and read compressed by the rest of the pipeline
+    '''
     for gz in find_ext('gz')(dir):
+        if gz.endswith('.fastq.gz'):
+            continue
         dest = swap_dir(outdir)(drop_ext(gz))
         with gzip.open( gz, 'rb' ) as input:
-            with open(dest, 'w') as output:
+            with open(dest, 'wb') as output:
                 logger.info('Unpacking {0} to {1}'.format(gz, dest))
-                output.write(input.read())
+                shutil.copyfileobj(input, output, 1<<20)
+
 def link_fastqs(dir, outdir): 
-    for fq in find_ext('fastq')(dir):
+    for fq in find_ext('fastq')(dir) + find_ext('fastq.gz')(dir):
         dest = swap_dir(outdir)(fq)
         src = os.path.abspath(fq)
         dst = os.path.abspath(dest)
-        if os.path.exists(dst):
+        if fq.endswith('.gz') and os.path.exists(drop_ext(fq)):
+            logger.warning(
+                'Skipping symlink of {0} because {1} is the same file ' \
+                'uncompressed'.format(src, drop_ext(fq))
+            )
+        elif os.path.exists(dst):
             logger.warning(
                 'Skipping symlink of {0} because {1} already exists.' \
                 'This can happen if you have the file compressed and also not ' \
@@ -2,13 +2,15 @@ import argparse
 from collections import defaultdict
 import sys
 from Bio.SeqIO import parse
+from ngs_mapper.data import open_reads
 import matplotlib.pyplot as plt
 from os.path import *
 import numpy as np
 
 def main():
     args = parse_args()
-    fqs = [(basename(fq),parse( fq, 'fastq' )) for fq in args.fastqs]
+    # .fastq.gz files are decompressed while they are parsed
+    fqs = [(basename(fq),parse( open_reads(fq), 'fastq' )) for fq in args.fastqs]
     plot_fqs( fqs, args.output )
 
 def plot_fqs( iterable, out ):
@@ -47,7 +49,7 @@ def plot_fqs( iterable, out ):
         rlb, aqb, mlen, mqual, mreads, mquals = stats[i]
         # Plot the read length first on left
         plt.subplot( nrows, 2, plotn )
-        tname = fqname.replace('.fastq', '' )
+        tname = fqname.replace('.gz', '').replace('.fastq', '' )
         plot( plt.gca(), tname + ' ' + 'Read Length', 'Read Length', rlb, maxl, maxreads )
         # Plot the avg qual on right
         plt.subplot( nrows, 2, plotn+1 )
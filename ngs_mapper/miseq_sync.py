@@ -84,18 +84,18 @@ and your miseq run name is::
 
         /home/NGSData/ReadData/140101_M00001_0001_000000000-AAAAA
 
-#. Then it unpacks each fastq.gz file into that directory so there are only .fastq files and appends the run date to them before the .fastq
+#. Then it copies each fastq.gz file into that directory(they stay compressed as the pipeline reads .fastq.gz directly) and appends the run date to them before the .fastq.gz
 
     So in the previous example the two file names would become::
 
-        SAMPLENAME1_S1_L001_R1_001_2014_01_01.fastq
-        SAMPLENAME1_S1_L001_R2_001_2014_01_01.fastq
+        SAMPLENAME1_S1_L001_R1_001_2014_01_01.fastq.gz
+        SAMPLENAME1_S1_L001_R2_001_2014_01_01.fastq.gz
 
     and be placed inside of::
 
         /home/NGSData/ReadData/140101_M00001_0001_000000000-AAAAA
 
-#. Once the files are unpacked it uses the <sample name> field in the each of the file names to determine the final samplename to use
+#. Once the files are copied it uses the <sample name> field in the each of the file names to determine the final samplename to use
 
         Aka::
 
@@ -107,12 +107,12 @@ and your miseq run name is::
             
             /home/NGSData/ReadsBySample/SAMPLENAME1
 
-#. It then creates a symlink with the same name as the file in the ReadData/MiSeq/<rundirectory> inside of the appropriate ReadsBySample/<samplename> that links back to the .fastq file
+#. It then creates a symlink with the same name as the file in the ReadData/MiSeq/<rundirectory> inside of the appropriate ReadsBySample/<samplename> that links back to the .fastq.gz file
 
     The symlinks would come out as follows::
 
-        SAMPLENAME1_S1_L001_R1_001_2014_01_01.fastq -> ../../ReadData/MiSeq/140101_M00001_0001_000000000-AAAAA/SAMPLE1_S01_L001_R1_001_2014_01_01.fastq
-        SAMPLENAME1_S1_L001_R2_001_2014_01_01.fastq -> ../../ReadData/MiSeq/140101_M00001_0001_000000000-AAAAA/SAMPLE1_S01_L001_R2_001_2014_01_01.fastq
+        SAMPLENAME1_S1_L001_R1_001_2014_01_01.fastq.gz -> ../../ReadData/MiSeq/140101_M00001_0001_000000000-AAAAA/SAMPLE1_S01_L001_R1_001_2014_01_01.fastq.gz
+        SAMPLENAME1_S1_L001_R2_001_2014_01_01.fastq.gz -> ../../ReadData/MiSeq/140101_M00001_0001_000000000-AAAAA/SAMPLE1_S01_L001_R2_001_2014_01_01.fastq.gz
         
 #. Once all ReadsBySample directories and files are symlinked it finishes syncing the rest of the miseq run directory
 
@@ -127,7 +127,6 @@ import shlex
 import shutil
 from glob import glob
 from datetime import datetime
-import gzip
 import csv
 from ngs_mapper import compat
 
@@ -234,8 +233,9 @@ def rsync_run( rundir, ngsdata ):
 
 def create_readdata( rundir, ngsdata ):
     '''
-        Uncompress fastq files from rundir into basename(rundir)'s ReadData
+        Copy fastq.gz files from rundir into basename(rundir)'s ReadData
         and add date to the end
+        They are not uncompressed as the pipeline reads them compressed
     '''
     fqpath = get_basecalls_dir( rundir )
     dstroot = join( ngsdata, 'ReadData', 'MiSeq', basename( rundir ) )
@@ -243,16 +243,16 @@ def create_readdata( rundir, ngsdata ):
     if not exists( dstroot ):
         os.makedirs( dstroot )
     for gz in glob( join( fqpath, '*.fastq.gz' ) ):
-        dstfq = join( dstroot, basename( gz ).replace( '.fastq.gz', '_{0}.fastq'.format( rundate ) ) )
-        if not exists( dstfq ):
-            logger.info( 'Unpacking {0} to {1}'.format(gz, dstfq) )
-            fr = gzip.open( gz, 'rb' )
-            fw = open( dstfq, 'w' )
-            fw.write( fr.read() )
-            fw.close()
-            fr.close()
+        dstfq = join( dstroot, basename( gz ).replace( '.fastq.gz', '_{0}.fastq.gz'.format( rundate ) ) )
+        # Runs synced before reads were kept compressed have them unpacked
+        unpacked = dstfq[:-3]
+        if exists( unpacked ):
+            logger.debug( '{0} looks to be unpacked already as {1}'.format(gz, unpacked) )
+        elif not exists( dstfq ):
+            logger.info( 'Copying {0} to {1}'.format(gz, dstfq) )
+            shutil.copyfile( gz, dstfq )
         else:
-            logger.debug( '{0} looks to be unpacked already as {1}'.format(gz, dstfq) )
+            logger.debug( '{0} looks to be copied already as {1}'.format(gz, dstfq) )
 
 def link_reads( rundir, ngsdata ):
     '''
@@ -260,7 +260,7 @@ def link_reads( rundir, ngsdata ):
     '''
     readdata = join( ngsdata, 'ReadData', 'MiSeq', basename( rundir ) )
     readsbysample = join( ngsdata, 'ReadsBySample' )
-    for fq in glob( join( readdata, '*.fastq' ) ):
+    for fq in glob( join( readdata, '*.fastq' ) ) + glob( join( readdata, '*.fastq.gz' ) ):
         samplename = samplename_from_fq( fq )
         # Ensure sampledir
         sampledir = join( readsbysample, samplename )
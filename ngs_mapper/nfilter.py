@@ -4,7 +4,7 @@ Usage: ngs_filter <readdir> [--threads=<threads>]  [--drop-ns ] [--index-min=<in
 Options:
     --outdir=<DIR>,-o=<DIR>   outupt directory [Default: filtered]
     --config=<CONFIG>,-c=<CONFIG>  Derive options from provided YAML file instead of commandline
-    --threads=<threads>            Number of files to filter in parallel. [Default: 1]
+    --threads=<threads>            Number of read file chunks to filter in parallel. [Default: 1]
     --platforms=<PLATFORMS>   Only accept reads from specified machines. Choices: 'Roche454','IonTorrent','MiSeq', 'Sanger', 'All', [Default: All]
 
 Help:
@@ -15,15 +15,17 @@ Help:
 from functools import partial
 import multiprocessing
 from operator import methodcaller
-from Bio import SeqIO
 from docopt import docopt
 from schema import Schema, Use, Optional, Or
-from itertools import ifilterfalse, izip, chain, izip_longest
+from itertools import ifilterfalse, izip, chain, izip_longest, islice, imap
+import numpy as np
 import re
 import os
 import sys
+import shutil
 import warnings
-from data import reads_by_plat
+from cStringIO import StringIO
+from data import reads_by_plat, open_reads
 from ngs_mapper.config import load_config
 import log
 logger = log.setup_logger(__name__, log.get_config())
@@ -31,6 +33,8 @@ logger = log.setup_logger(__name__, log.get_config())
 ALLPLATFORMS = 'Roche454','IonTorrent','MiSeq', 'Sanger'
 #TODO: should guarantee that there is an index file or allow there not to be one
 STATSFILE_NAME='ngs_filter_stats.txt'
+CHUNK_SIZE = 64 * 1024 * 1024
+''' read files bigger than this many bytes are split into chunks of about this size that are filtered in parallel '''
 stat_header = '''ngs_filter found {0} reads in file {1}, and filtered out {2} reads.'''
 stat_body = '''In file {0}, {1} reads were filtered for poor quality index below {2}. {3} reads had Ns and were filtered.'''
 
@@ -40,12 +44,15 @@ stat_body = '''In file {0}, {1} reads were filtered for poor quality index below
 
 get_index = partial(re.sub, r'_R([12])_', r'_I\1_')
 
-is_fastq = methodcaller('endswith', ('fq', 'fastq'))
+is_fastq = methodcaller('endswith', ('fq', 'fastq', 'fq.gz', 'fastq.gz'))
 def name_filtered(path, outdir):
-    ''' rename with 'fitered.' prefix and inside the new path directory. '''
+    ''' rename with 'fitered.' prefix and inside the new path directory.
+    filtered reads are written uncompressed so a .gz extension is dropped. '''
     #rename = "filtered.{0}".format
     dirpath, filename = os.path.split(path)
     #renamed = rename(filename)
+    if filename.endswith('.gz'):
+        filename = filename[:-3]
     renamed = filename[:-3] + 'fastq' if filename.endswith('sff') else filename
     return os.path.join(outdir, renamed)
 
@@ -71,9 +78,10 @@ def flatten(container):
                 yield j
         else:
             yield i
-def map_to_dir(readsdir, idxQualMin, dropNs, platforms, outdir, threads):
+def map_to_dir(readsdir, idxQualMin, dropNs, platforms, outdir, threads, chunksize=CHUNK_SIZE):
     '''maps *func* to all fastq/sff files which are not indexes.
-    fetch the fastqs and indexes of the directory and write the filtered results.'''
+    fetch the fastqs and indexes of the directory and write the filtered results.
+    files bigger than chunksize are filtered in chunks by threads processes.'''
     #no_index_fqs = fqs_excluding_indices(readsdir)
     plat_files_dict = reads_by_plat(readsdir)
     #_nested_files = map(plat_files_dict.get, platforms)
@@ -105,12 +113,21 @@ def map_to_dir(readsdir, idxQualMin, dropNs, platforms, outdir, threads):
     if not files:
         raise ValueError("No fastq or sff files found in directory %s" % readsdir + '\n' + msg)
     logger.debug(
-        "Using {0} threads to map filters over read files {1} in directory {2}"
+        "Using {0} threads to map filters over chunks of read files {1} in directory {2}"
         .format(threads, files, readsdir)
     )
-    func = partial(write_filtered, idxQualMin=idxQualMin, dropNs=dropNs, outdir=outdir)
+    # Every chunk of every file goes to the same pool so one big file does not leave the other threads idle
+    tasks, nchunks = [], []
+    for readpath in files:
+        chunks = file_chunks(readpath, chunksize) if idxQualMin or dropNs else []
+        outpath = name_filtered(readpath, outdir)
+        tasks += [(readpath, idxQualMin, dropNs, chunk, '%s.%d.part' % (outpath, i)) for i, chunk in enumerate(chunks)]
+        nchunks.append(len(chunks))
     pool = multiprocessing.Pool(threads)
-    outpaths = pool.map(func, files)
+    # imap keeps the chunks in order so each file is put back together as soon as its chunks are done
+    parts = pool.imap(filter_chunk, tasks)
+    outpaths = [write_filtered(readpath, idxQualMin, dropNs, outdir, list(islice(parts, n)))
+                for readpath, n in izip(files, nchunks)]
     pool.close()
     pool.join()
     return outpaths
@@ -118,76 +135,192 @@ def map_to_dir(readsdir, idxQualMin, dropNs, platforms, outdir, threads):
 def idx_filter(read, idxread, thresh):
     ''' AT or ABOVE threshold.'''
     return min(idxread._per_letter_annotations['phred_quality']) >= thresh
-formats={ 'sff' : 'sff', 'fq' : 'fastq', 'fastq' : 'fastq', 'fa' : 'fasta', 'fasta' : 'fasta' }
-extension = lambda s: s.split('.')[-1]
-compose = lambda f, g: lambda x: f(g(x))
-getformat = compose(formats.__getitem__, extension)
 
-def make_filtered(readpath, idxQualMin, dropNs):
-    ''' given a fastq file with an index, will filter on low-quality index entries, and drop all reads with N.
-    If file does not have an index, only drops Ns.
-    Raises an AssertionError if the index-quality filter drops all reads. '''
+
+def fastq_records(fh, batchsize):
+    ''' yield lists of up to batchsize (title, seq, qual) tuples from the 4 line fastq records in fh.
+    The lines are only split apart, not parsed into SeqRecords. Line endings and the + line are dropped. '''
+    lines = izip(fh, fh, fh, fh)
+    while True:
+        batch = list(islice(lines, batchsize))
+        if not batch:
+            return
+        records = []
+        for title, seq, plus, qual in batch:
+            if title[0] != '@' or plus[0] != '+':
+                raise ValueError("Invalid fastq record %s in %s. Only 4 line fastq records are supported" % (title.rstrip(), getattr(fh, 'name', fh)))
+            records.append((title.rstrip(), seq.rstrip(), qual.rstrip()))
+        yield records
+
+def reduce_lines(ufunc, lines, empty, transform=None):
+    ''' reduce the bytes of every string in lines with ufunc in one vectorized pass over all of them.
+    transform is applied to the bytes first. Empty strings reduce to empty. '''
+    lengths = np.fromiter(imap(len, lines), dtype=np.int64, count=len(lines))
+    result = np.empty(len(lines), dtype=np.array(empty).dtype)
+    result.fill(empty)
+    notempty = lengths > 0
+    if notempty.any():
+        values = np.frombuffer(''.join(lines), dtype=np.uint8)
+        if transform is not None:
+            values = transform(values)
+        starts = np.cumsum(lengths) - lengths
+        result[notempty] = ufunc.reduceat(values, starts[notempty])
+    return result
+
+is_n = lambda bases: (bases == ord('N')) | (bases == ord('n'))
+
+def record_offsets(path, every, blocksize=1<<22):
+    ''' byte offsets of records 0, every, 2*every... of the 4 line fastq file path followed by the size of path '''
+    offsets = [0]
+    pos = 0
+    # lines left until the next offset
+    want = 4 * every
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), ''):
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+            # the newlines that end the line before each offset
+            ends = newlines[want - 1::4 * every]
+            offsets.extend(int(pos + end + 1) for end in ends)
+            if len(ends):
+                want = 4 * every - (len(newlines) - want - (len(ends) - 1) * 4 * every)
+            else:
+                want -= len(newlines)
+            pos += len(block)
+    if offsets[-1] != pos:
+        offsets.append(pos)
+    return offsets
+
+def file_chunks(readpath, chunksize=CHUNK_SIZE):
+    ''' split readpath and its index file into chunks of about chunksize bytes that can be filtered on their own.
+    Both files are split at the same record numbers so their reads stay in lockstep.
+    Returns a list of (readrange, indexrange) (start, end) byte ranges. indexrange is None if the index has
+    no reads for the chunk. Files no bigger than chunksize and .gz files, which cannot be split, are one None chunk. '''
     index = has_index(readpath)
-    if idxQualMin and not index:
-        sys.stderr.write("Specified Non-null index quality minimum, but index for file {0} does not exist.\n".format(readpath))
-    #NOTE: this will fail if the reads have an index stored in a different format (ie reads in FASTA, index in FASTQ) but that should never happen
-    format = getformat(readpath)
-    # right now this silently skips
-    fq_open = partial(SeqIO.parse, format=format)
-    def filterReads(readsWithMaybeIndex):
-        total = badIndex = hadNCount = 0
-        read, idxRead = None, None
-        for read, idxRead in readsWithMaybeIndex:
-            indexIsBad = False
-            if idxRead:
-                indexIsBad = min(idxRead._per_letter_annotations['phred_quality']) < idxQualMin
-                badIndex += int(indexIsBad)
-            hasN = False
-            if dropNs:
-                hasN = 'N' in str(read.seq).upper()
-                hadNCount += int(hasN)
-            dropRead = hasN or indexIsBad
-            total += 1
-            if dropRead:
-                read = None
-            yield (total, badIndex, hadNCount, read)
+    if readpath.endswith('.gz') or (index and index.endswith('.gz')) or os.path.getsize(readpath) <= chunksize:
+        return [None]
+    # Estimate how many records make up chunksize bytes from the start of the file
+    with open(readpath, 'rb') as fh:
+        sample = fh.read(1<<20)
+    every = max(1, int(chunksize * sample.count('\n') / (4.0 * len(sample))))
+    byte_ranges = lambda offsets: zip(offsets[:-1], offsets[1:])
+    readranges = byte_ranges(record_offsets(readpath, every))
+    indexranges = byte_ranges(record_offsets(index, every)) if index else []
+    # Index chunks without reads are dropped
+    return [(r, i) for r, i in izip_longest(readranges, indexranges) if r is not None]
+
+def read_range(path, byterange):
+    ''' file like object with the bytes from start to end of byterange(start, end) in path '''
+    start, end = byterange
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        return StringIO(fh.read(end - start))
+
+def indexed_batches(readpath, batchsize=10000, chunk=None):
+    ''' yield (batch, idxBatch) fastq_records batches of readpath and the matching batches of its index file.
+    idxBatch is None once the index runs out or if there is no index. Only the reads in chunk are read if a
+    file_chunks chunk is given. '''
+    if chunk is None:
+        index = has_index(readpath)
+        # .gz files are decompressed while they are read
+        handles = [open_reads(readpath)] + ([open_reads(index)] if index else [])
+    else:
+        readrange, indexrange = chunk
+        handles = [read_range(readpath, readrange)] + ([read_range(has_index(readpath), indexrange)] if indexrange else [])
     try:
-        indexReads = [] if not index else fq_open(index)
-        reads = fq_open(readpath)
-    except AssertionError, E:
-        logger.debug("skipping biopython assertion error in file %s " % readpath)
-    readsWithMaybeIndex = izip_longest(reads, indexReads, fillvalue=None)
-    return filterReads(readsWithMaybeIndex)
-
-def write_filtered(readpath, idxQualMin, dropNs, outdir='.'):
+        readBatches = fastq_records(handles[0], batchsize)
+        indexBatches = [] if len(handles) == 1 else fastq_records(handles[1], batchsize)
+        for batch, idxBatch in izip_longest(readBatches, indexBatches, fillvalue=None):
+            if batch is None:
+                # Index reads without reads are ignored
+                break
+            yield batch, idxBatch
+    finally:
+        for fh in handles:
+            fh.close()
+
+def filter_batch(batch, idxBatch, idxQualMin, dropNs):
+    ''' find the reads of a batch that have a low quality index or an N all at once.
+    Returns (drop, badIndex, hadNCount) where drop is a bool array of the reads to drop. '''
+    drop = np.zeros(len(batch), dtype=bool)
+    badIndex = hadNCount = 0
+    if idxBatch and idxQualMin:
+        # An index file shorter than the reads does not filter the rest of the reads
+        idxquals = [qual for title, seq, qual in idxBatch[:len(batch)]]
+        indexIsBad = reduce_lines(np.minimum, idxquals, 255) < idxQualMin + 33
+        badIndex = int(indexIsBad.sum())
+        drop[:len(indexIsBad)] |= indexIsBad
+    if dropNs:
+        hasN = reduce_lines(np.logical_or, [seq for title, seq, qual in batch], False, is_n)
+        hadNCount = int(hasN.sum())
+        drop |= hasN
+    return drop, badIndex, hadNCount
+
+def make_filtered(readpath, idxQualMin, dropNs, batchsize=10000, chunk=None):
+    ''' given a fastq file with an index, will filter on low-quality index entries, and drop all reads with N.
+    If file does not have an index, only drops Ns.
+    Reads and index reads are read in lockstep batches of batchsize records and the index quality
+    minimums and Ns of a whole batch are found at once.
+    Only the reads in chunk are filtered if a file_chunks chunk is given.
+    Yields (total, badIndex, hadNCount, kept, text) for each batch where the counts are for the batch
+    and text is the fastq text of the kept reads of the batch. '''
+    for batch, idxBatch in indexed_batches(readpath, batchsize, chunk):
+        drop, badIndex, hadNCount = filter_batch(batch, idxBatch, idxQualMin, dropNs)
+        kept = [record for record, dropRead in izip(batch, drop) if not dropRead]
+        text = ''.join('%s\n%s\n+\n%s\n' % record for record in kept)
+        yield (len(batch), badIndex, hadNCount, len(kept), text)
+
+def filter_chunk(args):
+    ''' filter one file_chunks chunk of a read file into a part file.
+    args is (readpath, idxQualMin, dropNs, chunk, partpath) so it can be mapped over by a Pool.
+    Returns (total, badIndex, hadN, kept, partpath) for the chunk. '''
+    readpath, idxQualMin, dropNs, chunk, partpath = args
+    counts = (0, 0, 0, 0)
+    with open(partpath, 'w') as partfile:
+        for result in make_filtered(readpath, idxQualMin, dropNs, chunk=chunk):
+            counts = tuple(map(sum, zip(counts, result[:4])))
+            partfile.write(result[4])
+    return counts + (partpath,)
+
+def write_filtered(readpath, idxQualMin, dropNs, outdir='.', parts=None):
     '''write the results to the new directory.
+    parts are filter_chunk results for all chunks of readpath in order that are put together instead of filtering here.
     Also writes a stats file to outdir/ngs_filter_stats.txt, with basic information about how many reads were filtered.'''
-    results = make_filtered(readpath, idxQualMin, dropNs)
     outpath = name_filtered(readpath, outdir)
     if not idxQualMin and not dropNs:
+        if readpath.endswith('.gz'):
+            # Nothing is filtered so compressed reads stay compressed
+            outpath = os.path.join(outdir, os.path.basename(readpath))
         os.symlink(os.path.abspath(readpath), os.path.abspath(outpath))
         logger.warn("Index Quality was %s and dropNs was set to %s, so file %s was copied to %s without filtering" % (idxQualMin, dropNs, readpath, outpath))
         return outpath
-    try:
-        num_written = 0
-        with open(outpath, 'w') as outfile:
-            for total, badIndex, hadN, read in results:
-                if read:
-                    SeqIO.write(read, outfile, 'fastq')
-                    num_written += 1
-        logger.info("filtered reads from %s will be written to %s" % (readpath, outpath))
-        logger.info("%s reads left after filtering." % num_written)
-        if  num_written <= 0:
-            logger.warn("No reads left after filtering! Quality controls eliminated all reads. Drop-Ns was set to %s; maybe try again with lower quality min than %s. " %(dropNs, idxQualMin))
-            warnings.warn("No reads left after filtering! Quality controls eliminated all reads. Drop-Ns was set to %s; maybe try again with lower quality min than %s. " %(dropNs, idxQualMin))
-    except AssertionError, E:
-        logger.debug("skipping biopython assertion error")
-        #sys.stderr.write(str(E))
+    if idxQualMin and not has_index(readpath):
+        sys.stderr.write("Specified Non-null index quality minimum, but index for file {0} does not exist.\n".format(readpath))
+    total = badIndex = hadN = num_written = 0
+    with open(outpath, 'w') as outfile:
+        if parts is None:
+            for t, b, n, kept, text in make_filtered(readpath, idxQualMin, dropNs):
+                total, badIndex, hadN, num_written = total + t, badIndex + b, hadN + n, num_written + kept
+                outfile.write(text)
+        else:
+            for t, b, n, kept, partpath in parts:
+                total, badIndex, hadN, num_written = total + t, badIndex + b, hadN + n, num_written + kept
+                with open(partpath) as partfile:
+                    shutil.copyfileobj(partfile, outfile, 1<<20)
+                os.unlink(partpath)
+    logger.info("filtered reads from %s will be written to %s" % (readpath, outpath))
+    logger.info("%s reads left after filtering." % num_written)
+    if  num_written <= 0:
+        logger.warn("No reads left after filtering! Quality controls eliminated all reads. Drop-Ns was set to %s; maybe try again with lower quality min than %s. " %(dropNs, idxQualMin))
+        warnings.warn("No reads left after filtering! Quality controls eliminated all reads. Drop-Ns was set to %s; maybe try again with lower quality min than %s. " %(dropNs, idxQualMin))
+    write_stats(outdir, readpath, idxQualMin, total, badIndex, hadN)
+    return outpath
+
+def write_stats(outdir, readpath, idxQualMin, total, badIndex, hadN):
+    '''append the filter stats for readpath to outdir/ngs_filter_stats.txt'''
     msg = '\n'.join( [stat_header.format(total, readpath, badIndex + hadN),
                       stat_body.format(readpath, badIndex, idxQualMin, hadN) ])
     with open(os.path.join(outdir, STATSFILE_NAME), 'a') as statfile:
         statfile.write(msg)
-    return outpath
 
 def write_groups(paths, idxQualMin, dropNs, outdir):
      func = partial(write_filtered, idxQualMin=idxQualMin, dropNs=dropNs, outdir=outdir)
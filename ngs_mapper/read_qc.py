@@ -0,0 +1,373 @@
+"""
+Filters and trims reads in a single pass instead of running
+:py:mod:`ngs_mapper.nfilter` and then :py:mod:`ngs_mapper.trim_reads`
+
+Every read file(and its _I1_/_I2_ index file) is read once. Reads are dropped
+for a low quality index or Ns the same way ngs_filter drops them and then
+trimmed the same way as Trimmomatic's LEADING, TRAILING and HEADCROP steps(in
+that order) which are all trim_reads runs unless a primer file is given.
+Qualities are expected to be phred+33.
+
+Mate pairs are read together so a pair that loses one mate keeps the other
+as a non paired read. For each platform only the final read sets are written
+into the output directory::
+
+    <platform>_R1_.fastq
+    <platform>_R2_.fastq
+    <platform>.fastq
+
+which :py:mod:`ngs_mapper.run_bwa_on_samplename <ngs_mapper.run_bwa>` pairs
+and maps the same as the trim_reads output.
+
+If a primer file is given, Trimmomatic's ILLUMINACLIP is run over those files
+afterwards as it is not done here.
+
+The filter stats go into ngs_filter_stats.txt inside of the output directory
+and a summary of the trimming for each read file into trim_stats next to it.
+"""
+
+import argparse
+import os
+import sys
+import shutil
+import tempfile
+from os.path import basename, join, isdir, dirname
+from itertools import izip, izip_longest
+
+import data
+import reads
+import nfilter
+import trim_reads
+
+import log
+lconfig = log.get_config()
+logger = log.setup_logger( 'read_qc', lconfig )
+
+def main():
+    args = parse_args()
+    qc_reads_in_dir(
+        args.readsdir,
+        args.outputdir,
+        args.q,
+        head_crop=args.headcrop,
+        idx_qual_min=args.index_min,
+        drop_ns=args.drop_ns,
+        platforms=args.platforms,
+        primer_info=[args.primer_file, args.primer_seed, args.palindrom_clip, args.simple_clip]
+    )
+
+def qc_reads_in_dir( readdir, out_path, qual_th, **kwargs ):
+    '''
+        Filters and trims all read files in readdir into <platform>_R1_.fastq,
+        <platform>_R2_.fastq and <platform>.fastq inside of out_path
+
+        :param str readdir: Directory with read files in it(fastq, fastq.gz and sff)
+        :param str out_path: Output directory path
+        :param int qual_th: Quality threshold for leading and trailing trimming
+        :param int head_crop: How many bases to crop off the front after quality trimming
+        :param int idx_qual_min: Drop reads with an index quality below this
+        :param bool drop_ns: Drop reads that have an N
+        :param list platforms: List of platform's reads to use
+        :param list primer_info: [primer file, seed mismatches, palindrome clip, simple clip]
+        :returns: list of read files written
+    '''
+    headcrop = int( kwargs.get('head_crop', 0) )
+    idx_qual_min = kwargs.get('idx_qual_min')
+    drop_ns = kwargs.get('drop_ns', False)
+    platforms = kwargs.get('platforms', None)
+    primer_info = kwargs.get('primer_info')
+    logger.info(
+        "Only accepting the following platform's read files: {0}".format(
+            platforms
+        )
+    )
+
+    platreads = data.reads_by_plat( readdir )
+    if not isdir( out_path ):
+        os.mkdir( out_path )
+    stats_dir = join( dirname( out_path.rstrip('/') ), 'trim_stats' )
+    if not isdir( stats_dir ):
+        os.makedirs( stats_dir )
+
+    written = []
+    for plat, readfiles in platreads.iteritems():
+        if platforms is not None and plat not in platforms:
+            logger.info("{0} are being excluded as they are not in {1}".format(
+                readfiles,platforms
+            ))
+            continue
+        outpaths = [join(out_path, plat + ext) for ext in ('_R1_.fastq', '_R2_.fastq', '.fastq')]
+        outfiles = [open(p, 'w') for p in outpaths]
+        try:
+            for r in readfiles:
+                readpaths = [r] if isinstance(r, str) else sorted(r)
+                if '_I1_' in readpaths[0] or '_I2_' in readpaths[0]:
+                    logger.debug("Skipped MiSeq index read {0}".format(r))
+                    continue
+                # Sometimes there are .ab1 files
+                if not all( reads.is_valid_read( rp ) for rp in readpaths ):
+                    logger.debug("Skipped {0} as it is not a fastq or sff file".format(r))
+                    continue
+                logger.info("Filtering and trimming {0}".format(readpaths))
+                stats = qc_read_files(
+                    readpaths, outfiles, qual_th, headcrop, idx_qual_min, drop_ns
+                )
+                for readpath, counts in izip(readpaths, stats['filter']):
+                    nfilter.write_stats( out_path, readpath, idx_qual_min, *counts )
+                stats_file = join( stats_dir, basename(readpaths[0]) + '.trim_stats' )
+                with open( stats_file, 'w' ) as fh:
+                    fh.write( trim_summary( stats['trim'], len(readpaths) == 2 ) + '\n' )
+        finally:
+            for fh in outfiles:
+                fh.close()
+
+        if primer_info and primer_info[0]:
+            clip_primers( outpaths, primer_info )
+
+        # Empty read sets would only be skipped by the mapping
+        for p in outpaths:
+            if os.stat(p).st_size == 0:
+                os.unlink(p)
+            else:
+                written.append(p)
+    return written
+
+def qc_read_files( readpaths, outfiles, qual_th, headcrop=0, idx_qual_min=None, drop_ns=False, batchsize=10000 ):
+    '''
+        Filters and trims a read file or a pair of mate read files in one pass
+
+        :param list readpaths: One read file or the forward and reverse read files of a pair
+        :param list outfiles: Open forward, reverse and non paired fastq files to write to
+        :param int qual_th: Quality threshold for leading and trailing trimming
+        :param int headcrop: How many bases to crop off the front after quality trimming
+        :param int idx_qual_min: Drop reads with an index quality below this
+        :param bool drop_ns: Drop reads that have an N
+        :param int batchsize: How many reads to filter at once
+        :returns: {'filter': [(total, badIndex, hadN) for each readpath], 'trim': [input, both, forward only, reverse only, dropped]}
+    '''
+    low = ''.join( chr(33 + q) for q in range(int(qual_th)) )
+    tfiles = []
+    try:
+        sources = []
+        for readpath in readpaths:
+            if readpath.endswith('.sff'):
+                # sff is converted to fastq first the same way trim_reads does
+                _, tfile = tempfile.mkstemp(prefix='readqc', suffix='sff.fastq')
+                tfiles.append( tfile )
+                try:
+                    reads.sffs_to_fastq( [readpath], tfile, True )
+                except AssertionError as e:
+                    # Biopython issue #294
+                    pass
+                readpath = tfile
+            sources.append( nfilter.indexed_batches( readpath, batchsize ) )
+
+        filterstats = [[0, 0, 0] for r in readpaths]
+        # input, both surviving, forward only, reverse only, dropped
+        trimstats = [0, 0, 0, 0, 0]
+        F, R, NP = outfiles
+        for batches in izip_longest( *sources ):
+            if None in batches or len(set( len(b[0]) for b in batches )) != 1:
+                raise ValueError( "Mate files {0} do not have the same number of reads".format(readpaths) )
+            survivors = []
+            for counts, (batch, idxBatch) in izip( filterstats, batches ):
+                drop, badIndex, hadN = nfilter.filter_batch( batch, idxBatch, idx_qual_min, drop_ns )
+                counts[0] += len(batch)
+                counts[1] += badIndex
+                counts[2] += hadN
+                survivors.append( [
+                    None if dropRead else trim_record( record, low, headcrop )
+                    for record, dropRead in izip( batch, drop )
+                ] )
+            trimstats[0] += len(survivors[0])
+            if len(survivors) == 1:
+                kept = filter( None, survivors[0] )
+                NP.write( ''.join( kept ) )
+                trimstats[1] += len(kept)
+            else:
+                for fwd, rev in izip( *survivors ):
+                    if fwd and rev:
+                        F.write( fwd )
+                        R.write( rev )
+                        trimstats[1] += 1
+                    elif fwd:
+                        NP.write( fwd )
+                        trimstats[2] += 1
+                    elif rev:
+                        NP.write( rev )
+                        trimstats[3] += 1
+            trimstats[4] = trimstats[0] - sum( trimstats[1:4] )
+        return {'filter': filterstats, 'trim': trimstats}
+    finally:
+        for tfile in tfiles:
+            os.unlink( tfile )
+
+def quality_trim( qual, low, headcrop=0 ):
+    '''
+        Where Trimmomatic's LEADING, TRAILING and HEADCROP steps would cut a read
+
+        :param str qual: phred+33 quality string of the read
+        :param str low: All quality characters below the LEADING/TRAILING threshold
+        :param int headcrop: How many bases to crop off the front after quality trimming
+        :returns: (start, end) of the bases to keep. start >= end if nothing is left
+    '''
+    start = len(qual) - len(qual.lstrip(low))
+    end = len(qual.rstrip(low))
+    return start + headcrop, end
+
+def trim_record( record, low, headcrop=0 ):
+    '''
+        Trims a fastq_records record
+
+        :param tuple record: (title, seq, qual)
+        :param str low: All quality characters below the LEADING/TRAILING threshold
+        :param int headcrop: How many bases to crop off the front after quality trimming
+        :returns: fastq text of the trimmed read or None if nothing is left of it
+    '''
+    title, seq, qual = record
+    start, end = quality_trim( qual, low, headcrop )
+    if start >= end:
+        return None
+    return '%s\n%s\n+\n%s\n' % (title, seq[start:end], qual[start:end])
+
+def trim_summary( trimstats, paired ):
+    '''
+        Trimmomatic style summary of qc_read_files trim stats
+
+        :param list trimstats: qc_read_files trim stats
+        :param bool paired: If the stats are for a pair of read files
+    '''
+    total, both, fwd, rev, dropped = trimstats
+    pct = lambda n: 100.0 * n / total if total else 0.0
+    if paired:
+        return 'Input Read Pairs: {0} Both Surviving: {1} ({2:.2f}%) Forward Only Surviving: {3} ({4:.2f}%) ' \
+            'Reverse Only Surviving: {5} ({6:.2f}%) Dropped: {7} ({8:.2f}%)'.format(
+                total, both, pct(both), fwd, pct(fwd), rev, pct(rev), dropped, pct(dropped)
+        )
+    return 'Input Reads: {0} Surviving: {1} ({2:.2f}%) Dropped: {3} ({4:.2f}%)'.format(
+        total, both, pct(both), dropped, pct(dropped)
+    )
+
+def clip_primers( outpaths, primer_info ):
+    '''
+        Runs Trimmomatic's ILLUMINACLIP over the read sets qc_reads_in_dir wrote
+        Pairs that lose a mate have the other mate added to the non paired reads
+
+        :param list outpaths: forward, reverse and non paired read files
+        :param list primer_info: [primer file, seed mismatches, palindrome clip, simple clip]
+    '''
+    F, R, NP = outpaths
+    primer_info = [str(p) for p in primer_info]
+    if os.stat(F).st_size:
+        output = trim_reads.run_trimmomatic(
+            'PE', F, R, F + '.clip', F + '.unpaired', R + '.clip', R + '.unpaired',
+            threads=1, primer_info=primer_info
+        )
+        logger.info( output )
+        os.rename( F + '.clip', F )
+        os.rename( R + '.clip', R )
+        with open( NP, 'a' ) as fw:
+            for up in (F + '.unpaired', R + '.unpaired'):
+                with open( up ) as fr:
+                    shutil.copyfileobj( fr, fw )
+                os.unlink( up )
+    if os.stat(NP).st_size:
+        output = trim_reads.run_trimmomatic(
+            'SE', NP, NP + '.clip', threads=1, primer_info=primer_info
+        )
+        logger.info( output )
+        os.rename( NP + '.clip', NP )
+
+def parse_args( args=sys.argv[1:] ):
+    from ngs_mapper import config
+    conf_parser, args, config, configfile = config.get_config_argparse(args)
+    defaults = config['trim_reads']
+    filter_defaults = config['ngs_filter']
+
+    parser = argparse.ArgumentParser(
+        parents=[conf_parser],
+        description='Filters and trims reads in one pass'
+    )
+
+    parser.add_argument(
+        dest='readsdir',
+        help='Directory of read files'
+    )
+
+    parser.add_argument(
+        '-q',
+        dest='q',
+        type=int,
+        default=defaults['q']['default'],
+        help=defaults['q']['help']
+    )
+
+    parser.add_argument(
+        '--head-crop',
+        dest='headcrop',
+        type=int,
+        default=defaults['headcrop']['default'],
+        help=defaults['headcrop']['help']
+    )
+
+    parser.add_argument(
+        '-o',
+        dest='outputdir',
+        default=defaults['outputdir']['default'],
+        help=defaults['outputdir']['help']
+    )
+
+    parser.add_argument(
+        '--index-min',
+        dest='index_min',
+        type=int,
+        default=filter_defaults['indexQualityMin']['default'],
+        help=filter_defaults['indexQualityMin']['help']
+    )
+
+    parser.add_argument(
+        '--drop-ns',
+        dest='drop_ns',
+        action='store_true',
+        default=filter_defaults['dropNs']['default'],
+        help=filter_defaults['dropNs']['help']
+    )
+
+    parser.add_argument(
+        '--platforms',
+        dest='platforms',
+        nargs='+',
+        choices=defaults['platforms']['choices'],
+        default=defaults['platforms']['default'],
+        help=defaults['platforms']['help']
+    )
+
+    parser.add_argument(
+        '--primer-file',
+        dest='primer_file',
+        default=defaults['primerfile']['default'],
+        help=defaults['primerfile']['help']
+    )
+
+    parser.add_argument(
+        '--primer-seed',
+        dest='primer_seed',
+        default=defaults['primerseed']['default'],
+        help=defaults['primerseed']['help']
+    )
+
+    parser.add_argument(
+        '--palindrome-clip',
+        dest='palindrom_clip',
+        default=defaults['palindromeclip']['default'],
+        help=defaults['palindromeclip']['help']
+    )
+
+    parser.add_argument(
+        '--simple-clip',
+        dest='simple_clip',
+        default=defaults['simpleclip']['default'],
+        help=defaults['simpleclip']['help']
+    )
+
+    return parser.parse_args( args )
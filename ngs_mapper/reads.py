@@ -1,12 +1,15 @@
 import os
 from os.path import *
+import fcntl
+import threading
 from Bio import SeqIO
+from ngs_mapper.data import open_reads
 
 import logging
 log = logging.getLogger(__name__)
 
 # Valid Read extensions
-VALID_READ_EXT = ('sff','fastq')
+VALID_READ_EXT = ('sff','fastq','fastq.gz')
 
 def clip_seq_record( seqrecord ):
     '''
@@ -55,46 +58,57 @@ def sffs_to_fastq( sfflist, outfile, trim=True ):
 
 class InvalidReadFile(Exception): pass
 
-def compile_reads( readfilelist, outputdir ):
+def split_reads( readfilelist ):
     '''
-    Compiles all read files inside of readfilelist into respective files.
-    Creates F.fq, R.fq and/or NP.fq depending on the reads found in readfilelist
-    Only compiles fastq files. If others are given an exception will be raised
+    Sorts readfilelist into forward, reverse and non paired read files
 
     @param readfilelist - List of read file paths. If any of the items are a 2 item tuple, that item is treated as a
     mate pair read set and the first item will be the Forward read file and the second the Reverse read file.
 
-    @param outputdir - Where to output the three files
-
-    @returns a dictionary {'F': join(outputdir,'F.fq'), 'R': join(outputdir,'R.fq'), 'NP': join(outputdir,'NP.fq')}
-    If there were no mated files given then F & R will be None. Same goes for NP
+    @returns a dictionary {'F': [...], 'R': [...], 'NP': [...]}
     '''
-    from bwa.bwa import seqio
-    if not os.path.exists(outputdir):
-        os.makedirs(outputdir)
-
-    files_written = {'F':[],'R':[],'NP':[]}
+    files = {'F':[],'R':[],'NP':[]}
 
     # Build the list of files to be written for each type
     for read in readfilelist:
         # Non Paired read
         if isinstance(read,str):
             if is_valid_read( read ):
-                files_written['NP'].append(read)
+                files['NP'].append(read)
             else:
                 raise InvalidReadFile("{0} is not a fastq file. Only fastq files are supported at this time.".format(read))
         elif isinstance(read,tuple) and len(read) == 2:
             if is_valid_read( read[0] ):
-                files_written['F'].append(read[0])
+                files['F'].append(read[0])
             else:
                 raise InvalidReadFile("{0} is not a fastq file. Only fastq files are supported at this time.".format(read[0]))
             if is_valid_read( read[1] ):
-                files_written['R'].append(read[1])
+                files['R'].append(read[1])
             else:
                 raise InvalidReadFile("{0} is not a fastq file. Only fastq files are supported at this time.".format(read[1]))
         else:
             raise ValueError("Somehow neither got 1 or 2 items for a read in readfilelist")
+    return files
+
+def compile_reads( readfilelist, outputdir ):
+    '''
+    Compiles all read files inside of readfilelist into respective files.
+    Creates F.fq, R.fq and/or NP.fq depending on the reads found in readfilelist
+    Only compiles fastq(or .fastq.gz) and sff files. If others are given an exception will be raised
 
+    @param readfilelist - List of read file paths. If any of the items are a 2 item tuple, that item is treated as a
+    mate pair read set and the first item will be the Forward read file and the second the Reverse read file.
+
+    @param outputdir - Where to output the three files
+
+    @returns a dictionary {'F': join(outputdir,'F.fq'), 'R': join(outputdir,'R.fq'), 'NP': join(outputdir,'NP.fq')}
+    If there were no mated files given then F & R will be None. Same goes for NP
+    '''
+    from bwa.bwa import seqio
+    if not os.path.exists(outputdir):
+        os.makedirs(outputdir)
+
+    files_written = split_reads( readfilelist )
     # Now concat the files to their respective output file
     for f,files in files_written.items():
         if files:
@@ -126,7 +140,14 @@ def compile_reads( readfilelist, outputdir ):
 
             # concat everything together now
             log.debug( "Concating all files {0} to {1}".format(cfiles,outfile) )
-            seqio.concat_files(cfiles, outfile)
+            if any( r.endswith('.gz') for r in cfiles ):
+                # Decompressed while they are concatenated so the order of
+                # paired files still lines up
+                with open( outfile, 'wb' ) as fh:
+                    for r in cfiles:
+                        write_reads( r, fh )
+            else:
+                seqio.concat_files(cfiles, outfile)
             # Remove the sff concatted file
             if sffs:
                 os.unlink( sff_out )
@@ -138,13 +159,134 @@ def compile_reads( readfilelist, outputdir ):
 
     return files_written
 
+def stream_reads( readfilelist, outputdir ):
+    '''
+    Same as compile_reads except that F.fq, R.fq and NP.fq are named pipes that
+    a ReadStream writes the reads into while they are being read. No compiled copy
+    of the reads is written to disk, but each pipe can only be read once.
+
+    @param readfilelist - Same as compile_reads
+    @param outputdir - Where to create the named pipes
+
+    @returns tuple(files, streams) where files is the same as compile_reads output and
+    streams is {'F': ReadStream, 'R': ReadStream, 'NP': ReadStream} with None in place of
+    missing files
+    '''
+    if not os.path.exists(outputdir):
+        os.makedirs(outputdir)
+
+    files = split_reads( readfilelist )
+    streams = {}
+    for f, readfiles in files.items():
+        if readfiles:
+            fifo = join(outputdir,f+'.fq')
+            log.info( "Streaming reads from {0} through {1}".format( readfiles, fifo ) )
+            streams[f] = ReadStream( readfiles, fifo )
+            streams[f].start()
+            files[f] = fifo
+        else:
+            streams[f] = None
+            files[f] = None
+    return files, streams
+
+def write_reads( readfile, fh, blocksize=1<<20 ):
+    '''
+    Writes the reads from readfile to fh as fastq
+    sff files are converted(and trimmed) and gzip files are decompressed
+
+    @param readfile - Path to read file
+    @param fh - File object to write to
+    @param blocksize - How much of readfile to copy at a time
+
+    @returns number of reads written
+    '''
+    if readfile.endswith('.sff'):
+        count = 0
+        try:
+            for rec in SeqIO.parse( readfile, 'sff' ):
+                count += SeqIO.write( clip_seq_record( rec ), fh, 'fastq' )
+        except AssertionError as e:
+            # Same Biopython issue #294 that compile_reads skips
+            pass
+        return count
+
+    rfh = open_reads( readfile )
+    lines = 0
+    block = ''
+    with rfh:
+        for block in iter( lambda: rfh.read( blocksize ), '' ):
+            lines += block.count('\n')
+            fh.write( block )
+    # Make sure the next file starts on its own line
+    if block and not block.endswith('\n'):
+        fh.write('\n')
+        lines += 1
+    # Fastq records are 4 lines each
+    return lines // 4
+
+class ReadStream(threading.Thread):
+    '''
+    Writes the reads of a list of read files into a named pipe in the background
+    so whatever opens the pipe gets the concatenated reads without them
+    being written to disk first
+    '''
+    def __init__( self, readfiles, fifo ):
+        '''
+        Creates the named pipe. Call start to begin writing into it
+
+        @param readfiles - List of read file paths
+        @param fifo - Path of named pipe to create
+        '''
+        super(ReadStream, self).__init__()
+        # Nothing may ever open the pipe so never keep the interpreter alive
+        self.daemon = True
+        self.readfiles = readfiles
+        self.fifo = fifo
+        # Size of the read files for splitting work
+        self.size = sum( getsize( f ) for f in readfiles )
+        # Number of reads written so far
+        self.count = 0
+        self.error = None
+        os.mkfifo( fifo )
+
+    def run( self ):
+        try:
+            fd = os.open( self.fifo, os.O_WRONLY | getattr( os, 'O_CLOEXEC', 0 ) )
+            # Processes started while the pipe is open must not inherit it or
+            # the reader would never see the end of the reads
+            fcntl.fcntl( fd, fcntl.F_SETFD, fcntl.fcntl( fd, fcntl.F_GETFD ) | fcntl.FD_CLOEXEC )
+            with os.fdopen( fd, 'wb' ) as fh:
+                for readfile in self.readfiles:
+                    self.count += write_reads( readfile, fh )
+        except (IOError, OSError, ValueError) as e:
+            self.error = e
+
+    def finish( self ):
+        '''
+        Waits for all reads to be written. Call it once the reader of the pipe is done.
+        If the reader never opened the pipe the writer is released instead of
+        waiting forever
+
+        @returns number of reads written
+        @raises the error the writer ran into if any
+        '''
+        while self.is_alive():
+            try:
+                # Opening the read end lets a blocked writer through to fail with EPIPE
+                os.close( os.open( self.fifo, os.O_RDONLY | os.O_NONBLOCK ) )
+            except OSError:
+                pass
+            self.join( 0.1 )
+        if self.error is not None:
+            raise self.error
+        return self.count
+
 def is_valid_read( readpath ):
     '''
     Just checks to make sure file extension is in VALID_READ_EXT
 
     @param readpath - Path to read file
 
-    @returns true if ext of readpath is in VALID_READ_EXT
+    @returns true if readpath ends with an ext in VALID_READ_EXT
     '''
-    # File extension without the period in VALID_READ_EXT ?
-    return splitext( readpath )[1][1:] in VALID_READ_EXT
+    return any( readpath.endswith( '.' + ext ) for ext in VALID_READ_EXT )
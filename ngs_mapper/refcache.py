@@ -0,0 +1,200 @@
+'''
+Shared on disk cache of indexed references
+
+Everything that gets built from a reference(bwa index, samtools faidx index and
+the base_caller homopolymer bitmap) only depends on the contents of the fasta,
+so every sample that is mapped against the same reference can share one copy.
+
+Each entry lives in a directory named after the sha1 of the fasta. Entries are
+hard linked into the directory of the sample that uses them so evicting an entry
+never removes files out from under a running sample.
+'''
+import os
+from os.path import join, isdir, exists, lexists, dirname, abspath, getmtime, getsize
+import errno
+import fcntl
+import hashlib
+import logging
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from bwa.bwa import index_ref, compile_refs
+
+from ngs_mapper import samtools
+
+log = logging.getLogger(__name__)
+
+# Name of the fasta inside of every cache entry
+CACHE_FASTA = 'reference.fa'
+# Held shared while entries are used and exclusive while they are evicted
+CACHE_LOCK = '.lock'
+# Suffixes of the fasta and every index that is built from it
+REFERENCE_FILES = ('', '.amb', '.ann', '.bwt', '.pac', '.sa', '.fai', '.hpoly3.npz')
+
+def fasta_sha1( fasta, blocksize=1<<20 ):
+    '''
+    :param str fasta: Path to fasta file
+    :param int blocksize: How much of the file to read at a time
+
+    :returns sha1 hexdigest of the contents of fasta
+    '''
+    sha = hashlib.sha1()
+    with open(fasta, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), ''):
+            sha.update(block)
+    return sha.hexdigest()
+
+@contextmanager
+def lock( lockfile, mode=fcntl.LOCK_EX ):
+    '''
+    Holds an flock on lockfile(created if missing) for the duration of the with block
+
+    :param str lockfile: Path to lock file
+    :param int mode: fcntl.LOCK_EX or fcntl.LOCK_SH
+    '''
+    with open(lockfile, 'a') as fh:
+        fcntl.flock(fh, mode)
+        try:
+            yield fh
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+def build_entry( fasta, entry ):
+    '''
+    Copies fasta into a new cache entry and builds all of its indexes
+    The entry is built in a temporary directory that is renamed to entry when it
+    is complete so a partially built entry is never used
+
+    :param str fasta: Path to fasta file
+    :param str entry: Cache entry directory to create
+    '''
+    tmpdir = tempfile.mkdtemp(prefix='.tmp', dir=dirname(entry))
+    try:
+        reffile = join(tmpdir, CACHE_FASTA)
+        shutil.copyfile(fasta, reffile)
+        if not index_ref(reffile):
+            raise ValueError('{0} cannot be indexed by bwa'.format(fasta))
+        samtools.faidx(reffile)
+        # base_caller pulls in most of the pipeline so only import it when needed
+        from ngs_mapper.base_caller import index_reference
+        index_reference(reffile)
+        os.rename(tmpdir, entry)
+    except:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+def cached_reference( fasta, cachedir ):
+    '''
+    Get the indexed copy of fasta from cachedir, adding it if it is not there yet
+    The caller should hold the shared CACHE_LOCK so the entry is not evicted
+
+    :param str fasta: Path to fasta file
+    :param str cachedir: Cache directory
+
+    :returns path to the fasta inside of its cache entry
+    '''
+    entry = join(cachedir, fasta_sha1(fasta))
+    with lock(entry + '.lock'):
+        if not isdir(entry):
+            log.info('Adding {0} to reference cache {1}'.format(fasta, entry))
+            build_entry(fasta, entry)
+        else:
+            log.debug('{0} is already in reference cache {1}'.format(fasta, entry))
+        # Last use time for eviction
+        os.utime(entry, None)
+    return join(entry, CACHE_FASTA)
+
+def link_file( src, dst ):
+    '''
+    Hard link src to dst, replacing dst. Falls back to copying when src and dst are
+    on different filesystems
+
+    :param str src: Existing file
+    :param str dst: Path to create
+    '''
+    if lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM):
+            raise
+        # copy2 keeps the mtime so the indexes stay newer than the fasta
+        shutil.copy2(src, dst)
+
+def link_reference( reference, dest, cachedir, maxsize=None ):
+    '''
+    Links the cached copy of reference and all of its indexes(dest.amb, dest.fai,
+    dest.hpoly3.npz...) to dest, adding reference to the cache first if needed.
+    A directory of fasta files is compiled with compile_refs next to dest first.
+
+    :param str reference: Fasta file or directory of fasta files
+    :param str dest: Path of the fasta to create
+    :param str cachedir: Cache directory(created if it does not exist)
+    :param int maxsize: Evict least recently used entries until the cache is no
+        bigger than this many bytes(None to never evict)
+
+    :returns dest
+    '''
+    try:
+        os.makedirs(cachedir)
+    except OSError as e:
+        if not isdir(cachedir):
+            raise
+    if isdir(reference):
+        # compile_refs writes reference.fa into the current directory
+        reference = abspath(reference)
+        cwd = os.getcwd()
+        os.chdir(dirname(abspath(dest)))
+        try:
+            reference = abspath(compile_refs(reference))
+        finally:
+            os.chdir(cwd)
+    with lock(join(cachedir, CACHE_LOCK), fcntl.LOCK_SH):
+        cached = cached_reference(reference, cachedir)
+        entry = dirname(cached)
+        for f in os.listdir(entry):
+            if f.startswith(CACHE_FASTA):
+                link_file(join(entry, f), dest + f[len(CACHE_FASTA):])
+    if maxsize is not None:
+        evict(cachedir, maxsize)
+    return dest
+
+def entry_size( entry ):
+    '''
+    :param str entry: Cache entry directory
+
+    :returns total size in bytes of the files in entry
+    '''
+    return sum(getsize(join(entry, f)) for f in os.listdir(entry))
+
+def evict( cachedir, maxsize ):
+    '''
+    Removes the least recently used entries from cachedir until it is no bigger
+    than maxsize bytes. The most recently used entry is always kept
+
+    :param str cachedir: Cache directory
+    :param int maxsize: Maximum size of the cache in bytes
+
+    :returns list of removed entries
+    '''
+    removed = []
+    with lock(join(cachedir, CACHE_LOCK)):
+        entries = [
+            join(cachedir, d) for d in os.listdir(cachedir)
+            if not d.startswith('.') and isdir(join(cachedir, d))
+        ]
+        sizes = dict((entry, entry_size(entry)) for entry in entries)
+        total = sum(sizes.values())
+        for entry in sorted(entries, key=getmtime)[:-1]:
+            if total <= maxsize:
+                break
+            log.info('Evicting {0} from reference cache'.format(entry))
+            shutil.rmtree(entry)
+            # Nothing else can hold the entry lock while the cache lock is exclusive
+            if exists(entry + '.lock'):
+                os.unlink(entry + '.lock')
+            total -= sizes[entry]
+            removed.append(entry)
+    return removed
@@ -65,7 +65,7 @@ def rename_miseq( rbsfile, old, new, ngsdata ):
     rbsd = dirname( rbsfile )
     bcdir = join( rawd, 'Data', 'Intensities', 'BaseCalls' )
     # Raw file is fastq.gz without the date before it
-    rawfilename = re.sub( '_\d{4}_\d{2}_\d{2}.fastq', '.fastq.gz', readp )
+    rawfilename = re.sub( '_\d{4}_\d{2}_\d{2}.fastq(?:\.gz)?$', '.fastq.gz', readp )
     rawfile = join( bcdir, rawfilename )
     newrbsd = join( dirname(rbsd), new )
     if not isdir( newrbsd ):
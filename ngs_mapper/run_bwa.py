@@ -1,15 +1,20 @@
 from bwa.bwa import BWAMem, index_ref, which_bwa, compile_refs
 from ngs_mapper.data import reads_by_plat
-from ngs_mapper.reads import compile_reads
+from ngs_mapper.reads import compile_reads, stream_reads
+from ngs_mapper.tagreads import rg_line, get_bam_header
+from ngs_mapper import refcache
+from ngs_mapper.util import split_threads
 import ngs_mapper.bam
 
 import os
+import re
 import sys
 from os.path import *
 import log
 import tempfile
 import shutil
-from subprocess import PIPE
+from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
 
 logger = log.setup_logger(__name__, log.get_config())
 
@@ -25,21 +30,34 @@ def main():
     args = parse_args( sys.argv[1:] )
     tdir = join(dirname(args.output), 'bwa')
     
-    # Compile together all the reads into a list
+    # Reads for each platform are compiled and mapped on their own so that
+    # bwa can tag them with the read group for that platform
     preads = reads_by_plat( args.reads )
     logger.debug( "Reads parsed by platform: {0}".format(preads) )
-    reads = []
+    platreads = []
     for plat in args.platforms:
         if plat in preads:
-            reads += preads[plat]
-    # Creates reads/F.fq, reads/R.fq, reads/NP.fq
-    readdir = join(tdir,'reads')
-    os.makedirs( readdir )
-    reads = compile_reads( reads, readdir )
-    if not reads:
+            # Creates <plat>/reads/F.fq, <plat>/reads/R.fq, <plat>/reads/NP.fq
+            readdir = join(tdir, plat, 'reads')
+            os.makedirs( readdir )
+            if args.stream_reads:
+                # Named pipes that are fed while bwa reads them
+                reads, streams = stream_reads( preads[plat], readdir )
+            else:
+                reads, streams = compile_reads( preads[plat], readdir ), None
+            if not reads:
+                raise Exception( "Somehow no reads were compiled" )
+            platreads.append( (plat, reads, streams) )
+    if not platreads:
         raise Exception( "Somehow no reads were compiled" )
 
-    if os.path.isdir( args.reference ):
+    if args.ref_cache:
+        # Reuse the indexes from the reference cache instead of building them
+        ref = refcache.link_reference(
+            args.reference, join(tdir, 'reference.fa'), args.ref_cache,
+            args.ref_cache_size * 1024 * 1024
+        )
+    elif os.path.isdir( args.reference ):
         cwd = os.getcwd()
         os.chdir( tdir )
         ref = join( tdir, compile_refs( args.reference ) )
@@ -47,37 +65,32 @@ def main():
     else:
         ref = args.reference
 
-    # Keeps track so we know to merge bams later if it is 3
-    merge = 0
+    # Sample name defaults to the output name the same way tagreads does it
+    SM = args.SM
+    if SM is None:
+        SM = basename( args.output ).replace( '.bam', '' )
 
-    if reads['F'] is not None:
-        merge += 1
-        pairedsai = bwa_mem( reads['F'], reads['R'], ref, join(tdir, 'paired.sai'), t=args.threads )
-        if isinstance(pairedsai,int):
-            raise BWAError("There was an error running bwa")
-        pairedbam = ngs_mapper.bam.sortbam( ngs_mapper.bam.samtobam( pairedsai, PIPE ), join(tdir, 'paired.bam') )
-        #bam.indexbam( pairedbam )
-
-    if reads['NP'] is not None:
-        merge += 2
-        nonpairedsai = bwa_mem( reads['NP'], ref=ref, output=join(tdir, 'nonpaired.sai'), t=args.threads )
-        if isinstance(nonpairedsai,int):
-            raise BWAError("There was an error running bwa")
-        nonpairedbam = ngs_mapper.bam.sortbam( ngs_mapper.bam.samtobam( nonpairedsai, PIPE ), join(tdir, 'nonpaired.bam') )
-        #bam.indexbam( nonpairedbam )
+    # The paired and nonpaired reads of every platform are each a mapping job
+    jobs = []
+    rgs = []
+    for plat, reads, streams in platreads:
+        rg = rg_line( plat, SM, args.CN )
+        rgs.append( rg )
+        jobs += mapping_jobs( reads, join(tdir, plat), rg, streams )
+    if not jobs:
+        raise Exception( "Somehow no reads were compiled" )
 
     # Now decide if any merging needs to happen
     bampath = args.output
-    if merge == 3:
-        ngs_mapper.bam.mergebams( [pairedbam, nonpairedbam], args.output )
-    elif merge == 1:
-        logger.debug( "Paired only. Moving result file {0} to {1}".format(pairedbam, bampath) )
-        shutil.move( pairedbam, bampath )
-    elif merge == 2:
-        logger.debug( "Includes non-paired. Moving result file {0} to {1}".format(nonpairedbam, bampath) )
-        shutil.move( nonpairedbam, bampath )
+    if len( jobs ) > 1:
+        # Bams that only get merged are compressed as little as possible
+        bams = map_jobs( jobs, ref, args.threads, level=1 )
+        header = merge_header( bams[0], rgs, join(tdir, 'header.sam') )
+        ngs_mapper.bam.mergebams( bams, bampath, header, args.threads )
     else:
-        raise Exception( "Somehow no reads were compiled" )
+        logger.debug( "Only one mapping job. Sorting it straight into {0}".format(bampath) )
+        reads, bam, rg, streams = jobs[0]
+        map_jobs( [(reads, bampath, rg, streams)], ref, args.threads )
 
     # Index the resulting bam
     ngs_mapper.bam.indexbam( bampath )
@@ -106,8 +119,8 @@ def parse_args( args=sys.argv[1:] ):
         epilog='You should consider this script an autonomous bwa operation. That is, it will select the reads for ' \
             'the platforms you select and it will pull those reads onto the current host. It will ' \
             'compile references if they are multiple ones in a directory you select onto the local computer. Then it ' \
-            'will map any mated reads against to those refs and also map the nonpaired reads against that ref in a separate ' \
-            'call. Then when both are finished it will convert to bam/sort/index/merge/reindex the results. It attempts all of ' \
+            'will map the mated and nonpaired reads of each platform against those refs as separate jobs that run at the same ' \
+            'time and pipe straight into sorted bam files. Then when all are finished it will merge/index the results. It attempts all of ' \
             'this inside of the /dev/shm filesystem which should be very fast. If /dev/shm cannot be used then /tmp will be used. '\
             'If you want the temporary files that are created to stay then you can use the --keep-temp argument',
         parents=[conf_parser]
@@ -148,6 +161,43 @@ def parse_args( args=sys.argv[1:] ):
         help=defaults['keep_temp']['help']
     )
 
+    parser.add_argument(
+        '-SM',
+        dest='SM',
+        default=defaults['SM']['default'],
+        help=defaults['SM']['help']
+    )
+
+    parser.add_argument(
+        '-CN',
+        dest='CN',
+        default=defaults['CN']['default'],
+        help=defaults['CN']['help']
+    )
+
+    parser.add_argument(
+        '--ref-cache',
+        dest='ref_cache',
+        default=defaults['ref_cache']['default'],
+        help=defaults['ref_cache']['help']
+    )
+
+    parser.add_argument(
+        '--ref-cache-size',
+        dest='ref_cache_size',
+        type=int,
+        default=defaults['ref_cache_size']['default'],
+        help=defaults['ref_cache_size']['help']
+    )
+
+    parser.add_argument(
+        '--stream-reads',
+        dest='stream_reads',
+        action='store_true',
+        default=defaults['stream_reads']['default'],
+        help=defaults['stream_reads']['help']
+    )
+
     parser.add_argument(
         '-t',
         dest='threads',
@@ -160,6 +210,106 @@ def parse_args( args=sys.argv[1:] ):
 
 class InvalidReference(Exception): pass
 
+def mapping_jobs( reads, outdir, rg, streams=None ):
+    '''
+        Splits the compiled reads of a single platform into mapping jobs
+
+        @param reads - compile_reads output({'F':,'R':,'NP':})
+        @param outdir - Where the sorted bam of each job goes
+        @param rg - @RG header line for the reads
+        @param streams - stream_reads streams for reads if they are named pipes
+
+        @returns list of (read files, sorted bam path, rg, streams) for the paired and/or nonpaired reads
+            where streams is None unless streams was given
+    '''
+    jobs = []
+    if reads['F'] is not None:
+        jobstreams = None
+        if streams:
+            jobstreams = (streams['F'], streams['R'])
+        jobs.append( ((reads['F'], reads['R']), join(outdir, 'paired.bam'), rg, jobstreams) )
+    if reads['NP'] is not None:
+        jobstreams = None
+        if streams:
+            jobstreams = (streams['NP'],)
+        jobs.append( ((reads['NP'],), join(outdir, 'nonpaired.bam'), rg, jobstreams) )
+    return jobs
+
+def map_job( job ):
+    '''
+        Maps a single job from mapping_jobs with bwa_mem_bam
+        Tags the reads with the job's read group
+
+        @param job - (read files, ref, sorted bam path, rg, streams, threads, compression level)
+
+        @returns the sorted bam path
+    '''
+    reads, ref, bam, rg, streams, threads, level = job
+    # bwa expects the tabs in the read group to be escaped
+    R = rg.replace( '\t', '\\t' )
+    if len( reads ) == 2:
+        out = bwa_mem_bam( reads[0], reads[1], ref, bam, level, streams, t=threads, R=R )
+    else:
+        out = bwa_mem_bam( reads[0], ref=ref, output=bam, level=level, streams=streams, t=threads, R=R )
+    if isinstance(out,int):
+        raise BWAError("There was an error running bwa")
+    return out
+
+def map_jobs( jobs, ref, threads=1, level=None ):
+    '''
+        Runs mapping jobs concurrently. The threads are split between the jobs
+        by the size of their reads and no more than threads jobs run at once
+
+        @param jobs - List of (read files, sorted bam path, rg, streams) from mapping_jobs
+        @param ref - Reference file path
+        @param threads - Thread budget for all jobs
+        @param level - Compression level for the sorted bams
+
+        @returns list of sorted bam paths in the same order as jobs
+    '''
+    # Index up front so the jobs do not all try to build the index at once
+    logger.debug( "Ensuring {0} is indexed".format(ref) )
+    if not index_ref(ref):
+        raise InvalidReference("{0} cannot be indexed by bwa".format(ref))
+
+    sizes = []
+    for reads, bam, rg, streams in jobs:
+        if streams:
+            # Named pipes have no size so use what is being streamed into them
+            sizes.append( sum( stream.size for stream in streams ) )
+        else:
+            sizes.append( sum( os.path.getsize(r) for r in reads ) )
+    jobthreads = split_threads( sizes, threads )
+    args = [
+        (reads, ref, bam, rg, streams, t, level)
+        for (reads, bam, rg, streams), t in zip( jobs, jobthreads )
+    ]
+    if len( args ) == 1:
+        return [map_job( args[0] )]
+    # Each job spends its time in bwa and samtools so threads are enough
+    pool = ThreadPool( max( 1, min( len(args), threads ) ) )
+    try:
+        return pool.map( map_job, args )
+    finally:
+        pool.close()
+        pool.join()
+
+def merge_header( bam, rgs, headerfile ):
+    '''
+        Writes the header of bam with its @RG lines replaced by rgs so that
+        samtools merge keeps the read groups of every bam it merges
+
+        @param bam - Bam file to take the header from
+        @param rgs - List of @RG header lines
+        @param headerfile - Where to write the header
+
+        @returns headerfile
+    '''
+    lines = [line for line in get_bam_header( bam ).splitlines() if not line.startswith( '@RG\t' )]
+    with open( headerfile, 'w' ) as fh:
+        fh.write( '\n'.join( lines + rgs ) + '\n' )
+    return headerfile
+
 def bwa_mem( read1, mate=None, ref=None, output='bwa.sai', **kwargs ):
     '''
         Runs the bwa mem algorithm on read1 against ref. If mate is given then run that file with the read1 file
@@ -175,6 +325,63 @@ def bwa_mem( read1, mate=None, ref=None, output='bwa.sai', **kwargs ):
 
         @returns the output path if sucessful or -1 if something went wrong
     '''
+    mem = setup_bwa_mem( read1, mate, ref, **kwargs )
+    ret = mem.run( output )
+    print "Ret: " + str(ret)
+    if ret != 0:
+        return ret
+    else:
+        return output
+
+def bwa_mem_bam( read1, mate=None, ref=None, output='bwa.bam', level=None, streams=None, **kwargs ):
+    '''
+        Runs bwa mem the same way as bwa_mem but pipes the alignments through
+        samtools into a sorted bam instead of writing them to a sam file first
+
+        @param read1 - File path to read
+        @param mate - Mate file path
+        @param ref - Reference file path or directory of references
+        @param output - The sorted bam to create
+        @param level - Compression level for output(samtools default if None)
+        @param streams - ReadStreams feeding read1 and mate if they are named pipes
+
+        @returns the output path if sucessful or the bwa return code if something went wrong
+    '''
+    mem = setup_bwa_mem( read1, mate, ref, streams, **kwargs )
+    cmd = mem.required_options_values + mem.options + mem.args
+    logger.info( "Running {0}".format( " ".join( cmd ) ) )
+    # stderr goes to a file so bwa cannot block on it while samtools reads stdout
+    with tempfile.TemporaryFile() as errfh:
+        # Keeps bwa from holding open pipes of other mapping jobs
+        p = Popen( cmd, stdout=PIPE, stderr=errfh, close_fds=True )
+        bam = ngs_mapper.bam.samtobam( p.stdout, PIPE, uncompressed=True )
+        # Only samtools should hold the pipe so bwa sees it close
+        p.stdout.close()
+        ngs_mapper.bam.sortbam( bam, output, level )
+        bam.close()
+        p.wait()
+        errfh.seek( 0 )
+        stderr = errfh.read()
+    logger.debug( "STDERR: {0}".format(stderr) )
+
+    ret = mem.bwa_return_code( stderr )
+    if ret != 0:
+        return ret
+    else:
+        return output
+
+def setup_bwa_mem( read1, mate=None, ref=None, streams=None, **kwargs ):
+    '''
+        Makes sure ref is compiled and indexed and sets up BWAMem for read1
+        and mate
+
+        @param read1 - File path to read
+        @param mate - Mate file path
+        @param ref - Reference file path or directory of references
+        @param streams - ReadStreams feeding read1 and mate if they are named pipes
+
+        @returns BWAMem instance(StreamBWAMem if streams are given)
+    '''
     if os.path.isdir( ref ):
         # Compile ref directory
         logger.debug( "Compiling references inside of {0}".format(ref) )
@@ -187,15 +394,48 @@ def bwa_mem( read1, mate=None, ref=None, output='bwa.sai', **kwargs ):
         raise InvalidReference("{0} cannot be indexed by bwa")
 
     # Setup BWA Mem
-    mem = None
+    args = [ref, read1]
     if mate:
-        mem = BWAMem( ref, read1, mate, bwa_path=which_bwa(), **kwargs )
-    else:
-        mem = BWAMem( ref, read1, bwa_path=which_bwa(), **kwargs )
+        args.append( mate )
+    if streams:
+        return StreamBWAMem( streams, *args, bwa_path=which_bwa(), **kwargs )
+    return BWAMem( *args, bwa_path=which_bwa(), **kwargs )
 
-    ret = mem.run( output )
-    print "Ret: " + str(ret)
-    if ret != 0:
-        return ret
-    else:
-        return output
+class StreamBWAMem(BWAMem):
+    '''
+        BWAMem for reads that are named pipes fed by reads.ReadStream
+        The pipes can only be read once so they are not opened to be validated and
+        the reads bwa processed are checked against the reads that were streamed
+    '''
+    # bwa has reported the reads as [M::main_mem] and [M::process] depending on version
+    READ_LINE = re.compile( '\[M::\w+\] read (\d+) sequences' )
+
+    def __init__( self, streams, *args, **kwargs ):
+        self.streams = streams
+        super( StreamBWAMem, self ).__init__( *args, **kwargs )
+
+    def validate_input( self, inputpath ):
+        if not os.path.exists( inputpath ):
+            raise ValueError( "{0} is not a valid input file".format(inputpath) )
+
+    def bwa_return_code( self, output ):
+        '''
+            Waits for all streams to finish and makes sure bwa processed
+            every read that was streamed
+
+            @param output - bwa stderr
+
+            @returns 0 if all reads were processed otherwise 1
+        '''
+        expected_reads = 0
+        for stream in self.streams:
+            try:
+                expected_reads += stream.finish()
+            except (IOError, OSError, ValueError) as e:
+                logger.error( "Streaming {0} failed: {1}".format(stream.readfiles, e) )
+                return 1
+        total_reads = sum( int( n ) for n in self.READ_LINE.findall( output ) )
+        if total_reads == 0 or total_reads != expected_reads:
+            logger.error( "bwa processed {0} reads but {1} were streamed".format(total_reads, expected_reads) )
+            return 1
+        return 0
@@ -10,14 +10,25 @@ Current Pipeline Stages
 
 * :py:mod:`ngs_mapper.nfilter`
 * :py:mod:`ngs_mapper.trim_reads`
-* :py:mod:`ngs_mapper.run_bwa_on_samplename <ngs_mapper.run_bwa>`
-* :py:mod:`ngs_mapper.tagreads`
+* :py:mod:`ngs_mapper.read_qc` (instead of nfilter and trim_reads with --read-qc)
+* :py:mod:`ngs_mapper.run_bwa_on_samplename <ngs_mapper.run_bwa>` (also assigns the read groups)
 * :py:mod:`ngs_mapper.base_caller`
 * :doc:`../scripts/gen_flagstats`
 * :py:mod:`ngs_mapper.graphsample`
 * :py:mod:`ngs_mapper.fqstats`
 * :py:mod:`ngs_mapper.vcf_consensus`
 
+The stages are run by :py:mod:`ngs_mapper.stages` as soon as the stages they
+depend on are done, so stages that do not depend on each other(such as
+base_caller, flagstats and fqstats) run at the same time as long as their
+threads(from the config) fit in --threads
+
+Every stage that finishes is recorded in checkpoints.json along with its
+command line and the size and modification time of its inputs. Running again
+with --resume in the same outdir(after a failure or with different options)
+only runs the stages whose command line or inputs changed and the stages after
+them
+
 Basic Usage
 ===========
 
@@ -69,6 +80,8 @@ Output Analysis Directory
     * VCF formatted file that has all information about each base position across
       each reference.
     * You can open this with your spreadsheet program by using tab as the delimiter
+* checkpoints.json (:py:mod:`ngs_mapper.stages`)
+    * The stages that finished and what they were run with. Used by --resume
 * samplename.log (:py:mod:`ngs_mapper.runsample`)
     * Log file showing what stages were run
 * samplename.reads.png (:py:mod:`ngs_mapper.fqstats`)
@@ -79,7 +92,8 @@ Output Analysis Directory
 * bwa.log (:py:mod:`ngs_mapper.run_bwa_on_samplename`)
     * Log file that is specific to when bwa ran and contains all bwa output
 * reference.fasta (:py:mod:`ngs_mapper.runsample`)
-    * Copied reference fasta file that was specified
+    * Copied reference fasta file that was specified(linked from --ref-cache along
+      with its indexes if it is set)
 * reference.fasta.amb (:py:mod:`ngs_mapper.runsample`)
 * reference.fasta.ann (:py:mod:`ngs_mapper.runsample`)
 * reference.fasta.bwt (:py:mod:`ngs_mapper.runsample`)
@@ -100,6 +114,15 @@ Output Analysis Directory
     * filtered.sampleread1.fastq
     * filtered.sampleread2.fastq
     * ngs_filter_stats.txt
+
+With --read-qc trimmed_reads has the read_qc output instead(with its
+ngs_filter_stats.txt) and there is no filtered directory::
+
+    * trimmed_reads (:py:mod:`ngs_mapper.read_qc`)
+        * MiSeq_R1_.fastq
+        * MiSeq_R2_.fastq
+        * MiSeq.fastq
+        * ngs_filter_stats.txt
 """
 
 import argparse
@@ -112,10 +135,12 @@ import tempfile
 import logging
 import shutil
 import glob
+import re
 from ngs_mapper import compat
-import sh
+from ngs_mapper import refcache
 from data import fastas_to_40s_fastqs
 import nfilter
+from stages import Stage, Checkpoints, run_stages, budget_from_env, remove_paths
 # Everything to do with running a single sample
 # Geared towards running in a Grid like universe(HTCondor...)
 # Ideally the entire sample would be run inside of a prefix directory under
@@ -212,6 +237,21 @@ def parse_args( args=sys.argv[1:] ):
         help=_config['tagreads']['CN']['help'],
     )
 
+    parser.add_argument(
+        '--ref-cache',
+        dest='ref_cache',
+        default=_config['run_bwa_on_samplename']['ref_cache']['default'],
+        help=_config['run_bwa_on_samplename']['ref_cache']['help'],
+    )
+
+    parser.add_argument(
+        '--ref-cache-size',
+        dest='ref_cache_size',
+        type=int,
+        default=_config['run_bwa_on_samplename']['ref_cache_size']['default'],
+        help=_config['run_bwa_on_samplename']['ref_cache_size']['help'],
+    )
+
     parser.add_argument(
         '--index-min',
         dest='index_min',
@@ -235,6 +275,32 @@ def parse_args( args=sys.argv[1:] ):
         help=_config['ngs_filter']['platforms']['help'],
     )
 
+    parser.add_argument(
+        '--read-qc',
+        dest='read_qc',
+        action='store_true',
+        default=_config['read_qc']['fused']['default'],
+        help=_config['read_qc']['fused']['help'],
+    )
+
+    parser.add_argument(
+        '-t',
+        '--threads',
+        dest='threads',
+        type=int,
+        default=_config['THREADS'],
+        help='How many threads the stages that run at the same time can use together[Default: %(default)s]'
+    )
+
+    parser.add_argument(
+        '--resume',
+        dest='resume',
+        action='store_true',
+        default=False,
+        help='Run in an outdir that is not empty, only running the stages that are not up to date with the ' \
+            'finished or unfinished run that is already in it'
+    )
+
     default_outdir = os.getcwd()
     parser.add_argument(
         '-od',
@@ -253,6 +319,11 @@ def parse_args( args=sys.argv[1:] ):
 
     args, rest = parser.parse_known_args(args)
     args.config = configfile
+    # How many threads each stage will use according to the config
+    args.stage_threads = dict(
+        (stage, _config[stage]['threads']['default'])
+        for stage in ('ngs_filter', 'trim_reads', 'run_bwa_on_samplename', 'base_caller')
+    )
 
     # Parse qsub args if found
     if rest and rest[0].startswith('--qsub'):
@@ -289,6 +360,20 @@ def make_project_repo( projpath ):
     output = compat.check_output( cmd, stderr=subprocess.STDOUT )
     logger.debug( output )
 
+def resume_dir( outdir, prefix ):
+    '''
+    The newest temporary directory an unfinished run of prefix left in outdir
+
+    :return: path to the directory or None if there is not one
+    '''
+    tdirs = [
+        d for d in glob.glob( os.path.join( outdir, prefix + '*runsample' ) )
+        if os.path.isdir(d) and os.listdir(d)
+    ]
+    if not tdirs:
+        return None
+    return max( tdirs, key=os.path.getmtime )
+
 def run_cmd( cmdstr, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr, script_dir=None ):
     '''
         Runs a subprocess on cmdstr and logs some timing information for each command
@@ -319,7 +404,7 @@ def main():
     global logger
     # Setup analysis directory
     if os.path.isdir( args.outdir ):
-        if os.listdir( args.outdir ):
+        if os.listdir( args.outdir ) and not args.resume:
             raise AlreadyExists( "{0} already exists and is not empty".format(args.outdir) )
     else:
         os.makedirs(args.outdir)
@@ -330,16 +415,28 @@ def main():
     # /dev/shm
     tmpdir = args.outdir
     # Directory analysis is run in will be inside of tmpdir
-    tdir = tempfile.mkdtemp('runsample', args.prefix, dir=tmpdir)
+    tdir = None
+    if args.resume:
+        tdir = resume_dir( args.outdir, args.prefix )
+    if tdir is None:
+        tdir = tempfile.mkdtemp('runsample', args.prefix, dir=tmpdir)
+        if args.resume:
+            # Pick up where the finished run in outdir left off
+            for f in os.listdir( args.outdir ):
+                if not re.match( re.escape(args.prefix) + '.*runsample$', f ):
+                    shutil.move( os.path.join( args.outdir, f ), tdir )
+    tdir = os.path.abspath( tdir )
     os.environ['TMPDIR'] = tdir
 
     bamfile = os.path.join( tdir, args.prefix + '.bam' )
     flagstats = os.path.join( tdir, 'flagstats.txt' )
     consensus = bamfile+'.consensus.fasta'
+    qualdepth = bamfile+'.qualdepth.json'
     vcf = bamfile+'.vcf'
     bwalog = os.path.join( tdir, 'bwa.log' )
     stdlog = os.path.join( tdir, args.prefix + '.std.log' )
     logfile = os.path.join( tdir, args.prefix + '.log' )
+    manifest = os.path.join( tdir, 'checkpoints.json' )
     CN = args.CN
 
     # Set the global logger
@@ -352,7 +449,8 @@ def main():
     if args.config:
         logger.info( "--- Using custom config from {0} ---".format(args.config) )
     # Write all stdout/stderr to a logfile from the various commands
-    with open(stdlog,'wb') as lfile:
+    # Appended to so a resumed run keeps the output of the earlier ones
+    with open(stdlog,'ab') as lfile:
         cmd_args = {
             'samplename': args.prefix,
             'tdir': tdir,
@@ -361,6 +459,7 @@ def main():
             'bamfile': bamfile,
             'flagstats': flagstats,
             'consensus': consensus,
+            'qualdepth': qualdepth,
             'vcf': vcf,
             'CN': CN,
             'trim_qual': args.trim_qual,
@@ -375,130 +474,174 @@ def main():
             'primer_info' : (args.primer_file, args.primer_seed, args.palindrom_clip, args.simple_clip)
         }
 
-        # Best not to run across multiple cpu/core/threads on any of the pipeline steps
-        # as multiple samples may be running concurrently already
-
-        logger.debug( "Copying reference file {0} to {1}".format(args.reference,cmd_args['reference']) )
-        shutil.copy( args.reference, cmd_args['reference'] )
+        # Stages that do not depend on each other run at the same time as long
+        # as their threads fit in --threads. Multiple samples may be running
+        # concurrently already so the default is the config THREADS
+        stage_threads = args.stage_threads
+        stage_list = []
+
+        def link_reference():
+            # Anything left from an earlier run was built from a different reference
+            for suffix in refcache.REFERENCE_FILES:
+                f = cmd_args['reference'] + suffix
+                if os.path.lexists( f ):
+                    os.unlink( f )
+            if args.ref_cache:
+                # The copy comes with its indexes so later stages do not rebuild them
+                logger.debug( "Linking reference file {0} from cache {1} to {2}".format(args.reference,args.ref_cache,cmd_args['reference']) )
+                refcache.link_reference( args.reference, cmd_args['reference'], args.ref_cache, args.ref_cache_size * 1024 * 1024 )
+            else:
+                logger.debug( "Copying reference file {0} to {1}".format(args.reference,cmd_args['reference']) )
+                shutil.copy( args.reference, cmd_args['reference'] )
+        stage_list.append( Stage(
+            'reference', func=link_reference, fatal=True,
+            inputs=[args.reference], outputs=[cmd_args['reference']], params=[args.ref_cache]
+        ) )
+        # Every stage depends on the contents of the config it is run with
+        configs = [args.config] if args.config else []
 
-        # Return code list
-        rets = []
         logger.debug(cmd_args)
-        #Filter
-        def select_keys(d, keys):
-            return dict( ((k, v) for k, v in d.items() if k in keys))
-
 
         #convert sffs to fastq
         convert_dir = os.path.join(tdir,'converted')
-
-        print sh.convert_formats(cmd_args['readsdir'], convert_dir, _out=sys.stdout, _err=sys.stderr)
-        #print sh.sff_to_fastq(cmd_args['readsdir'], _out=sys.stdout, _err=sys.stderr)
+        trim_stats = os.path.join(tdir,'trim_stats')
+        cmd_args['convert_dir'] = convert_dir
+        stage_list.append( Stage(
+            'convert_formats', 'convert_formats {readsdir} {convert_dir}'.format(**cmd_args), fatal=True,
+            inputs=[args.readsdir], outputs=[convert_dir]
+        ) )
+        reads_stage = 'convert_formats'
 
         if args.fasta:
-            fastas = glob.glob(os.path.join(cmd_args['readsdir'], '*.fasta'))
-            fastas_to_40s_fastqs(convert_dir, fastas)
-
-        try:
+            fastas = sorted(glob.glob(os.path.join(cmd_args['readsdir'], '*.fasta')))
+            def convert_fastas():
+                fastas_to_40s_fastqs(convert_dir, fastas)
+            stage_list.append( Stage(
+                'fasta', func=convert_fastas, deps=[reads_stage], fatal=True, inputs=fastas,
+                outputs=[os.path.join(convert_dir, os.path.splitext(os.path.basename(f))[0] + '.fastq') for f in fastas]
+            ) )
+            reads_stage = 'fasta'
+
+        if args.read_qc:
+            # Filter and trim in one pass
+            cmd = 'read_qc {convert_dir} -q {trim_qual} -o {trim_outdir} --head-crop {head_crop} --index-min {index_min}'
+            if cmd_args['drop_ns']:
+                cmd += ' --drop-ns'
+            platforms = cmd_args['platforms']
+            if isinstance(platforms, basestring):
+                platforms = nfilter.picked_platforms(platforms)
+            cmd += ' --platforms ' + ' '.join(platforms)
+            if cmd_args['config']:
+                cmd += ' -c {config}'
+            primer_info = cmd_args['primer_info']
+            if primer_info[0]:
+                cmd += " --primer-file %s --primer-seed %s --palindrome-clip %s --simple-clip %s " % primer_info
+            stage_list.append( Stage(
+                'read_qc', cmd.format(**cmd_args), deps=[reads_stage], stdout=lfile, stderr=subprocess.STDOUT,
+                inputs=[convert_dir] + configs, outputs=[cmd_args['trim_outdir'], trim_stats]
+            ) )
+            trim_stage = 'read_qc'
+        else:
+            # Filter on index quality and Ns
+            cmd = 'ngs_filter {convert_dir} --outdir {filtered_dir}'
             if cmd_args['config']:
-                __result = sh.ngs_filter(convert_dir, config=cmd_args['config'], outdir=cmd_args['filtered_dir'])
+                cmd += ' --config {config}'
             else:
-                filter_args = select_keys(cmd_args, ["drop_ns", "platforms", "index_min"])
-                __result = sh.ngs_filter(convert_dir, outdir=cmd_args['filtered_dir'], **filter_args)
-            logger.debug( 'ngs_filter: %s' % __result )
-        except sh.ErrorReturnCode, e:
-                logger.error(e.stderr)
-                sys.exit(1)
-
-        #sh.rm(convert_dir, r=True)
-
-        #Trim reads
-        cmd = 'trim_reads {filtered_dir} -q {trim_qual} -o {trim_outdir} --head-crop {head_crop}'
-        if cmd_args['config']:
-            cmd += ' -c {config}'
-        primer_info = cmd_args['primer_info']
-        if primer_info[0]:
-            cmd += " --primer-file %s --primer-seed %s --palindrome-clip %s --simple-clip %s " % primer_info
-        p = run_cmd( cmd.format(**cmd_args), stdout=lfile, stderr=subprocess.STDOUT )
-        rets.append( p.wait() )
-        if rets[-1] != 0:
-            logger.critical( "{0} did not exit sucessfully".format(cmd.format(**cmd_args)) )
-
-        # Filter on index quality and Ns
-
-        # Mapping
-        with open(bwalog, 'wb') as blog:
-            cmd = 'run_bwa_on_samplename {trim_outdir} {reference} -o {bamfile}'
+                cmd += ' --index-min {index_min} --threads ' + str(stage_threads['ngs_filter'])
+                if cmd_args['drop_ns']:
+                    cmd += ' --drop-ns'
+                platforms = cmd_args['platforms']
+                if not isinstance(platforms, basestring):
+                    platforms = ','.join(platforms)
+                cmd += ' --platforms ' + platforms
+            stage_list.append( Stage(
+                'ngs_filter', cmd.format(**cmd_args), deps=[reads_stage],
+                threads=stage_threads['ngs_filter'], stdout=lfile, stderr=subprocess.STDOUT, fatal=True,
+                inputs=[convert_dir] + configs, outputs=[cmd_args['filtered_dir']]
+            ) )
+
+            #Trim reads
+            cmd = 'trim_reads {filtered_dir} -q {trim_qual} -o {trim_outdir} --head-crop {head_crop}'
             if cmd_args['config']:
                 cmd += ' -c {config}'
-            p = run_cmd( cmd.format(**cmd_args), stdout=blog, stderr=subprocess.STDOUT )
-            # Wait for the sample to map
-            rets.append( p.wait() )
-            # Everything else is dependant on bwa finishing so might as well die here
-            if rets[-1] != 0:
-                cmd = cmd.format(**cmd_args)
-                logger.critical( "{0} failed to complete sucessfully. Please check the log file {1} for more details".format(cmd,bwalog) )
-                sys.exit(1)
-
-        # Tag Reads
-        cmd = 'tagreads {bamfile} -CN {CN}'
+            primer_info = cmd_args['primer_info']
+            if primer_info[0]:
+                cmd += " --primer-file %s --primer-seed %s --palindrome-clip %s --simple-clip %s " % primer_info
+            stage_list.append( Stage(
+                'trim_reads', cmd.format(**cmd_args), deps=['ngs_filter'],
+                threads=stage_threads['trim_reads'], stdout=lfile, stderr=subprocess.STDOUT,
+                inputs=[cmd_args['filtered_dir']] + configs, outputs=[cmd_args['trim_outdir'], trim_stats]
+            ) )
+            trim_stage = 'trim_reads'
+
+        # Mapping
+        # Reads are tagged with their read group by bwa
+        cmd = 'run_bwa_on_samplename {trim_outdir} {reference} -o {bamfile}'
+        if cmd_args['CN'] is not None:
+            cmd += ' -CN {CN}'
         if cmd_args['config']:
             cmd += ' -c {config}'
-        p = run_cmd( cmd.format(**cmd_args), stdout=lfile, stderr=subprocess.STDOUT )
-        r = p.wait()
-        if r != 0:
-            logger.critical( "{0} did not exit sucessfully".format(cmd.format(**cmd_args)) )
-        rets.append( r )
+        # Everything else is dependant on bwa finishing so might as well die there
+        stage_list.append( Stage(
+            'run_bwa_on_samplename', cmd.format(**cmd_args), deps=[trim_stage, 'reference'],
+            threads=stage_threads['run_bwa_on_samplename'], stdout=bwalog, stderr=subprocess.STDOUT, fatal=True,
+            inputs=[cmd_args['trim_outdir'], cmd_args['reference']] + configs, outputs=[bamfile, bamfile + '.bai']
+        ) )
 
         # Variant Calling
-        cmd = 'base_caller {bamfile} {reference} {vcf} -minth {minth}'
+        # The qualdepth json for graphsample comes from the same pileup pass
+        cmd = 'base_caller {bamfile} {reference} {vcf} -minth {minth} --qualdepth {qualdepth}'
         if cmd_args['config']:
             cmd += ' -c {config}'
-        p = run_cmd( cmd.format(**cmd_args), stdout=lfile, stderr=subprocess.STDOUT )
-        r = p.wait()
-        if r != 0:
-            logger.critical( "{0} did not exit sucessfully".format(cmd.format(**cmd_args)) )
-        rets.append( r )
-        if rets[-1] != 0:
-            cmd = cmd.format(**cmd_args)
-            logger.critical( '{0} failed to complete successfully'.format(cmd.format(**cmd_args)) )
+        stage_list.append( Stage(
+            'base_caller', cmd.format(**cmd_args), deps=['run_bwa_on_samplename'],
+            threads=stage_threads['base_caller'], stdout=lfile, stderr=subprocess.STDOUT,
+            inputs=[bamfile, cmd_args['reference']] + configs, outputs=[vcf, qualdepth]
+        ) )
 
         # Flagstats
-        with open(flagstats,'wb') as flagstats:
-            cmd = 'samtools flagstat {bamfile}'
-            p = run_cmd( cmd.format(**cmd_args), stdout=flagstats, stderr=lfile, script_dir='' )
-            r = p.wait()
-            if r != 0:
-                logger.critical( "{0} did not exit sucessfully".format(cmd.format(**cmd_args)) )
-            rets.append( r )
+        stage_list.append( Stage(
+            'flagstat', 'samtools flagstat {bamfile}'.format(**cmd_args), deps=['run_bwa_on_samplename'],
+            stdout=flagstats, stderr=lfile, script_dir='',
+            inputs=[bamfile], outputs=[flagstats]
+        ) )
 
         # Graphics
-        cmd = 'graphsample {bamfile} -od {tdir}'
-        p = run_cmd( cmd.format(**cmd_args), stdout=lfile, stderr=subprocess.STDOUT )
-        r = p.wait()
-        if r != 0:
-            logger.critical( "{0} did not exit sucessfully".format(cmd.format(**cmd_args)) )
-        rets.append( r )
+        stage_list.append( Stage(
+            'graphsample', 'graphsample {bamfile} -od {tdir} -qualdepth {qualdepth}'.format(**cmd_args),
+            deps=['base_caller'], stdout=lfile, stderr=subprocess.STDOUT,
+            inputs=[bamfile, qualdepth] + configs, outputs=[qualdepth.replace('.json', '.png')]
+        ) )
 
         # Read Graphics
-        fastqs = ' '.join( glob.glob( os.path.join( cmd_args['trim_outdir'], '*.fastq' ) ) )
-        cmd = 'fqstats -o {0}.reads.png {1}'.format(cmd_args['bamfile'].replace('.bam',''),fastqs)
-        p = run_cmd( cmd, stdout=lfile, stderr=subprocess.STDOUT )
-        r = p.wait()
-        if r != 0:
-            logger.critical( "{0} did not exit sucessfully".format(cmd) )
-        rets.append( r )
+        def fqstats_cmd():
+            # The trimmed reads only exist once the trim stage is done
+            fastqs = ' '.join( sorted( glob.glob( os.path.join( cmd_args['trim_outdir'], '*.fastq' ) ) ) )
+            return 'fqstats -o {0}.reads.png {1}'.format(cmd_args['bamfile'].replace('.bam',''),fastqs)
+        stage_list.append( Stage(
+            'fqstats', fqstats_cmd, deps=[trim_stage], stdout=lfile, stderr=subprocess.STDOUT,
+            inputs=[cmd_args['trim_outdir']], outputs=[bamfile.replace('.bam', '') + '.reads.png']
+        ) )
 
         # Consensus
-        cmd = 'vcf_consensus {vcf} -i {samplename} -o {consensus}'
-        p = run_cmd( cmd.format(**cmd_args), stdout=lfile, stderr=subprocess.STDOUT )
-        r = p.wait()
-        if r != 0:
-            logger.critical( "{0} did not exit sucessfully".format(cmd.format(**cmd_args)) )
-        rets.append( r )
-
-        # If sum is > 0 then one of the commands failed
-        if sum(rets) != 0:
+        stage_list.append( Stage(
+            'vcf_consensus', 'vcf_consensus {vcf} -i {samplename} -o {consensus}'.format(**cmd_args),
+            deps=['base_caller'], stdout=lfile, stderr=subprocess.STDOUT,
+            inputs=[vcf], outputs=[consensus]
+        ) )
+
+        # runsamplesheet shares one budget between all the samples it runs
+        # Stages that are up to date from an earlier run are skipped
+        checkpoints = Checkpoints( manifest, tdir )
+        results = run_stages(
+            stage_list, args.threads, run_cmd, logger, budget_from_env(args.threads), checkpoints
+        )
+
+        if results['run_bwa_on_samplename'] != 0:
+            logger.critical( "Mapping failed to complete sucessfully. Please check the log file {0} for more details".format(bwalog) )
+            sys.exit(1)
+        # Any stage that failed or was skipped is an error
+        if any( r != 0 for r in results.values() ):
             logger.critical( "!!! There was an error running part of the pipeline !!!" )
             logger.critical( "Please check the logfile {0}".format(logfile) )
             sys.exit( 1 )
@@ -514,7 +657,11 @@ def main():
         else:
             file_list = [os.path.join(tdir,m) for m in os.listdir(tdir)]
             for f in file_list:
+                # Replaces what a resumed run left in outdir
+                remove_paths( [os.path.join( args.outdir, os.path.basename(f) )] )
                 shutil.move( f, args.outdir )
+            # So a later --resume does not mistake it for an unfinished run
+            os.rmdir( tdir )
 
 def pbs_job(runsampleargs, pbsargs):
     '''
@@ -0,0 +1,333 @@
+"""
+Runs :py:mod:`runsample <ngs_mapper.runsample>` on every sample/reference pair
+inside of a :doc:`../samplesheet`
+
+Every runsample takes the threads for its stages from one budget that is shared
+by all of the samples(see :py:mod:`ngs_mapper.stages`), so the mapping of one
+sample can run while another sample is base calling without the machine being
+oversubscribed. How many samples run at the same time is limited by how much
+memory they are planned to use.
+
+Samples that already finished are skipped(unless --resume is given) and
+samples that did not finish are resumed with runsample --resume, which only
+runs the stages that are not up to date.
+
+Once all samples are done the time every stage took is summarized in
+StageThroughput.tsv
+
+Usage
+=====
+
+.. code-block:: bash
+
+    runsamplesheet /path/to/ReadsBySample /path/to/samplesheet.tsv
+
+Any option that runsample does not know about is passed on to runsample
+
+.. code-block:: bash
+
+    runsamplesheet /path/to/ReadsBySample /path/to/samplesheet.tsv -minth 0.95
+"""
+
+import argparse
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import join, isdir, isfile, exists
+
+from ngs_mapper import stages
+import log
+
+lconfig = log.get_config()
+logger = log.setup_logger( 'runsamplesheet', lconfig )
+
+# Seconds between checks for finished samples
+POLL_INTERVAL = 1
+# Where the stage summary is written
+THROUGHPUT_FILE = 'StageThroughput.tsv'
+
+def main():
+    args, runsample_args = parse_args()
+    samples = read_samplesheet( args.samplesheet )
+    cores = args.cores or multiprocessing.cpu_count()
+    memory = args.memory or total_memory()
+    max_samples = samples_at_once( cores, memory, args.sample_memory )
+    logger.info( "Using {0} cores and running at most {1} samples at a time".format(cores, max_samples) )
+    if args.config:
+        runsample_args += ['-c', args.config]
+    started = time.time()
+    results = run_samplesheet(
+        args.readsbysample, samples, args.projdir, cores, max_samples, runsample_args, args.resume
+    )
+    elapsed = time.time() - started
+    outdirs = [join(args.projdir, sample) for sample, reference in samples]
+    report = stage_throughput( [d for d in outdirs if sample_status( d ) == 'done'] )
+    write_throughput( report, THROUGHPUT_FILE )
+    ran = [s for s, r in results.items() if r == 0]
+    if ran:
+        logger.info( "Ran {0} samples in {1:.0f} seconds({2:.2f} samples per hour)".format(
+            len(ran), elapsed, len(ran) * 3600.0 / max(elapsed, 1) )
+        )
+    failed = sorted( s for s, r in results.items() if r != 0 )
+    if failed:
+        logger.critical( "The following samples did not finish: {0}".format(', '.join(failed)) )
+        sys.exit( 1 )
+
+def read_samplesheet( samplesheet ):
+    '''
+    Read the samplename/reference pairs out of a samplesheet
+
+    Lines starting with # are ignored. Lines without both a samplename and a
+    reference file that exists are skipped with an error
+
+    :param str samplesheet: Path to space or tab delimited samplesheet
+    :return: list of (samplename, reference)
+    '''
+    samples = []
+    with open( samplesheet ) as fh:
+        for line in fh:
+            line = line.replace( '\r', '' ).strip()
+            if not line or line.startswith( '#' ):
+                continue
+            parts = line.split()
+            if len(parts) < 2:
+                logger.error( "{0} must have an incorrect line. Could not read reference from {1}".format(
+                    samplesheet, line )
+                )
+                continue
+            sample, reference = parts[:2]
+            if not isfile( reference ):
+                logger.error( "{0} is not a file that can be read. Skipping {1}".format(reference, sample) )
+                continue
+            samples.append( (sample, reference) )
+    return samples
+
+def total_memory( meminfo='/proc/meminfo' ):
+    '''
+    :return: megabytes of memory in the machine or None if it cannot be found
+    '''
+    try:
+        with open( meminfo ) as fh:
+            for line in fh:
+                if line.startswith( 'MemTotal:' ):
+                    return int(line.split()[1]) // 1024
+    except IOError:
+        pass
+    return None
+
+def samples_at_once( cores, memory, sample_memory ):
+    '''
+    How many samples can run at the same time
+
+    More samples than cores would only wait on each other for threads and more
+    samples than fit in memory would swap
+
+    :param int cores: Cores that all samples share
+    :param int memory: Megabytes of memory all samples share(None for no limit)
+    :param int sample_memory: Megabytes of memory planned for each sample
+    '''
+    n = cores
+    if memory and sample_memory:
+        n = min( n, memory // sample_memory )
+    return max( 1, n )
+
+def sample_status( outdir ):
+    '''
+    :param str outdir: runsample output directory of a sample
+    :return: 'done' if the sample finished, 'partial' if it was started but did
+        not finish and 'new' if it was never run
+    '''
+    if not isdir( outdir ) or not os.listdir( outdir ):
+        return 'new'
+    # runsample only moves its log into outdir once every stage finished
+    sample = os.path.basename( outdir.rstrip( os.sep ) )
+    if exists( join(outdir, sample + '.log') ):
+        return 'done'
+    return 'partial'
+
+def run_samplesheet( readsbysample, samples, projdir, cores, max_samples, runsample_args=[], resume=False ):
+    '''
+    Run runsample for every sample that has not finished already
+
+    :param str readsbysample: Directory with a read directory for every sample
+    :param list samples: (samplename, reference) pairs
+    :param str projdir: Directory every sample's output directory goes in
+    :param int cores: Threads that all samples share
+    :param int max_samples: Most samples to run at the same time
+    :param list runsample_args: Extra arguments for runsample
+    :param bool resume: Also resume the samples that finished so the stages
+        that are out of date(such as after changing -minth) run again
+
+    A sample that is killed by a signal cannot give back the threads it held so
+    the budget is refilled with cores threads once no samples are running
+    :return: dictionary of samplename -> runsample return code for the samples
+        that were run
+    '''
+    if not isdir( projdir ):
+        os.makedirs( projdir )
+    todo = []
+    results = {}
+    for sample, reference in samples:
+        status = sample_status( join( projdir, sample ) )
+        if status == 'done' and not resume:
+            logger.info( "Skipping {0} because it already finished".format(sample) )
+            continue
+        todo.append( (sample, reference, status != 'new') )
+
+    budgetdir = tempfile.mkdtemp( prefix='runsamplesheet' )
+    fifo = join( budgetdir, 'budget' )
+    # Kept open so the tokens stay in the fifo between samples
+    budget = stages.make_shared_budget( fifo, cores )
+    env = dict( os.environ )
+    env[stages.BUDGET_ENV] = fifo
+    running = {}
+    # A sample that was killed may not have given back the threads it held
+    lost = False
+    try:
+        while todo or running:
+            while todo and len(running) < max_samples:
+                sample, reference, started = todo.pop( 0 )
+                cmd = [
+                    'runsample', join(readsbysample, sample), reference, sample,
+                    '-od', join(projdir, sample), '--threads', str(cores)
+                ] + list(runsample_args)
+                if started:
+                    cmd.append( '--resume' )
+                logger.info( "Running {0}".format(' '.join(cmd)) )
+                running[sample] = subprocess.Popen( cmd, env=env )
+            time.sleep( POLL_INTERVAL )
+            for sample, p in running.items():
+                r = p.poll()
+                if r is None:
+                    continue
+                del running[sample]
+                results[sample] = r
+                if r != 0:
+                    logger.critical( "runsample for {0} exited with {1}".format(sample, r) )
+                else:
+                    logger.info( "Finished {0}".format(sample) )
+                if r < 0:
+                    lost = True
+            if lost and not running:
+                logger.info( "Refilling the thread budget after a sample was killed" )
+                budget.reset( cores )
+                lost = False
+    finally:
+        os.close( budget.fd )
+        shutil.rmtree( budgetdir )
+    return results
+
+def stage_times( logfile ):
+    '''
+    :param str logfile: runsample log of a sample
+    :return: list of (stage, seconds) for every stage that finished
+    '''
+    p = r'Finished stage (\S+) in ([\d.]+) seconds'
+    with open( logfile ) as fh:
+        return [(stage, float(secs)) for stage, secs in re.findall( p, fh.read() )]
+
+def stage_throughput( outdirs ):
+    '''
+    Summarize how long every stage took in the finished samples of outdirs
+
+    :param list outdirs: runsample output directories
+    :return: list of (stage, samples, total seconds, mean seconds, samples per hour)
+        in the order the stages first finished
+    '''
+    times = {}
+    order = []
+    for outdir in outdirs:
+        sample = os.path.basename( outdir.rstrip( os.sep ) )
+        for stage, secs in stage_times( join(outdir, sample + '.log') ):
+            if stage not in times:
+                times[stage] = []
+                order.append( stage )
+            times[stage].append( secs )
+    report = []
+    for stage in order:
+        n, total = len(times[stage]), sum(times[stage])
+        mean = total / n
+        report.append( (stage, n, total, mean, 3600.0 / mean if mean else float('inf')) )
+    return report
+
+def write_throughput( report, outfile ):
+    '''
+    Write and log the stage_throughput report as tab separated lines
+    '''
+    header = ('stage', 'samples', 'total_seconds', 'mean_seconds', 'samples_per_hour')
+    with open( outfile, 'w' ) as fh:
+        fh.write( '\t'.join(header) + '\n' )
+        for stage, n, total, mean, rate in report:
+            line = '{0}\t{1}\t{2:.1f}\t{3:.1f}\t{4:.2f}'.format(stage, n, total, mean, rate)
+            fh.write( line + '\n' )
+            logger.info( line )
+
+def parse_args( args=sys.argv[1:] ):
+    from ngs_mapper import config
+    conf_parser, args, config, configfile = config.get_config_argparse(args)
+    defaults = config['runsamplesheet']
+
+    parser = argparse.ArgumentParser(
+        parents=[conf_parser],
+        description='Runs runsample on every sample/reference pair in a samplesheet. ' \
+            'Any option that is not listed here is passed on to runsample'
+    )
+
+    parser.add_argument(
+        dest='readsbysample',
+        help='Directory that holds all reads by sample'
+    )
+
+    parser.add_argument(
+        dest='samplesheet',
+        help='Space or tab delimited file with samplename reference one per line'
+    )
+
+    parser.add_argument(
+        '-od',
+        '--projdir',
+        dest='projdir',
+        default=defaults['projdir']['default'],
+        help=defaults['projdir']['help']
+    )
+
+    parser.add_argument(
+        '--cores',
+        dest='cores',
+        type=int,
+        default=defaults['cores']['default'],
+        help=defaults['cores']['help']
+    )
+
+    parser.add_argument(
+        '--memory',
+        dest='memory',
+        type=int,
+        default=defaults['memory']['default'],
+        help=defaults['memory']['help']
+    )
+
+    parser.add_argument(
+        '--sample-memory',
+        dest='sample_memory',
+        type=int,
+        default=defaults['sample_memory']['default'],
+        help=defaults['sample_memory']['help']
+    )
+
+    parser.add_argument(
+        '--resume',
+        dest='resume',
+        action='store_true',
+        default=False,
+        help='Resume samples that already finished too, so only their stages that are out of date run again'
+    )
+
+    args, rest = parser.parse_known_args( args )
+    args.config = configfile
+    return args, rest
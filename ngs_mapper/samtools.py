@@ -1,7 +1,23 @@
 from subprocess import Popen, PIPE
+import os
 import numpy as np
 import itertools
 import re
+import string
+import zlib
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+# Backends that mpileup can use to generate pileup columns
+PILEUP_BACKENDS = ('samtools','pysam')
+
+# Highest quality samtools writes in a pileup(~ in phred + 33)
+MAX_QUAL = 93
+# The quality of every bin of a quality histogram(see qual_hist)
+QUALS = np.arange( MAX_QUAL + 1 )
 
 def view( infile, *args, **kwargs ):
     '''
@@ -48,16 +64,21 @@ class Prop(object):
     '''
     Defines a property that auto converts the value
     to the defined type
+
+    The converted value is stored in the attribute called name which
+    can be a __slots__ entry, but must not be the name of the Prop itself
     '''
     def __init__( self, name, type=int ):
         self.name = name
         self.type = type
 
     def __get__( self, obj, objtype ):
-        return obj.__dict__[self.name]
+        if obj is None:
+            return self
+        return getattr( obj, self.name )
 
     def __set__( self, obj, val ):
-        obj.__dict__[self.name] = self.type(val)
+        setattr( obj, self.name, self.type(val) )
 
 class SamRow(object):
     '''
@@ -67,11 +88,15 @@ class SamRow(object):
 
     @param samrow_str - Sam row string
     '''
-    FLAG = Prop( 'FLAG', int )
-    MAPQ = Prop( 'MAPQ', int )
-    POS = Prop( 'POS', int )
-    TLEN = Prop( 'TLEN', int )
-    PNEXT = Prop( 'PNEXT', int )
+    __slots__ = (
+        'QNAME', '_FLAG', 'RNAME', '_POS', '_MAPQ', 'CIGAR',
+        'RNEXT', '_PNEXT', '_TLEN', 'SEQ', '_qual', '_tags'
+    )
+    FLAG = Prop( '_FLAG', int )
+    MAPQ = Prop( '_MAPQ', int )
+    POS = Prop( '_POS', int )
+    TLEN = Prop( '_TLEN', int )
+    PNEXT = Prop( '_PNEXT', int )
 
     def __init__( self, samrow_str ):
         # Only split up to 11 times. The last element will be all the tags if they are there at all
@@ -116,29 +141,49 @@ class SamRow(object):
         '''
         Returns the quality scores as a list of integers
         '''
-        return [char_to_qual(c) for c in self._qual]
+        return self.qual_array.tolist()
+
+    @property
+    def qual_array( self ):
+        '''
+        Returns the quality scores as a numpy array of phred - 33 integers
+        '''
+        return np.frombuffer( self._qual, dtype=np.uint8 ) - 33
 
     def __str__( self ):
-        s = '{QNAME}\t{FLAG}\t{RNAME}\t{POS}\t{MAPQ}\t{CIGAR}\t{RNEXT}' \
-                '\t{PNEXT}\t{TLEN}\t{SEQ}\t{_qual}'.format(**self.__dict__)
+        s = '\t'.join( (
+            self.QNAME, str(self._FLAG), self.RNAME, str(self._POS), str(self._MAPQ), self.CIGAR,
+            self.RNEXT, str(self._PNEXT), str(self._TLEN), self.SEQ, self._qual
+        ) )
         if self._tags:
             s += '\t'+self._tags
         return s
 
-def mpileup( bamfile, regionstr=None, minmq=20, minbq=25, maxd=100000 ):
+def mpileup( bamfile, regionstr=None, minmq=20, minbq=25, maxd=100000, backend='samtools' ):
     '''
     A simple  wrapper around the samtools mpileup command to ensure that
     samtools mpileup is called the way we would expect for MPilupColumn to work
 
+    If backend is pysam then the indexed bam file is read in-process through htslib
+    and BamPileupColumn objects are yielded instead of mpileup text lines.
+    Use pileup_column to get an MPileupColumn from either kind of item.
+
     @param bamfile - path to a bam file
     @param regionstr - Region string acceptable to the -r option for mpileup. If None is provided,
     then the same output as not specifying the -r option to mpileup is expected
     @param minmq - Minimum mapping qualty threshold. Same as -q option to mpileup
     @param minbq - Minimum base quality or min BAQ. Same as -Q option to mpileup
     @param maxd - Maximum depth to consider. Same as -d option to mpileup
+    @param backend - One of PILEUP_BACKENDS
 
     @returns file like object representing the output of mpileup
     '''
+    if backend == 'pysam':
+        return pysam_mpileup( bamfile, regionstr, minmq, minbq, maxd )
+    elif backend != 'samtools':
+        raise ValueError( '{0} is not a valid pileup backend. Choose from {1}'.format(
+            backend, PILEUP_BACKENDS
+        ))
     # The command that will be executed
     cmd = ['samtools','mpileup','-s','-q',str(minmq),'-Q',str(minbq),'-d','{0}'.format(maxd)]
     # Only include -r if regionstr is set
@@ -152,19 +197,107 @@ def mpileup( bamfile, regionstr=None, minmq=20, minbq=25, maxd=100000 ):
     # Return the stdout file descriptor handle so it can be easily iterated
     return p.stdout
 
+def idxstats( bamfile ):
+    '''
+    A simple wrapper around samtools idxstats
+
+    @param bamfile - path to an indexed bam file
+
+    @returns list of (refname, reflength, mapped, unmapped) tuples
+    '''
+    cmd = ['samtools','idxstats',bamfile]
+    p = Popen( cmd, stdout=PIPE, stderr=open('/dev/null','w') )
+    stats = []
+    for line in p.stdout:
+        refname, reflen, mapped, unmapped = line.rstrip('\n').split('\t')
+        stats.append( (refname, int(reflen), int(mapped), int(unmapped)) )
+    p.wait()
+    return stats
+
+def faidx( fasta ):
+    '''
+    A simple wrapper around samtools faidx that indexes a fasta file
+
+    @param fasta - path to fasta file
+
+    @returns path to the .fai index
+    '''
+    cmd = ['samtools','faidx',fasta]
+    p = Popen( cmd, stderr=PIPE )
+    _, err = p.communicate()
+    fai = fasta + '.fai'
+    # Older samtools exit 0 even when they cannot index the fasta
+    if p.returncode != 0 or not os.path.exists( fai ):
+        raise ValueError( "samtools faidx failed on {0}: {1}".format(fasta, err) )
+    return fai
+
+def pysam_mpileup( bamfile, regionstr=None, minmq=20, minbq=25, maxd=100000 ):
+    '''
+    Generates BamPileupColumn objects for an indexed bam file using pysam
+    The reads are filtered the same way samtools mpileup filters them(unmapped, secondary,
+    qcfail, duplicate and orphan reads are skipped, no BAQ and no overlap detection)
+
+    Parameters are the same as mpileup
+
+    @returns generator of BamPileupColumn
+    '''
+    if pysam is None:
+        raise ImportError( 'pysam is required for the pysam pileup backend' )
+    bam = pysam.AlignmentFile( bamfile )
+    try:
+        piles = bam.pileup(
+            region=regionstr or None, truncate=True, stepper='samtools',
+            ignore_orphans=True, ignore_overlaps=False, compute_baq=False,
+            min_base_quality=int(minbq), min_mapping_quality=int(minmq), max_depth=int(maxd)
+        )
+        for pcol in piles:
+            yield BamPileupColumn.from_pysam( pcol )
+    finally:
+        bam.close()
+
+def pileup_column( pile ):
+    '''
+    Returns an MPileupColumn for an item yielded by mpileup or nogap_mpileup
+    regardless of which backend generated it
+
+    @param pile - mpileup string or MPileupColumn
+
+    @returns MPileupColumn
+    '''
+    if isinstance( pile, MPileupColumn ):
+        return pile
+    return MPileupColumn( pile )
+
+def fan_out( piles, consumers ):
+    '''
+    Hands every pileup column to each consumer so that a single pileup pass can
+    feed multiple consumers at the same time
+
+    @param piles - Iterable of items from mpileup or nogap_mpileup
+    @param consumers - Objects that have an add(MPileupColumn) method
+
+    @returns generator of MPileupColumn after all consumers have seen it
+    '''
+    for pile in piles:
+        col = pileup_column( pile )
+        for consumer in consumers:
+            consumer.add( col )
+        yield col
+
 def nogap_mpileup(*args, **kwargs):
     '''
     Wrapper around mpileup that fills in missing positions with 0 depth
     Arguments are the same as mplileup
+    Filled in positions are always mpileup strings
 
     Returns a generator of mpileup rows
     '''
     lastref = None
     lastpos = 0
     for pile in mpileup(*args, **kwargs):
-        col = pile.split('\t')
-        refname = col[0]
-        pos = int(col[1])
+        col = pileup_column(pile)
+        refname = col.ref
+        pos = col.pos
         # First iteration
         if lastref is None:
             lastref = refname
@@ -193,6 +326,117 @@ def char_to_qual( qual_char ):
     '''
     return ord( qual_char ) - 33
 
+def qual_hist( quals ):
+    '''
+    Counts how many times every quality from 0 to MAX_QUAL is in quals
+    Qualities above MAX_QUAL are counted as MAX_QUAL just like samtools caps them at ~
+
+    @param quals - Iterable of integer qualities
+
+    @returns numpy int array of length MAX_QUAL + 1
+    '''
+    quals = np.minimum( np.asarray( quals, dtype=np.int64 ), MAX_QUAL )
+    return np.bincount( quals, minlength=MAX_QUAL + 1 )
+
+def hist_count( hist ):
+    ''' Returns how many qualities are in a qual_hist '''
+    return int( hist.sum() )
+
+def hist_sum( hist ):
+    ''' Returns the sum of all qualities in a qual_hist '''
+    return int( np.dot( hist, QUALS ) )
+
+def base_hists( bases, quals ):
+    '''
+    Builds a qual_hist for every different base in a pileup column at once
+
+    @param bases - numpy array of base ascii codes
+    @param quals - numpy array of qualities that line up with bases
+
+    @returns tuple(codes, first, hists) where codes are the ascii codes of the bases in
+        the order they first appear in bases, first is the index of that first appearance
+        and hists is a len(codes) x (MAX_QUAL + 1) array of quality counts
+    '''
+    width = MAX_QUAL + 1
+    if not len(bases):
+        empty = np.zeros( 0, dtype=np.int64 )
+        return empty, empty, np.zeros( (0, width), dtype=np.int64 )
+    uniq, first, inverse = np.unique( bases, return_index=True, return_inverse=True )
+    order = np.argsort( first )
+    # Histogram row of each unique base
+    rows = np.empty( len(uniq), dtype=np.int64 )
+    rows[order] = np.arange( len(uniq) )
+    quals = np.minimum( quals, MAX_QUAL ).astype( np.int64 )
+    hists = np.bincount( rows[inverse.ravel()] * width + quals, minlength=len(uniq) * width )
+    return uniq[order], first[order], hists.reshape( len(uniq), width )
+
+# Read starts(^ and the mapping quality character after it) and read ends($)
+# in an mpileup base string
+MPILEUP_ENDS = re.compile( r'\^.|\$', re.DOTALL )
+# Indels in an mpileup base string(+ or - and the length of the inserted/deleted
+# bases that follow)
+MPILEUP_INDEL = re.compile( r'([+-])([0-9]*)' )
+
+# refbase -> translate table that uppercases bases and turns ./, into refbase
+_BASE_TABLES = {}
+
+def base_table( refbase ):
+    '''
+    Returns the str.translate table that cleans mpileup bases for a reference base
+
+    @param refbase - Reference base that . and , match
+
+    @returns translate table string or None if refbase is not a single base
+    '''
+    try:
+        return _BASE_TABLES[refbase]
+    except KeyError:
+        if len(refbase) != 1:
+            return None
+        table = string.maketrans( 'acgtn.,', 'ACGTN' + refbase * 2 )
+        _BASE_TABLES[refbase] = table
+        return table
+
+def parse_bases( bases, refbase ):
+    '''
+    Parses an mpileup base string
+
+    Read starts and ends are removed in one regular expression substitution so
+    only indels are stepped through one at a time
+
+    @param bases - Base string from mpileup(5th column)
+    @param refbase - Reference base to replace . and , with
+
+    @returns tuple(cleaned bases, [(+ or -, indel bases),...])
+    '''
+    # Indel bases never contain ^ or $ so they can be removed first
+    bases = MPILEUP_ENDS.sub( '', bases )
+    indels = []
+    if '+' in bases or '-' in bases:
+        parts = []
+        i = 0
+        while True:
+            m = MPILEUP_INDEL.search( bases, i )
+            if m is None:
+                parts.append( bases[i:] )
+                break
+            parts.append( bases[i:m.start()] )
+            i = m.end()
+            if m.group(2):
+                # Skip over the inserted/deleted bases
+                n = int( m.group(2) )
+                indels.append( (m.group(1), bases[i:i+n]) )
+                i += n
+        cleaned = ''.join( parts )
+    else:
+        cleaned = bases
+    table = base_table( refbase )
+    if table is None:
+        cleaned = cleaned.upper().replace( '.', refbase ).replace( ',', refbase )
+    else:
+        cleaned = cleaned.translate( table )
+    return cleaned, indels
+
 class MPileupColumn(object):
     '''
     Represents a single Mpileup column
@@ -204,11 +448,18 @@ class MPileupColumn(object):
     It is assumed that minimum base quality and mapping quality have already been applied to the mpileup string that is 
     provided to the constructor.
 
+    The base string is only parsed once(see parse_bases) and the base quality array is only built once
+
     @param mpileup_str - Mpileup string
     '''
-    _bases = ''
-    _mquals = ''
-    _bquals = ''
+    __slots__ = (
+        'ref', '_pos', 'refbase', '_depth', '_bases', '_bquals', '_mquals',
+        '_parsed', '_bqual_array'
+    )
+    # Depth and position are integers
+    depth = Prop( '_depth', int )
+    pos = Prop( '_pos', int )
+
     def __init__( self, mpileup_str ):
         parts = mpileup_str.rstrip('\n').split('\t')
         if len(parts) == 7:
@@ -216,24 +467,14 @@ class MPileupColumn(object):
         else:
             self.ref,self.pos,self.refbase,self.depth,self._bases,self._bquals = parts
             self._mquals = ''
+        self._parsed = None
+        self._bqual_array = None
 
-    @property
-    def depth( self ):
-        return self.__dict__['depth']
-    
-    @depth.setter
-    def depth( self, value ):
-        ''' Depth is an integer '''
-        self.__dict__['depth'] = int(value)
-
-    @property
-    def pos( self ):
-        return self.__dict__['pos']
-    
-    @pos.setter
-    def pos( self, value ):
-        ''' Position is an integer '''
-        self.__dict__['pos'] = int(value)
+    def _parse( self ):
+        ''' Returns the cached parse_bases result '''
+        if self._parsed is None:
+            self._parsed = parse_bases( self._bases, self.refbase )
+        return self._parsed
 
     @property
     def bases( self ):
@@ -242,53 +483,22 @@ class MPileupColumn(object):
             This means it returns just the bases that are really of interest.
             it also includes the * which indicates a deletion.
         '''
-        # Will contain the cleaned base
-        cleaned = ''
-        # The counter
-        i = 0
-        # Iterate every position
-        while i < len( self._bases ):
-            x = self._bases[i]
-            # Just skip - and +
-            if x in '-+$':
-                i += 1
-                continue
-            # Skip this position and the next quality scores
-            if x == '^':
-                i += 2
-                continue
-            # Add any normal base, but make it uppercase
-            if x.upper() in ('ACTGN*'):
-                cleaned += x.upper()
-                i += 1
-            # . and , mean a match to the reference base
-            elif x in ('.,'):
-                cleaned += self.refbase
-                i += 1
-            # We are on an indel number now so can just skip them
-            else:
-                try:
-                    # Build the integer that will tell us how many
-                    # indel bases to skip
-                    n = ''
-                    while True:
-                        # Just try it if it fails the try except will grab it
-                        int(x)
-                        n += x
-                        # Increment i
-                        i += 1
-                        # Get new base
-                        x = self._bases[i]
-                except ValueError as e:
-                    i += int( n )
-        return cleaned
+        return self._parse()[0]
+
+    @property
+    def indels( self ):
+        '''
+            Returns the insertions and deletions that start after this position
+            as a list of (+ or -, bases) tuples
+        '''
+        return self._parse()[1]
 
     @property
     def bquals( self ):
         '''
             Returns the base qualities as a phred - 33 integer
         '''
-        return map(char_to_qual, self._bquals)
+        return self.bqual_array.tolist()
 
     @property
     def mquals( self ):
@@ -301,15 +511,49 @@ class MPileupColumn(object):
             all the values are not the same since there would be no way to tell what qual values
             match what bases.
         '''
+        return (np.frombuffer( self._mqual_str(), dtype=np.uint8 ) - 33).tolist()
+
+    def _mqual_str( self ):
+        ''' Returns the mapping quality string that lines up with the base qualities or '' '''
         # Check to make sure map qual len is same as base qual length
         if len(self._bquals) == len(self._mquals):
-            return map(char_to_qual, self._mquals)
+            return self._mquals
         # Otherwise we can only proceed if all items are the same
         elif len(set(self._mquals)) == 1:
-            l = len(self._bquals)
-            return map(char_to_qual, self._mquals[:l])
+            return self._mquals[:len(self._bquals)]
+        return ''
+
+    @property
+    def base_array( self ):
+        ''' Returns the cleaned bases as a numpy array of ascii codes '''
+        return np.frombuffer( self.bases, dtype=np.uint8 )
+
+    @property
+    def bqual_array( self ):
+        ''' Returns the base qualities as a read only numpy array of phred - 33 integers '''
+        if self._bqual_array is None:
+            self._bqual_array = np.frombuffer( self._bquals, dtype=np.uint8 ) - 33
+            self._bqual_array.flags.writeable = False
+        return self._bqual_array
+
+    def take( self, keep ):
+        '''
+        Returns a BamPileupColumn with only some of the bases of this column
+
+        Only the picked base and mapping qualities are converted. Mapping qualities are
+        0 if they are unknown
+
+        @param keep - numpy array of the indexes of the bases to keep
+
+        @returns BamPileupColumn
+        '''
+        bquals = np.frombuffer( self._bquals, dtype=np.uint8 )[keep] - 33
+        mquals = self._mqual_str()
+        if mquals:
+            mquals = np.frombuffer( mquals, dtype=np.uint8 )[keep] - 33
         else:
-            return []
+            mquals = np.zeros( len(keep), dtype=np.uint8 )
+        return BamPileupColumn( self.ref, self.pos, self.base_array[keep], bquals, mquals )
 
     def bqual_avg( self ):
         ''' Returns the mean of the base qualities rounded to 2 places '''
@@ -335,31 +579,152 @@ class MPileupColumn(object):
             * bqualsum: sum of the base qualities
             * mqualsum: sum of the mapping qualities
             * 'A/C/T/G/N/\*': dictionary of information about the mapping and base qualities for an individual base
-                * mapq: list of all the mapping qualities for this base(int(phred - 33))
-                * baseq: list of all the base qualities for this base(int(phred - 333))
+                * mapq: qual_hist of the mapping qualities for this base
+                * baseq: qual_hist of the base qualities for this base
+                * firstq: base quality of the first time this base is in the column
+
+        Bases are added in the order they first appear in the column and take the same
+        amount of memory no matter how deep the column is
 
         @returns the stats dictionary
         '''
-        bquals = self.bquals
-        mquals = self.mquals
-        bases = self.bases
-        bqualsum = float( sum( bquals ) )
-        mqualsum = float( sum( mquals ) )
+        bases = self.base_array
+        bquals = self.bqual_array
+        mquals = np.array( self.mquals, dtype=np.int64 )
         # Lets just make sure of a few things because samtools mpileup isn't exactly documented the best
         assert len(bquals) == self.depth, "Somehow length of bases != length of Base Qualities"
-        depth = self.depth
-        stats = {'depth':depth,'mqualsum':mqualsum,'bqualsum':bqualsum}
-        for b,bq,mq in itertools.izip_longest( bases, bquals, mquals, fillvalue=0 ):
-            if b not in stats:
-                stats[b] = {'baseq':[],'mapq':[]}
-            stats[b]['baseq'].append(bq)
-            stats[b]['mapq'].append(mq)
-
+        if len(mquals) != len(bquals):
+            # Mapping qualities are unknown
+            mquals = np.zeros( len(bquals), dtype=np.int64 )
+        stats = {'depth':self.depth,'mqualsum':float( mquals.sum() ),'bqualsum':float( bquals.sum() )}
+        codes, first, bhists = base_hists( bases, bquals )
+        codes, first, mhists = base_hists( bases, mquals )
+        for code, i, bhist, mhist in itertools.izip( codes, first, bhists, mhists ):
+            stats[chr(code)] = {'baseq':bhist,'mapq':mhist,'firstq':int( bquals[i] )}
         return stats
 
     def __str__( self ):
         ''' Returns the mpileup string '''
-        return "{ref}\t{pos}\t{refbase}\t{depth}\t{_bases}\t{_bquals}\t{_mquals}".format(**self.__dict__)
+        return "{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}".format(
+            self.ref, self.pos, self.refbase, self.depth, self._bases, self._bquals, self._mquals
+        )
+
+class BamPileupColumn(MPileupColumn):
+    '''
+    MPileupColumn that is built from arrays instead of an mpileup string
+    The bases are already cleaned(deletions are \*) and uppercase so there is nothing to re-parse
+    There is no reference available so refbase is always N just like mpileup without -f
+    pysam does not report indels with the bases so indels is always empty
+
+    Mapping qualities always line up with the bases since they come from the same reads
+
+    @param ref - Reference name
+    @param pos - 1-based reference position
+    @param base_array - numpy uint8 array of base ascii codes
+    @param bqual_array - numpy uint8 array of phred - 33 base qualities
+    @param mqual_array - numpy uint8 array of mapping qualities
+    '''
+    __slots__ = ( '_base_array', '_mqual_array' )
+
+    def __init__( self, ref, pos, base_array, bqual_array, mqual_array ):
+        self.ref = ref
+        self.pos = pos
+        self.refbase = 'N'
+        self.depth = len(bqual_array)
+        self._bases = ''
+        self._bquals = ''
+        self._mquals = ''
+        self._parsed = None
+        self._base_array = base_array
+        self._bqual_array = bqual_array
+        self._mqual_array = mqual_array
+
+    @classmethod
+    def from_pysam( klass, pcol ):
+        '''
+        Build from a pysam.PileupColumn
+
+        @param pcol - pysam.PileupColumn
+
+        @returns BamPileupColumn
+        '''
+        # Deletions come back as empty strings
+        bases = ''.join( [b or '*' for b in pcol.get_query_sequences()] ).upper()
+        # samtools caps base and mapping quality characters at ~
+        bquals = np.minimum( pcol.get_query_qualities(), MAX_QUAL ).astype( np.uint8 )
+        mquals = np.minimum( pcol.get_mapping_qualities(), MAX_QUAL ).astype( np.uint8 )
+        return klass(
+            pcol.reference_name, pcol.reference_pos + 1,
+            np.frombuffer( bases, dtype=np.uint8 ), bquals, mquals
+        )
+
+    @property
+    def bases( self ):
+        return self._base_array.tostring()
+
+    @property
+    def base_array( self ):
+        return self._base_array
+
+    @property
+    def bqual_array( self ):
+        return self._bqual_array
+
+    @property
+    def bquals( self ):
+        return self._bqual_array.tolist()
+
+    @property
+    def mquals( self ):
+        return self._mqual_array.tolist()
+
+    def take( self, keep ):
+        return BamPileupColumn(
+            self.ref, self.pos, self._base_array[keep], self._bqual_array[keep], self._mqual_array[keep]
+        )
+
+    def __str__( self ):
+        ''' Returns the mpileup string '''
+        return "{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}".format(
+            self.ref, self.pos, self.refbase, self.depth, self.bases,
+            (self._bqual_array + 33).tostring(), (self._mqual_array + 33).tostring()
+        )
+
+def downsample_column( col, maxdepth, seed=0 ):
+    '''
+    Randomly picks maxdepth of the bases(without replacement) in a pileup column that is
+    deeper than maxdepth so the frequency of every base is kept while anything that works
+    on the column only has to look at maxdepth bases
+
+    The bases that are picked only depend on seed and the reference and position of the
+    column so the same column is always downsampled the same way no matter which
+    region or process it was piled up in
+
+    The picks are made from the depth of the column and only the picked qualities are
+    converted(see MPileupColumn.take). The base string of an mpileup line still has to
+    be cleaned as a whole(see parse_bases) to line the bases up with their qualities,
+    but that is done by regular expressions and str.translate, with only indels stepped
+    through in python
+
+    @param col - MPileupColumn
+    @param maxdepth - Most bases to keep
+    @param seed - Integer >= 0 to seed the random picks with
+
+    @returns col if it is not deeper than maxdepth, otherwise a BamPileupColumn with the
+        picked bases in the same order they are in col
+    '''
+    if col.depth <= maxdepth:
+        return col
+    rand = np.random.RandomState( [int(seed), col.pos, zlib.crc32( col.ref ) & 0xffffffff] )
+    if maxdepth * 2 > col.depth:
+        keep = np.sort( rand.choice( col.depth, maxdepth, replace=False ) )
+    else:
+        # Draw positions until there are maxdepth different ones instead of shuffling
+        # every position of the column
+        keep = np.unique( rand.randint( 0, col.depth, maxdepth ) )
+        while len(keep) < maxdepth:
+            keep = np.union1d( keep, rand.randint( 0, col.depth, maxdepth - len(keep) ) )
+    return col.take( keep )
 
 # Exception for when invalid region strings are given
 class InvalidRegionString(Exception): pass
@@ -0,0 +1,465 @@
+"""
+Runs the stages of a pipeline as a dependency graph
+
+Each :py:class:`Stage` names the stages it depends on and how many threads it
+uses. :py:func:`run_stages` starts every stage as soon as the stages it
+depends on have finished successfully and its threads fit in the cpu budget,
+so stages that do not depend on each other run at the same time.
+
+Stages that list their inputs and outputs can be checkpointed(see
+:py:class:`Checkpoints`) so running the same stages again only runs the ones
+whose command line, parameters or input files changed since they last finished.
+
+The budget can be shared between processes(:py:class:`SharedBudget`) so the
+stages of many samples run by :py:mod:`ngs_mapper.runsamplesheet` take their
+threads from the same pool.
+
+Used by :py:mod:`ngs_mapper.runsample`
+"""
+
+import os
+import math
+import time
+import errno
+import shutil
+import json
+import threading
+import Queue
+
+# Environment variable runsample looks in for the path to a SharedBudget fifo
+BUDGET_ENV = 'NGS_MAPPER_BUDGET'
+# Byte written to a SharedBudget fifo for every free thread
+TOKEN = '+'
+# Seconds between checks for free threads while a stage waits on a SharedBudget
+POLL_INTERVAL = 1
+# Wait in timed chunks so KeyboardInterrupt is delivered
+MAX_WAIT = 3600
+# Smallest part of its threads a stage starts with when it shares a SharedBudget
+MIN_SHARE = 0.5
+
+class Stage(object):
+    '''
+    A single step of a pipeline
+
+    Either cmd or func is given. cmd is a command line(or a function that
+    returns one when the stage starts) that is run with run_cmd. func is called
+    in its own thread and the stage fails if it raises.
+    '''
+    def __init__( self, name, cmd=None, func=None, deps=(), threads=1, stdout=None,
+            stderr=None, script_dir=None, fatal=False, inputs=(), outputs=(), params=None ):
+        '''
+        :param str name: Unique name of the stage
+        :param str|function cmd: Command line to run
+        :param function func: Python function to run instead of a command
+        :param list deps: Names of the stages that have to finish first
+        :param int threads: How many threads the stage uses
+        :param file|str stdout: File or path to write the command's stdout to.
+            None leaves the command on the same stdout as this process
+        :param file stderr: Where to write the command's stderr. None leaves the
+            command on the same stderr as this process
+        :param str script_dir: Passed on to run_cmd
+        :param bool fatal: Do not start any more stages if this one fails
+        :param list inputs: Files or directories the stage reads
+        :param list outputs: Files or directories the stage writes
+        :param params: Anything else(json serializable) the stage's result
+            depends on that is not in its command line
+        '''
+        if (cmd is None) == (func is None):
+            raise ValueError( "Stage {0} needs either a cmd or a func".format(name) )
+        self.name = name
+        self.cmd = cmd
+        self.func = func
+        self.deps = list(deps)
+        self.threads = threads
+        self.stdout = stdout
+        self.stderr = stderr
+        self.script_dir = script_dir
+        self.fatal = fatal
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params
+
+    def __repr__( self ):
+        return 'Stage({0})'.format(self.name)
+
+    def command( self ):
+        ''' The command line of the stage or the name of its function '''
+        if self.func is not None:
+            return self.func.__name__
+        if callable(self.cmd):
+            return self.cmd()
+        return self.cmd
+
+def stage_order( stages ):
+    '''
+    Order stages so every stage comes after the stages it depends on. Stages that
+    do not depend on each other keep the order they were given in
+
+    Raises ValueError if a stage depends on a stage that does not exist or the
+    dependencies have a cycle
+
+    :param list stages: Stage objects
+    :return: list of stages
+    '''
+    names = [s.name for s in stages]
+    if len(set(names)) != len(names):
+        raise ValueError( "Stage names are not unique: {0}".format(names) )
+    for s in stages:
+        missing = set(s.deps) - set(names)
+        if missing:
+            raise ValueError( "{0} depends on stages that do not exist: {1}".format(s.name, sorted(missing)) )
+    ordered, placed = [], set()
+    remaining = list(stages)
+    while remaining:
+        ready = [s for s in remaining if set(s.deps) <= placed]
+        if not ready:
+            raise ValueError( "Stages have a dependency cycle: {0}".format(remaining) )
+        ordered += ready
+        placed |= set(s.name for s in ready)
+        remaining = [s for s in remaining if s.name not in placed]
+    return ordered
+
+class ThreadBudget(object):
+    '''
+    Threads that stages in this process can use
+    '''
+    def __init__( self, threads ):
+        self.free = threads
+
+    def acquire( self, n ):
+        ''' Take n threads if they are free. Returns how many were taken(n or 0) '''
+        if n > self.free:
+            return 0
+        self.free -= n
+        return n
+
+    def release( self, n ):
+        self.free += n
+
+class SharedBudget(object):
+    '''
+    Threads shared by all processes that use the same token fifo
+
+    Every byte in the fifo is a thread that can be used. Threads are taken by
+    reading bytes out of it and given back by writing them again. The fifo is
+    created and filled by :py:func:`make_shared_budget`
+
+    Other processes take threads as soon as they are given back so a stage that
+    waited for all of its threads could wait forever behind smaller stages.
+    Stages start once MIN_SHARE of their threads are free instead. The command
+    still runs with all of its threads so the cpus can be oversubscribed by the
+    part that was not free.
+
+    Threads held by a process that is killed(SIGKILL) are never given back.
+    :py:func:`ngs_mapper.runsamplesheet.run_samplesheet` refills the fifo once
+    none of its samples are running
+    '''
+    def __init__( self, path ):
+        # Opened read/write so reading never blocks or sees end of file
+        self.fd = os.open( path, os.O_RDWR | os.O_NONBLOCK )
+
+    def acquire( self, n ):
+        '''
+        Take up to n threads if at least MIN_SHARE of them are free
+
+        :return: how many threads were taken(0 if not enough were free)
+        '''
+        got = self._take( n )
+        if got < max( 1, int( math.ceil( n * MIN_SHARE ) ) ):
+            # Do not hold on to part of what is needed while others wait too
+            self.release( got )
+            return 0
+        return got
+
+    def _take( self, n ):
+        ''' Read up to n tokens without waiting. Returns how many were read '''
+        try:
+            return len(os.read( self.fd, n ))
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            return 0
+
+    def release( self, n ):
+        if n:
+            os.write( self.fd, TOKEN * n )
+
+    def reset( self, threads ):
+        '''
+        Empty the fifo and fill it with threads tokens. Only safe when no other
+        process is holding any threads
+        '''
+        while self._take( 4096 ):
+            pass
+        self.release( threads )
+
+def make_shared_budget( path, threads ):
+    '''
+    Create the token fifo for a :py:class:`SharedBudget` at path with threads
+    tokens in it
+
+    :return: SharedBudget for path that keeps the fifo open
+    '''
+    os.mkfifo( path )
+    budget = SharedBudget( path )
+    budget.release( threads )
+    return budget
+
+def budget_from_env( threads ):
+    '''
+    SharedBudget for the fifo in the BUDGET_ENV environment variable or
+    ThreadBudget(threads) if it is not set
+    '''
+    path = os.environ.get( BUDGET_ENV )
+    if path:
+        return SharedBudget( path )
+    return ThreadBudget( threads )
+
+def path_signature( path ):
+    '''
+    Size and modification time of path or of every file under it if it is a
+    directory
+
+    :return: [size, mtime], sorted list of [relative path, size, mtime] or None
+        if path does not exist
+    '''
+    if os.path.isdir( path ):
+        sig = []
+        for root, dirs, files in os.walk( path ):
+            for f in files:
+                fp = os.path.join( root, f )
+                # Broken symlinks have no size or mtime
+                sig.append( [os.path.relpath(fp, path)] + (path_signature( fp ) or [None, None]) )
+        return sorted(sig)
+    if not os.path.exists( path ):
+        return None
+    st = os.stat( path )
+    return [st.st_size, st.st_mtime]
+
+def broken_links( path ):
+    '''
+    :return: True if there are symlinks under directory path that point to
+        something that does not exist(such as a directory that was moved)
+    '''
+    if not os.path.isdir( path ):
+        return False
+    for root, dirs, files in os.walk( path ):
+        for f in files:
+            if not os.path.exists( os.path.join( root, f ) ):
+                return True
+    return False
+
+def remove_paths( paths ):
+    '''
+    Remove every file or directory in paths that exists
+    '''
+    for path in paths:
+        if os.path.isdir( path ) and not os.path.islink( path ):
+            shutil.rmtree( path )
+        elif os.path.lexists( path ):
+            os.unlink( path )
+
+class Checkpoints(object):
+    '''
+    Manifest of the stages that finished inside of a directory
+
+    For every finished stage it keeps its command line, params, the signature
+    (path_signature) its inputs had when it started and the signature of its
+    outputs. A stage is up to date if all of those are still the same and its
+    outputs still exist(without broken symlinks in them). Paths inside of root
+    are kept relative to root so the directory can be moved between runs
+    '''
+    def __init__( self, manifest, root ):
+        '''
+        :param str manifest: Path to json manifest(created on first record)
+        :param str root: Directory the stages run in
+        '''
+        self.manifest = manifest
+        self.root = os.path.abspath( root )
+        self.stages = {}
+        if os.path.exists( manifest ):
+            with open( manifest ) as fh:
+                self.stages = json.load( fh )
+
+    def _rel( self, path ):
+        path = os.path.abspath( path )
+        if path.startswith( self.root + os.sep ):
+            return os.path.relpath( path, self.root )
+        return path
+
+    def signature( self, stage ):
+        '''
+        :return: what has to be the same as last time for stage to be up to date
+        '''
+        cmd = stage.command().replace( self.root, '{root}' )
+        sig = {
+            'command': cmd,
+            'params': stage.params,
+            'inputs': dict( (self._rel(p), path_signature(p)) for p in stage.inputs ),
+        }
+        # Compare the way it would be loaded back from the manifest
+        return json.loads( json.dumps( sig ) )
+
+    def is_current( self, stage, signature ):
+        '''
+        :param Stage stage: Stage to check
+        :param dict signature: signature(stage)
+        :return: True if stage finished before with the same signature and all
+            of its outputs still exist
+        '''
+        recorded = self.stages.get( stage.name )
+        if not recorded or not stage.outputs:
+            return False
+        for key in ('command', 'params', 'inputs'):
+            if recorded.get( key ) != signature[key]:
+                return False
+        return all( os.path.exists( p ) and not broken_links( p ) for p in stage.outputs )
+
+    def record( self, stage, signature ):
+        '''
+        Record that stage finished with signature
+        '''
+        entry = dict( signature )
+        entry['outputs'] = dict( (self._rel(p), path_signature(p)) for p in stage.outputs )
+        self.stages[stage.name] = entry
+        self.save()
+
+    def forget( self, name ):
+        '''
+        Forget that stage name ever finished so it runs next time
+        '''
+        if self.stages.pop( name, None ) is not None:
+            self.save()
+
+    def save( self ):
+        # Write then rename so a crash never leaves half of a manifest
+        tmp = self.manifest + '.tmp'
+        with open( tmp, 'w' ) as fh:
+            json.dump( self.stages, fh, indent=1, sort_keys=True )
+        os.rename( tmp, self.manifest )
+
+def run_stages( stages, cpus, run_cmd, logger, budget=None, checkpoints=None ):
+    '''
+    Run stages concurrently in dependency order without using more than cpus
+    threads at a time
+
+    A stage that needs more threads than cpus runs with nothing else. A stage
+    is skipped if any stage it depends on failed or was skipped. Once a fatal
+    stage fails no more stages are started but the running ones are waited on
+
+    :param list stages: Stage objects
+    :param int cpus: Most threads a single stage can use
+    :param function run_cmd: run_cmd(cmdstr, stdout=, stderr=, script_dir=) that
+        returns a Popen object
+    :param logging.Logger logger: Where to log stage progress
+    :param budget: ThreadBudget or SharedBudget the stage threads are taken
+        from[Default: ThreadBudget(cpus)]
+    :param Checkpoints checkpoints: Skip stages that are up to date, remove the
+        outputs of the ones that are not before they run and record the stages
+        that finish
+    :return: dictionary of stage name -> return code(None if it was skipped)
+    '''
+    cpus = max( 1, cpus )
+    if budget is None:
+        budget = ThreadBudget( cpus )
+    pending = stage_order( stages )
+    results = {}
+    running = {}
+    finished = Queue.Queue()
+    aborted = False
+    try:
+        while pending or running:
+            waiting = False
+            if not aborted:
+                for stage in list(pending):
+                    failed = [d for d in stage.deps if d in results and results[d] != 0]
+                    if failed:
+                        logger.critical( "Skipping {0} because {1} did not finish sucessfully".format(
+                            stage.name, ', '.join(failed) )
+                        )
+                        results[stage.name] = None
+                        pending.remove( stage )
+                        continue
+                    if not all( results.get(d) == 0 for d in stage.deps ):
+                        continue
+                    wanted = min( stage.threads, cpus )
+                    threads = budget.acquire( wanted )
+                    if not threads:
+                        waiting = True
+                        continue
+                    if threads < wanted:
+                        logger.debug( "Starting {0} with {1} of its {2} threads free".format(
+                            stage.name, threads, wanted )
+                        )
+                    pending.remove( stage )
+                    signature = None
+                    if checkpoints is not None:
+                        signature = checkpoints.signature( stage )
+                        if checkpoints.is_current( stage, signature ):
+                            budget.release( threads )
+                            logger.info( "Skipping {0} because it is up to date".format(stage.name) )
+                            results[stage.name] = 0
+                            continue
+                        # Anything it finished before is stale now
+                        checkpoints.forget( stage.name )
+                        remove_paths( stage.outputs )
+                    running[stage.name] = [stage, threads, time.time(), None, signature]
+                    running[stage.name][3] = _start( stage, run_cmd, finished, logger )
+            if not running and not waiting:
+                # Only stages that depend on skipped stages are left once aborted
+                for stage in pending:
+                    results[stage.name] = None
+                break
+            try:
+                # Threads used by other processes can free up at any time
+                name, returncode = finished.get( True, POLL_INTERVAL if waiting else MAX_WAIT )
+            except Queue.Empty:
+                continue
+            stage, threads, started, cmd, signature = running.pop( name )
+            budget.release( threads )
+            results[name] = returncode
+            if returncode != 0:
+                logger.critical( "{0} did not exit sucessfully".format(cmd) )
+                if stage.fatal:
+                    aborted = True
+            else:
+                logger.info( "Finished stage {0} in {1:.1f} seconds".format(name, time.time() - started) )
+                if checkpoints is not None:
+                    checkpoints.record( stage, signature )
+    finally:
+        # Only left over if something raised
+        for stage, threads, started, cmd, signature in running.values():
+            budget.release( threads )
+    return results
+
+def _start( stage, run_cmd, finished, logger ):
+    '''
+    Start stage and put (name, returncode) into finished once it is done
+
+    :return: the command line or function name of the stage
+    '''
+    cmd = stage.command()
+    if stage.func is not None:
+        def wait():
+            try:
+                stage.func()
+                r = 0
+            except Exception as e:
+                logger.exception( "{0} raised {1}".format(stage.name, e) )
+                r = 1
+            finished.put( (stage.name, r) )
+    else:
+        stdout = stage.stdout
+        if isinstance(stdout, basestring):
+            stdout = open( stdout, 'wb' )
+        p = run_cmd( cmd, stdout=stdout, stderr=stage.stderr, script_dir=stage.script_dir )
+        def wait():
+            r = p.wait()
+            if stdout is not stage.stdout:
+                stdout.close()
+            finished.put( (stage.name, r) )
+    logger.info( "Started {0}".format(stage.name) )
+    t = threading.Thread( target=wait, name=stage.name )
+    t.daemon = True
+    t.start()
+    return cmd
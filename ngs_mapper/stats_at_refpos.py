@@ -52,14 +52,17 @@ import sys
 import itertools
 from compat import OrderedDict
 from ngs_mapper import samtools
+from ngs_mapper import config
 
 def main():
     args = parse_args()
-    return stats_at_pos( args.bamfile, args.regionstr, args.minmq, args.minbq, args.maxd )
+    return stats_at_pos( args.bamfile, args.regionstr, args.minmq, args.minbq, args.maxd, args.pileup_backend )
 
 def parse_args(args=sys.argv[1:]):
+    conf_parser, args, _config, configfile = config.get_config_argparse(args)
     parser = argparse.ArgumentParser(
         description='''Gives stats about a given site in a bam file''',
+        parents=[conf_parser],
         epilog='''You might use this command to get a list of available reference 
 names to use for the regionstr. In the future there will be a list command for this
 but for now use this:                                                 
@@ -109,11 +112,19 @@ samtools idxstats <in.bam> | awk '!/^*/ {print $1}' | sort | uniq'''
         default=default_maxdepth,
         help='Maximum read depth at position to use[Default: %(default)s]'
     )
+
+    parser.add_argument(
+        '--pileup-backend',
+        dest='pileup_backend',
+        choices=samtools.PILEUP_BACKENDS,
+        default=_config['PILEUP_BACKEND'],
+        help='How to generate the pileup. pysam reads the indexed bam directly[Default: %(default)s]'
+    )
     
     return parser.parse_args(args)
 
-def stats_at_pos( bamfile, regionstr, minmq, minbq, maxd ):
-    base_stats = compile_stats( stats( bamfile, regionstr, minmq, minbq, maxd ) )
+def stats_at_pos( bamfile, regionstr, minmq, minbq, maxd, backend='samtools' ):
+    base_stats = compile_stats( stats( bamfile, regionstr, minmq, minbq, maxd, backend ) )
     print "Maximum Depth: {0}".format(maxd)
     print "Minumum Mapping Quality Threshold: {0}".format(minmq)
     print "Minumum Base Quality Threshold: {0}".format(minbq)
@@ -129,12 +140,12 @@ def stats_at_pos( bamfile, regionstr, minmq, minbq, maxd ):
 
     return base_stats
 
-def stats( bamfile, regionstr, minmq, minbq, maxd ):
-    out = samtools.mpileup( bamfile, regionstr, minmq, minbq, maxd )
+def stats( bamfile, regionstr, minmq, minbq, maxd, backend='samtools' ):
+    out = samtools.mpileup( bamfile, regionstr, minmq, minbq, maxd, backend )
     
     try:
         o = out.next()
-        col = samtools.MPileupColumn( o )
+        col = samtools.pileup_column( o )
         out.close()
         return col.base_stats()
     except StopIteration:
@@ -146,7 +157,7 @@ def stats( bamfile, regionstr, minmq, minbq, maxd ):
 
 def compile_stats( stats ):
     '''
-        @param stats - {'depth': 0, 'mqualsum': 0, 'bqualsum': 0, 'ATGCN*..': [quals]} depth is total depth at a position and qualsum is sum of all quality scores bqualsum is read quality sums ATGCN* will be keys for each base seen and the list of quality scores for them
+        @param stats - {'depth': 0, 'mqualsum': 0, 'bqualsum': 0, 'ATGCN*..': {'mapq': hist, 'baseq': hist}} depth is total depth at a position and qualsum is sum of all quality scores bqualsum is read quality sums ATGCN* will be keys for each base seen and the samtools.qual_hist of their quality scores
         @return - Dictionary of stats at each base and overall stats {'Bases': {'A': [quals], 'depth': 0, 'avgqual': 0.0}}
     '''
     if stats['depth'] == 0:
@@ -168,10 +179,11 @@ def compile_stats( stats ):
                 base_stats['Bases'][base] = {}
             mquals = quals['mapq']
             bquals = quals['baseq']
-            base_stats['Bases'][base]['Depth'] = len(mquals)
-            base_stats['Bases'][base]['AvgMapQ'] = round(float(sum(mquals))/len(mquals),2)
-            base_stats['Bases'][base]['AvgBaseQ'] = round(float(sum(bquals))/len(bquals),2)
-            base_stats['Bases'][base]['PctTotal'] = round((float(len(mquals))/stats['depth'])*100,2)
+            depth = samtools.hist_count(bquals)
+            base_stats['Bases'][base]['Depth'] = depth
+            base_stats['Bases'][base]['AvgMapQ'] = round(float(samtools.hist_sum(mquals))/depth,2)
+            base_stats['Bases'][base]['AvgBaseQ'] = round(float(samtools.hist_sum(bquals))/depth,2)
+            base_stats['Bases'][base]['PctTotal'] = round((float(depth)/stats['depth'])*100,2)
 
     # Quit out of loop we are done
     # Order bases by PctTotal, then AvgBaseQ descending
@@ -4,6 +4,8 @@ import samtools
 import re
 import shutil
 import os.path
+import string
+from subprocess import Popen, PIPE, CalledProcessError
 from ngs_mapper.bam import sortbam, indexbam
 
 import log
@@ -25,6 +27,18 @@ ID_MAP = (
     re.compile( 'M[0-9]{5}:\d+:[\w\d-]+:\d:\d{4}:\d{4,5}:\d{4,5}' ),
     re.compile( '.*' )
 )
+# Collapses a read name to the character classes that ID_MAP patterns can tell apart
+# digits -> 0, uppercase letters other than M -> A, lowercase letters -> a
+# so all read names from the same run share a shape and match the same pattern
+NAME_SHAPE = string.maketrans(
+    string.digits + string.ascii_uppercase.replace('M','') + string.ascii_lowercase,
+    '0' * 10 + 'A' * 25 + 'a' * 26
+)
+# Read name shape -> read group id
+_RG_CACHE = {}
+# Most shapes to remember before starting over
+RG_CACHE_SIZE = 10000
+
 # Read Group Template
 RG_TEMPLATE = {
     'SM': None,
@@ -87,62 +101,107 @@ def tag_reads( bam, hdr ):
         Sets header of bam and tags all reads appropriately for each platform
         Overwrites existing header
         
+        Reads are streamed from bam through samtools view straight into a new bam
+        so no intermediate sam file is written. Tagging does not move reads so if they
+        were already in coordinate order the new bam just replaces bam, otherwise it is
+        sorted into bam.
+
         @param bam - Bam file to tag reads in
         @param hdr - Header string to set in the bam(needs newline at the end)
     '''
+    # Reference order the reads need to be in to be sorted. Unmapped reads are last
+    refs = [
+        field[3:] for line in hdr.splitlines() if line.startswith('@SQ\t')
+        for field in line.split('\t') if field.startswith('SN:')
+    ]
+    refindex = dict( (ref, i) for i, ref in enumerate( refs ) )
     # Open the existing bam to fetch the reads to modify from
     untagged_bam = samtools.view( bam )
-    # Open a file to write the sam output to with the tagged reads
-    samf = bam.replace('.bam','.sam')
-    with open( samf, 'w' ) as sam:
-        # Write the hdr to the file first
-        sam.write( hdr )
-        # Tag the reads
-        logger.info( "Tagging reads for {0}".format(bam) )
+    # Tagged reads are converted back to bam as they are written
+    tmpbam = bam + '.tagged.bam'
+    cmd = ['samtools','view','-bS','-o',tmpbam,'-']
+    p = Popen( cmd, stdin=PIPE )
+    logger.info( "Tagging reads for {0}".format(bam) )
+    is_sorted = True
+    lastkey = (-1, 0)
+    try:
+        # Write the hdr first
+        p.stdin.write( hdr )
         for read in untagged_bam:
             samrow = samtools.SamRow(read)
+            key = (refindex.get( samrow.RNAME, len(refs) ), samrow.POS)
+            if key < lastkey:
+                is_sorted = False
+            lastkey = key
             read = tag_readgroup( samrow )
-            sam.write( str(read) + '\n' )
-    # Close stdout
-    untagged_bam.close()
+            p.stdin.write( str(read) + '\n' )
+    finally:
+        # Close stdout
+        untagged_bam.close()
+        p.stdin.close()
+        ret = p.wait()
+    if ret != 0:
+        if os.path.exists( tmpbam ):
+            os.unlink( tmpbam )
+        raise CalledProcessError( ret, ' '.join(cmd) )
     logger.info( "Finished tagging reads for {0}".format(bam) )
-    logger.info( "Sorting {0}".format(bam) )
-    b = samtools.view( samf, h=True, S=True, b=True )
-    sortbam( b, bam )
-    # Close the fh
-    b.close()
-    # Remove temp sam file
-    # maybe some day could even just use pipes all the way through :)
-    os.unlink( samf )
+    if is_sorted:
+        logger.info( "{0} is already sorted".format(bam) )
+        os.rename( tmpbam, bam )
+    else:
+        logger.info( "Sorting {0}".format(bam) )
+        sortbam( tmpbam, bam )
+        os.unlink( tmpbam )
     logger.info( "Indexing {0}".format(bam) )
     indexbam( bam )
 
 def get_rg_for_read( aread ):
-    ''' Gets the read group name for the given samtools.SamRow '''
+    '''
+        Gets the read group name for the given samtools.SamRow
+        The decision is cached for every read name shape(see NAME_SHAPE)
+    '''
     rname = aread.QNAME
+    shape = rname.translate( NAME_SHAPE )
+    try:
+        return _RG_CACHE[shape]
+    except KeyError:
+        pass
     for i, p in enumerate( ID_MAP ):
         if p.match( rname ):
+            if len( _RG_CACHE ) >= RG_CACHE_SIZE:
+                _RG_CACHE.clear()
+            _RG_CACHE[shape] = IDS[i]
             return IDS[i]
     raise UnknownReadNameFormat( "{0} is from an unknown platform and cannot be tagged".format(rname) )
 
+def rg_line( id, SM, CN=None ):
+    '''
+        Builds the @RG header line for one of the read groups in IDS
+
+        @param id - Read group id from IDS
+        @param SM - Sample name
+        @param CN - Sequencing center or None to leave it out
+
+        @returns @RG header line without a newline
+    '''
+    pl = PLATFORMS[IDS.index( id )]
+    rg = '@RG\tID:{0}\tSM:{1}\t'.format( id, SM )
+    if CN is not None:
+        rg += 'CN:{0}\t'.format( CN )
+    return rg + 'PL:{0}'.format( pl )
+
 def get_rg_headers( bam, SM=None, CN=None ):
     old_header = get_bam_header( bam ) + '\n'
 
-    for id, pl in zip( IDS, PLATFORMS ):
+    for id in IDS:
         # Skip headers that exist already
         if 'ID:{0}\t'.format(id) in old_header:
             continue
 
-        rg = '@RG\tID:{0}\tSM:{1}\t'
         if SM is None:
             SM = os.path.basename(bam).replace( '.bam', '' )
 
-        if CN is not None:
-            rg += 'CN:{2}\tPL:{3}'
-            old_header += rg.format( id, SM, CN, pl ) + '\n'
-        else:
-            rg += 'PL:{2}'
-            old_header += rg.format( id, SM, pl ) + '\n'
+        old_header += rg_line( id, SM, CN ) + '\n'
 
     return old_header
 
@@ -38,6 +38,16 @@ class TestUnitMergeBam(Base):
         else:
             assert False, "Did not raise ValueError with non list item as argument for sortedbams"
 
+    def test_header_file(self, popen_mock):
+        files = ['in'+str(i) for i in range(1,3)]
+        res = self._C( files, 'merged.bam', 'header.sam' )
+        eq_( [call(['samtools','merge','-h','header.sam','merged.bam']+files)], popen_mock.call_args_list )
+
+    def test_threads(self, popen_mock):
+        files = ['in'+str(i) for i in range(1,3)]
+        res = self._C( files, 'merged.bam', threads=4 )
+        eq_( [call(['samtools','merge','-@','4','merged.bam']+files)], popen_mock.call_args_list )
+
 @patch('ngs_mapper.bam.subprocess.Popen')
 class TestUnitIndexBam(Base):
     functionname = 'indexbam'
@@ -71,6 +81,11 @@ class TestUnitSortBam(Base):
         eq_( [call(self.samtools_cmd+['file'],stdin=input)], popen_mock.call_args_list )
         eq_( res, 'file' )
 
+    def test_level(self, open_mock, popen_mock):
+        input = Mock(spec=file)
+        res = self._C( input, 'file', 1 )
+        eq_( [call(['samtools','sort','-f','-l','1','-','file'],stdin=input)], popen_mock.call_args_list )
+
     def test_output_other_fails(self, open_mock, popen_mock):
         from subprocess import PIPE
         try:
@@ -103,6 +118,13 @@ class TestUnitSamToBam(Base):
         eq_( [call(self.samtools_cmd,stdin=input,stdout=files[0])], popen_mock.call_args_list )
         eq_( res, 'file.bam' )
 
+    def test_uncompressed(self, open_mock, popen_mock):
+        from subprocess import PIPE
+        input = Mock(spec=file)
+        res = self._C( input, PIPE, uncompressed=True )
+        eq_( [call(['samtools','view','-Sbu','-'],stdin=input,stdout=PIPE)], popen_mock.call_args_list )
+        eq_( popen_mock.return_value.stdout, res )
+
     def test_output_other(self, open_mock, popen_mock):
         files = [Mock(name='file.sam')]
         open_mock.side_effect = files
@@ -1,6 +1,8 @@
 from imports import *
 import re
-from ngs_mapper.samtools import InvalidRegionString
+import vcf
+import json
+from ngs_mapper.samtools import InvalidRegionString, parse_regionstring
 
 from ngs_mapper.base_caller import VCF_HEAD
 
@@ -31,7 +33,7 @@ class Base( common.BaseBaseCaller ):
         pileupqualstr - the character that will be used for all quals(mqual & bqual)
         '''
         refdepth = kwargs['refdepth']
-        def get_mpileup_region(bamfile, regionstr, mind, minq, maxd):
+        def get_mpileup_region(bamfile, regionstr, mind, minq, maxd, backend='samtools'):
             '''
             Mock ngs_mapper.samtools.mpileup region
             '''
@@ -50,15 +52,25 @@ class Base( common.BaseBaseCaller ):
             ]
         return get_mpileup_region
 
+    def hist(self, quals):
+        ''' Quality histogram of a list of qualities '''
+        from ngs_mapper.samtools import qual_hist
+        return qual_hist(quals)
+
+    def quals(self, hist):
+        ''' Sorted list of the qualities in a quality histogram '''
+        from ngs_mapper.samtools import QUALS
+        import numpy as np
+        return np.repeat(QUALS, hist).tolist()
+
     def make_stats(self, base_stats):
+        ''' Builds a stats dictionary from lists of base qualities '''
         stats = {}
         for k,v in base_stats.items():
             stats[k] = {}
-            stats[k]['baseq'] = v['baseq']
-            if 'mapq' not in stats[k]:
-                stats[k]['mapq'] = v['baseq']
-            else:
-                stats[k]['mapq'] = v['mapq']
+            stats[k]['baseq'] = self.hist(v['baseq'])
+            stats[k]['mapq'] = self.hist(v['baseq'])
+            stats[k]['firstq'] = v['baseq'][0]
 
         self.update_stats(stats)
 
@@ -66,6 +78,7 @@ class Base( common.BaseBaseCaller ):
 
     def update_stats(self, stats):
         ''' Updates depth, mqualsum and bqualsum from a given stats '''
+        from ngs_mapper.samtools import hist_count, hist_sum
         nonbasekeys = ('depth','mqualsum','bqualsum')
         # Reset to 0
         for k in nonbasekeys:
@@ -74,12 +87,12 @@ class Base( common.BaseBaseCaller ):
         # Sum everything
         for k,v in stats.items():
             if k not in nonbasekeys:
-                stats['depth'] += len(v['baseq'])
-                stats['bqualsum'] += sum(v['baseq'])
+                stats['depth'] += hist_count(v['baseq'])
+                stats['bqualsum'] += hist_sum(v['baseq'])
                 if 'mapq' not in v:
-                    stats['mqualsum'] += sum(v['baseq'])
+                    stats['mqualsum'] += hist_sum(v['baseq'])
                 else:
-                    stats['mqualsum'] += sum(v['mapq'])
+                    stats['mqualsum'] += hist_sum(v['mapq'])
 
         return stats
 
@@ -144,6 +157,52 @@ class TestIsHpoly(Hpoly):
         ok_(self._C(self.hpoly, 'ref', 13))
         ok_(self._C(self.hpoly, 'ref', 14))
 
+class TestIsHpolyBitmap(TestIsHpoly):
+    def setUp( self ):
+        super( TestIsHpolyBitmap, self ).setUp()
+        from ngs_mapper.base_caller import hpoly_bitmap
+        self.hpoly = hpoly_bitmap( self.hpoly, self.seqs )
+
+    def test_outside_reference(self):
+        ok_(not self._C(self.hpoly, 'ref', 0))
+        ok_(not self._C(self.hpoly, 'ref', 15))
+
+class TestHpolyIndex(Hpoly):
+    functionname = 'hpoly_index'
+
+    def _check(self, bitmaps):
+        eq_(['ref'], bitmaps.keys())
+        eq_(
+            [False] + [True]*3 + [False] + [True]*4 + [False] + [True]*5,
+            bitmaps['ref'].tolist()
+        )
+
+    def test_builds_cache(self):
+        r = self._C(self.ref, self.seqs, 3)
+        self._check(r)
+        ok_(exists(self.ref + '.hpoly3.npz'))
+
+    def test_uses_cache(self):
+        self._C(self.ref, self.seqs, 3)
+        with patch('ngs_mapper.base_caller.hpoly_list') as mhpoly_list:
+            r = self._C(self.ref, self.seqs, 3)
+            ok_(not mhpoly_list.called)
+        self._check(r)
+
+    def test_rebuilds_stale_cache(self):
+        self._C(self.ref, self.seqs, 3)
+        # Reference changes after cache was made
+        self.make_hpoly_fasta([('CCC',1,3)])
+        os.utime(self.ref + '.hpoly3.npz', (0, 0))
+        seqs = SeqIO.index(self.ref, 'fasta')
+        r = self._C(self.ref, seqs, 3)
+        eq_([False, True, True, True], r['ref'].tolist())
+
+    @patch('ngs_mapper.base_caller.save_hpoly_bitmap')
+    def test_unwritable_cache(self, msave):
+        msave.side_effect = IOError('Permission denied')
+        self._check(self._C(self.ref, self.seqs, 3))
+
 class StatsBase(Base):
     def setUp(self):
         super(StatsBase, self).setUp()
@@ -161,7 +220,10 @@ class TestUnitBiasHQ(StatsBase):
     def test_no_highquality(self):
         r = self._C(self.stats)
         for k,v in self.stats.items():
-            eq_(v, r[k])
+            if k in ('depth','mqualsum','bqualsum'):
+                eq_(v, r[k])
+            else:
+                eq_(v['baseq'].tolist(), r[k]['baseq'].tolist())
 
     def do_depth(self, stats, bias):
         if stats is None:
@@ -170,9 +232,9 @@ class TestUnitBiasHQ(StatsBase):
         r = self._C(stats, 1, bias)
         for k,v in stats.items():
             if k not in ('depth','mqualsum','bqualsum'):
-                ebaseq = v['baseq']*int(bias)
-                rbaseq = r[k]['baseq']
-                eq_(ebaseq, r[k]['baseq'], 
+                ebaseq = self.quals(v['baseq'])*int(bias)
+                rbaseq = self.quals(r[k]['baseq'])
+                eq_(sorted(ebaseq), rbaseq, 
                     "Len of base {0} should be {1} but got {2}".format(k, len(ebaseq), len(rbaseq))
                )
         # Verify depth is updated
@@ -184,15 +246,14 @@ class TestUnitBiasHQ(StatsBase):
             yield self.do_depth, None, i
 
     def test_biasth_works(self):
-        self.stats = {
+        self.stats = self.make_stats({
             'A': {'baseq': [1,10,20,30,40,50,60] },
-            'depth': 7
-        }
-        self.update_stats(self.stats)
+        })
         r = self._C(self.stats, 50, 2)
-        eq_(self.stats['A']['baseq'] + [50,60], r['A']['baseq'])
+        eq_(sorted([1,10,20,30,40,50,60] + [50,60]), self.quals(r['A']['baseq']))
+        eq_(9, r['depth'])
         r = self._C(self.stats, 15, 2)
-        eq_(self.stats['A']['baseq'] + [20,30,40,50,60], r['A']['baseq'])
+        eq_(sorted([1,10,20,30,40,50,60] + [20,30,40,50,60]), self.quals(r['A']['baseq']))
 
     @raises(ValueError)
     def test_bias_is_zero(self):
@@ -214,39 +275,39 @@ class TestUnitMarkLQ(StatsBase):
         }
         stats = self.make_stats(base_stats)
         r = self._C(stats, 25, 10, 'T')
-        eq_(9, len(r['T']['baseq']))
+        eq_(9, len(self.quals(r['T']['baseq'])))
 
         # Now add an A as well just to make sure. Also puts us >= mind of 10
         base_stats['A'] = {'baseq':[16]}
         stats = self.make_stats(base_stats)
         r = self._C(stats, 25, 10, 'T')
-        eq_(4, len(r['T']['baseq']))
-        eq_(6, len(r['?']['baseq']))
+        eq_(4, len(self.quals(r['T']['baseq'])))
+        eq_(6, len(self.quals(r['?']['baseq'])))
 
     def test_minq_lt(self):
-        self.stats['A']['baseq'] = [23,24,25,26]
+        self.stats['A']['baseq'] = self.hist([23,24,25,26])
         r = self._C(self.stats, 25, 1, 'G')
-        eq_([23,24], r['?']['baseq'])
+        eq_([23,24], self.quals(r['?']['baseq']))
         r = self._C(self.stats, 25, 100, 'G')
-        eq_([23,24], r['N']['baseq'])
+        eq_([23,24], self.quals(r['N']['baseq']))
 
     def test_removes_empty_bases(self):
-        self.stats['A']['baseq'] = [10]*10
-        self.stats['C']['baseq'] = [10]*10
+        self.stats['A']['baseq'] = self.hist([10]*10)
+        self.stats['C']['baseq'] = self.hist([10]*10)
         r = self._C(self.stats, 25, 1, 'G')
         assert 'A' not in r, 'A was not removed even though it had all < minq baseq'
         assert 'C' not in r, 'C was not removed even though it had all < minq baseq'
-        eq_([10]*20, r['?']['baseq'])
+        eq_([10]*20, self.quals(r['?']['baseq']))
         r = self._C(self.stats, 25, 100, 'G')
-        eq_([10]*20, r['N']['baseq'])
+        eq_([10]*20, self.quals(r['N']['baseq']))
 
     def test_adds_n_single_base(self):
         # A - Depth 10, AQ - 20
-        self.stats['A']['baseq'] = [10,10] + [30]*6 + [10,10]
+        self.stats['A']['baseq'] = self.hist([10,10] + [30]*6 + [10,10])
         r = self._C(self.stats, 25, 1, 'G')
-        eq_([10]*4, r['?']['baseq'])
+        eq_([10]*4, self.quals(r['?']['baseq']))
         r = self._C(self.stats, 25, 100, 'G')
-        eq_([10]*4, r['N']['baseq'])
+        eq_([10]*4, self.quals(r['N']['baseq']))
 
     def test_ensure_depth_threshold(self):
         # Make sure if the depth is == mind everything still works
@@ -256,7 +317,7 @@ class TestUnitMarkLQ(StatsBase):
         })
         # A's should all get turned to ? because mind == depth is high coverage
         r = self._C(stats, 25, 10, 'G')
-        eq_(10, len(r['?']['baseq']))
+        eq_(10, len(self.quals(r['?']['baseq'])))
 
     def test_no_n(self):
         r = self._C(self.stats, 25, 1, 'G')
@@ -326,12 +387,12 @@ class TestUnitCaller(Base):
 			'mqualsum': 540.0,
 			'depth': 9,
 			'A': {
-                'baseq': [40, 40, 40, 40, 40, 40, 40, 40],
-                'mapq': [60, 60, 60, 60, 60, 60, 60, 60]
+                'baseq': self.hist([40, 40, 40, 40, 40, 40, 40, 40]),
+                'mapq': self.hist([60, 60, 60, 60, 60, 60, 60, 60])
             },
             'C': {
-                'baseq': [40],
-                'mapq': [60]
+                'baseq': self.hist([40]),
+                'mapq': self.hist([60])
             }
         }
         r = self._C(stats, 25, 100000, 10, 0.8)
@@ -344,16 +405,16 @@ class TestUnitCaller(Base):
 			'mqualsum': 660.0,
 			'depth': 3,
             'A': {
-                'baseq': [40],
-                'mapq': [60]
+                'baseq': self.hist([40]),
+                'mapq': self.hist([60])
             },
 			'G': {
-                'baseq': [40],
-                'mapq': [60]
+                'baseq': self.hist([40]),
+                'mapq': self.hist([60])
             },
 			'T': {
-                'baseq': [40],
-                'mapq': [60]
+                'baseq': self.hist([40]),
+                'mapq': self.hist([60])
             }
         }
         r = self._C(stats, 25, 10000, 10, 0.8)
@@ -438,12 +499,12 @@ class TestUnitCallOnPct(Base):
 
     def test_no_majority_returns_n_zero(self):
         stats = {
-            'A': { 'baseq': [40]*19 },
-            'C': { 'baseq': [40]*19 },
-            'G': { 'baseq': [40]*19 },
-            'T': { 'baseq': [40]*19 },
-            'N': { 'baseq': [40]*19 },
-            '*': { 'baseq': [40]*1 },
+            'A': { 'baseq': self.hist([40]*19) },
+            'C': { 'baseq': self.hist([40]*19) },
+            'G': { 'baseq': self.hist([40]*19) },
+            'T': { 'baseq': self.hist([40]*19) },
+            'N': { 'baseq': self.hist([40]*19) },
+            '*': { 'baseq': self.hist([40]*1) },
             'depth': 100
         }
         r = self._C(stats, 0.8)
@@ -456,9 +517,106 @@ def eqs_(v1, v2, msg=None):
     else:
         eq_(str(v1), str(v2))
 
+class TestWriteGap(Base):
+    functionname = 'write_gap'
+
+    def setUp(self):
+        super(TestWriteGap, self).setUp()
+        import numpy as np
+        self.refseq = 'ACAAATGGGCCT'
+        self.hpolys = {'ref': np.array([0,0,0,1,1,1,0,1,1,1,0,0,0], dtype=bool)}
+
+    def _write(self, frompos, topos, blocks):
+        from ngs_mapper.base_caller import VcfWriter
+        out = StringIO()
+        self._C(VcfWriter(out), 'ref', self.refseq, self.hpolys, frompos, topos, blocks)
+        return [l for l in out.getvalue().splitlines() if not l.startswith('#')]
+
+    def test_same_as_blank_vcf_rows(self):
+        from ngs_mapper.base_caller import VcfWriter, blank_vcf_rows, is_hpoly
+        out = StringIO()
+        writer = VcfWriter(out)
+        for row in blank_vcf_rows('ref', self.refseq, 0, 13):
+            if is_hpoly(self.hpolys, 'ref', row.POS):
+                row.INFO['HPOLY'] = True
+            writer.write_record(row)
+        expect = [l for l in out.getvalue().splitlines() if not l.startswith('#')]
+        eq_(expect, self._write(0, 13, False))
+
+    def test_blocks_split_on_hpoly(self):
+        r = self._write(0, 13, True)
+        eq_(
+            [
+                'ref\t1\t.\tA\t.\t.\t.\tDP=0;RC=0;RAQ=0;PRC=0;CBD=0;CB=-;END=2',
+                'ref\t3\t.\tA\t.\t.\t.\tDP=0;RC=0;RAQ=0;PRC=0;CBD=0;CB=-;HPOLY;END=5',
+                'ref\t6\t.\tT\t.\t.\t.\tDP=0;RC=0;RAQ=0;PRC=0;CBD=0;CB=-',
+                'ref\t7\t.\tG\t.\t.\t.\tDP=0;RC=0;RAQ=0;PRC=0;CBD=0;CB=-;HPOLY;END=9',
+                'ref\t10\t.\tC\t.\t.\t.\tDP=0;RC=0;RAQ=0;PRC=0;CBD=0;CB=-;END=12',
+            ],
+            r
+        )
+
+    def test_blocks_stay_inside_gap(self):
+        r = self._write(3, 9, True)
+        eq_(['4','6','7'], [l.split('\t')[1] for l in r])
+        ok_(r[-1].endswith('END=8'))
+
+    def test_no_gap(self):
+        eq_([], self._write(3, 4, True))
+
+class TestGapBlockHeader(Base):
+    functionname = 'gap_block_header'
+
+    def test_adds_end_info(self):
+        from ngs_mapper.base_caller import END_INFO_HEAD
+        r = self._C(VCF_HEAD.format('sample'))
+        lines = r.splitlines()
+        eq_(END_INFO_HEAD, lines[-2])
+        ok_(lines[-1].startswith('#CHROM'))
+        eq_(VCF_HEAD.format('sample'), r.replace(END_INFO_HEAD + '\n', ''))
+
+class TestDownsampleHeader(Base):
+    functionname = 'downsample_header'
+
+    def test_adds_ds_info(self):
+        from ngs_mapper.base_caller import DS_INFO_HEAD
+        r = self._C(VCF_HEAD.format('sample'))
+        lines = r.splitlines()
+        eq_(DS_INFO_HEAD, lines[-2])
+        eq_(VCF_HEAD.format('sample'), r.replace(DS_INFO_HEAD + '\n', ''))
+
+class TestScaleCounts(Base):
+    functionname = 'scale_counts'
+
+    def test_scales_counts_only(self):
+        from ngs_mapper.base_caller import VcfRow
+        row = VcfRow('Ref1', 1, 'A', ['C'], {
+            'DP':100, 'RC':70, 'RAQ':40, 'PRC':70, 'AC':[30], 'AAQ':30, 'PAC':[30], 'CB':'M', 'CBD':100
+        })
+        self._C(row, 1049, 100)
+        eq_({
+            'DP':1049, 'RC':734, 'RAQ':40, 'PRC':70, 'AC':[315], 'AAQ':30, 'PAC':[30], 'CB':'M', 'CBD':1049, 'DS':True
+        }, row.INFO)
+
+    def test_no_alts(self):
+        from ngs_mapper.base_caller import blank_vcf_row
+        row = blank_vcf_row('Ref1', 'A', 1)
+        self._C(row, 20, 10)
+        eq_(20, row.INFO['DP'])
+        ok_('AC' not in row.INFO)
+        ok_(row.INFO['DS'])
+
 class TestUnitBlankVcfRows(Base):
     functionname = 'blank_vcf_rows'
 
+    def _C(self, *args, **kwargs):
+        return list(super(TestUnitBlankVcfRows, self)._C(*args, **kwargs))
+
+    def test_is_generator(self):
+        from ngs_mapper.base_caller import blank_vcf_rows
+        import types
+        ok_(isinstance(blank_vcf_rows('ref', 'A'*10, 0, 3), types.GeneratorType))
+
     def test_gap_front(self):
         # Should return 1 & 2
         r = self._C('ref', 'A'*10, 0, 3)
@@ -670,8 +828,8 @@ class TestUnitGenerateVcfRow(MpileBase):
         stats = self.mock_stats()
         # SHould keep depth at 100 and as it stands
         # ambiguous call which we can bias towards the N
-        stats['G'] = {'baseq': [50]*60}
-        stats['N'] = {'baseq': [40]*10}
+        stats['G'] = {'baseq': self.hist([50]*60)}
+        stats['N'] = {'baseq': self.hist([40]*10)}
         self.setup_mpileupcol(mpilecol, stats=stats)
         # biasth @ 50 will bias the G and bias @ 3 will make it
         # the majority at 180/220 = 82%
@@ -829,8 +987,8 @@ class TestUnitGenerateVcfRow(MpileBase):
         # as it is low quality
         stats = {
             'depth': 20,
-            'A': { 'baseq': [1]*10 },
-            'C': { 'baseq': [40]*10 },
+            'A': { 'baseq': self.hist([1]*10) },
+            'C': { 'baseq': self.hist([40]*10) },
             'mqualsum': 0,
             'bqualsum': 0
         }
@@ -845,8 +1003,8 @@ class TestUnitGenerateVcfRow(MpileBase):
         # as it is low quality
         stats = {
             'depth': 20,
-            'A': { 'baseq': [1]*10 },
-            'C': { 'baseq': [40]*10 },
+            'A': { 'baseq': self.hist([1]*10) },
+            'C': { 'baseq': self.hist([40]*10) },
             'mqualsum': 0,
             'bqualsum': 0
         }
@@ -860,6 +1018,218 @@ class TestUnitGenerateVcfRow(MpileBase):
         eq_([100], r.INFO['PAC'])
         eq_(['C'], r.ALT)
 
+class NumpyBase(Base):
+    def make_col(self, bases, quals, refbase='A', pos=1):
+        ''' Build a real MPileupColumn from bases and quality strings '''
+        from ngs_mapper.samtools import MPileupColumn
+        return MPileupColumn(
+            self._mock_pileup_str('ref', pos, refbase, len(quals), bases, quals, quals)
+        )
+
+class TestUnitPileStatsNumpy(NumpyBase):
+    functionname = 'pile_stats_numpy'
+
+    def test_bias_ref_and_bias_hq(self):
+        # Same as TestUnitPileStats.test_bias_ref_and_bias_hq
+        from ngs_mapper.base_caller import column_arrays
+        col = self.make_col('TTTTTT', '9:OY[G')
+        bases, quals = column_arrays(col)
+        r = self._C(bases, quals, 'T', 25, 10, 50, 10)
+        eq_(23, r['depth'])
+        # The 24 quality base is removed as depth is >= mind
+        eq_([23, 25+46+38+(56+58)*10], r['T'])
+
+    def test_lowdepth_lowqual_is_n(self):
+        from ngs_mapper.base_caller import column_arrays
+        col = self.make_col('TTAA', '!II!')
+        bases, quals = column_arrays(col)
+        r = self._C(bases, quals, 'A', 25, 10, 50, 10)
+        eq_([1, 0], r['N'])
+        eq_([2, 40], r['A'])
+        eq_([1, 40], r['T'])
+
+    @raises(ValueError)
+    def test_bias_lt_one(self):
+        from ngs_mapper.base_caller import column_arrays
+        bases, quals = column_arrays(self.make_col('A', 'I'))
+        self._C(bases, quals, 'A', 25, 10, 50, 0)
+
+class TestUnitGenerateVcfRowNumpy(NumpyBase):
+    functionname = 'generate_vcf_row_numpy'
+
+    def _cmp_engines(self, col, refseq, *args):
+        ''' The numpy engine has to produce exactly the same record as the python engine '''
+        from ngs_mapper.base_caller import generate_vcf_row
+        e = generate_vcf_row(col, refseq, *args)
+        r = self._C(col, refseq, *args)
+        eq_(e.CHROM, r.CHROM)
+        eq_(e.POS, r.POS)
+        eq_(e.REF, r.REF)
+        eq_(e.ALT, r.ALT)
+        # Order matters as it is the order written to the vcf
+        eq_(e.INFO.items(), r.INFO.items())
+        return r
+
+    def test_lowdepth_lowqual(self):
+        r = self._cmp_engines(self.make_col('ACGT*', '!I5!I'), 'A', 25, 1000, 10, 0.8, 50, 10)
+        eq_(5, r.INFO['DP'])
+
+    def test_highdepth_removes_lowqual(self):
+        bases = 'A'*50 + 'C'*10 + 'G'*10 + 'T'*5
+        quals = ('I!'*25) + ('S'*10) + ('5'*10) + ('!'*5)
+        r = self._cmp_engines(self.make_col(bases, quals), 'A', 25, 1000, 10, 0.8, 50, 10)
+        eq_(125, r.INFO['DP'])
+
+    def test_gap_majority_recalled(self):
+        bases = 'C'*45 + '*'*50 + 'GANT'
+        quals = 'I'*95 + 'II!5'
+        self._cmp_engines(self.make_col(bases, quals, 'C'), 'C', 25, 1000, 10, 0.8, 50, 10)
+
+    def test_ambiguous_call(self):
+        bases = 'AC'*30 + 'G'*10
+        quals = 'I'*70
+        r = self._cmp_engines(self.make_col(bases, quals), 'A', 25, 1000, 10, 0.8, 50, 10)
+        eq_('M', r.INFO['CB'])
+
+    def test_all_lowquality_highdepth(self):
+        r = self._cmp_engines(self.make_col('G'*20, '!'*20, 'G'), 'G', 25, 1000, 10, 0.8, 50, 10)
+        eq_('N', r.INFO['CB'])
+        eq_(0, r.INFO['DP'])
+
+    def test_reference_lowercase_dna(self):
+        r = self._cmp_engines(self.make_col('GGGA', 'IIII', 'g'), 'g', 25, 1000, 10, 0.8, 50, 10)
+        eq_('G', r.REF)
+
+    def test_column_stats(self):
+        ''' A ColumnStats is called the same as the column it was built from '''
+        from ngs_mapper.base_caller import ColumnStats
+        bases = 'AC'*30 + 'G'*10 + '*'*5
+        quals = 'I5'*30 + '!'*10 + 'I'*5
+        col = self.make_col(bases, quals)
+        for args in ((25, 1000, 10, 0.8, 50, 10), (10, 1000, 100, 0.5, 30, 2)):
+            e = self._C(col, 'A', *args)
+            r = self._C(ColumnStats.from_column(col), 'A', *args)
+            eq_((e.CHROM, e.POS, e.REF, e.ALT), (r.CHROM, r.POS, r.REF, r.ALT))
+            eq_(e.INFO.items(), r.INFO.items())
+
+class TestColumnStats(NumpyBase):
+    def from_column(self, col):
+        from ngs_mapper.base_caller import ColumnStats
+        return ColumnStats.from_column(col)
+
+    def test_first_appearance_order(self):
+        r = self.from_column(self.make_col('CCAC*', '5I!I5', pos=3))
+        eq_(('ref', 3, 5), (r.ref, r.pos, r.depth))
+        eq_([('C', 20), ('A', 0), ('*', 20)], r.seen)
+        eq_([2, 0, 0], r.hists[:, 40].tolist())
+        eq_([1, 0, 1], r.hists[:, 20].tolist())
+
+    def test_line_round_trip(self):
+        r = self.from_column(self.make_col('CCAC*', '5I!I5'))
+        eq_('ref\t1\tC:20:20=1,40=2\tA:0:0=1\t*:20:20=1', str(r))
+        from ngs_mapper.base_caller import ColumnStats
+        r2 = ColumnStats.from_line(str(r) + '\n')
+        eq_(r.seen, r2.seen)
+        eq_(r.hists.tolist(), r2.hists.tolist())
+
+    def test_same_stats_as_column(self):
+        from ngs_mapper.base_caller import pile_stats_hist, pile_stats_numpy, column_arrays
+        col = self.make_col('TTAA'*10 + 'G', '!II!'*10 + '5')
+        bases, quals = column_arrays(col)
+        for minbq, mind, biasth, bias in ((25, 10, 50, 10), (0, 50, 30, 2), (41, 2, 20, 1)):
+            eq_(
+                pile_stats_numpy(bases, quals, 'A', minbq, mind, biasth, bias).items(),
+                pile_stats_hist(self.from_column(col), 'A', minbq, mind, biasth, bias).items()
+            )
+
+class TestColumnStatsWriter(NumpyBase):
+    functionname = 'column_stats_writer'
+
+    def test_writes_as_columns_are_added(self):
+        from ngs_mapper.base_caller import COLUMN_STATS_HEAD
+        collector = self._C('stats.txt')
+        collector.start_region('ref:1-2')
+        collector.add(self.make_col('A', 'I', pos=1))
+        collector.stream.flush()
+        eq_([], collector.lines)
+        lines = open('stats.txt').read().splitlines()
+        eq_([COLUMN_STATS_HEAD, '#region\tref:1-2'], lines[:2])
+        eq_(3, len(lines))
+        collector.close()
+
+    def test_copies_keep_own_region(self):
+        import copy
+        import pickle
+        from ngs_mapper.base_caller import read_column_stats
+        collector = self._C('stats.txt')
+        chunk = pickle.loads(pickle.dumps(copy.deepcopy(collector)))
+        eq_(None, chunk.stream)
+        chunk.start_region('ref:3-4')
+        chunk.add(self.make_col('CC', 'II', pos=3))
+        chunk = pickle.loads(pickle.dumps(chunk))
+        eq_(2, len(chunk.lines))
+        collector.update(chunk)
+        collector.close()
+        r = [(region, [(c.pos, c.depth) for c in cols]) for region, cols in read_column_stats('stats.txt')]
+        eq_([('ref:3-4', [(3, 2)])], r)
+
+class TestReadColumnStats(NumpyBase):
+    functionname = 'read_column_stats'
+
+    def test_reads_regions_in_order(self):
+        from ngs_mapper.base_caller import ColumnStatsCollector, write_column_stats
+        first, second = ColumnStatsCollector(), ColumnStatsCollector()
+        first.start_region('ref:1-2')
+        first.add(self.make_col('A', 'I', pos=1))
+        second.start_region('ref:3-4')
+        second.start_region('ref2:1-4')
+        second.add(self.make_col('CC', 'II', pos=2))
+        first.update(second)
+        write_column_stats(first, 'stats.txt')
+        r = [(region, [(c.pos, c.depth) for c in cols]) for region, cols in self._C('stats.txt')]
+        eq_([('ref:1-2', [(1, 1)]), ('ref:3-4', []), ('ref2:1-4', [(2, 2)])], r)
+
+    @patch('ngs_mapper.base_caller.mpileup')
+    def test_recall_same_as_pileup(self, mmpileup):
+        ''' Saved statistics call the same vcf as piling up again with any thresholds '''
+        from ngs_mapper.base_caller import (
+            generate_vcf, generate_vcf_from_stats, ColumnStatsCollector, write_column_stats
+        )
+        with open('ref.fasta', 'w') as fh:
+            fh.write('>ref\nACGTTTAC\n')
+        cols = [
+            ('ref', 2, 'C', 12, 'CCAC*'*2 + 'GT', '5I!I5'*2 + 'II'),
+            ('ref', 3, 'G', 4, 'GGAA', 'I!I!'),
+            ('ref', 5, 'T', 30, 'T'*20 + '*'*10, '!'*20 + 'I'*10),
+            ('ref', 7, 'A', 3, 'AC*', 'I5!'),
+        ]
+        mmpileup.side_effect = lambda *args, **kwargs: [self._mock_pileup_str(*c) for c in cols]
+        collector = ColumnStatsCollector()
+        generate_vcf('in.bam', 'ref.fasta', 'ref:1-8', 'saved.vcf', 25, 1000, consumers=[collector])
+        write_column_stats(collector, 'stats.txt')
+        for minbq, mind, minth, bias in ((25, 10, 0.8, 10), (10, 2, 0.5, 2), (35, 100, 0.95, 1)):
+            generate_vcf('in.bam', 'ref.fasta', 'ref:1-8', 'bam.vcf', minbq, 1000, mind, minth, 50, bias)
+            generate_vcf_from_stats('stats.txt', 'ref.fasta', 'stats.vcf', minbq, 1000, mind, minth, 50, bias)
+            eq_(open('bam.vcf').read(), open('stats.vcf').read())
+
+    @raises(ValueError)
+    def test_not_stats_file(self):
+        with open('stats.txt', 'w') as fh:
+            fh.write('##fileformat=VCFv4.2\n')
+        list(self._C('stats.txt'))
+
+class TestUnitRowGenerator(Base):
+    functionname = 'row_generator'
+
+    def test_engines(self):
+        from ngs_mapper.base_caller import generate_vcf_row, generate_vcf_row_numpy
+        eq_(generate_vcf_row, self._C('python'))
+        eq_(generate_vcf_row_numpy, self._C('numpy'))
+
+    @raises(ValueError)
+    def test_invalid_engine(self):
+        self._C('fortran')
+
 class TestUnitGenerateVCF(Base):
     # Hard to test each thing without generating sam files and vcf manually so
     # just going to let the integration tests do it...
@@ -873,7 +1243,7 @@ class TestUnitInfoStats(Base):
 
     def mock_stats2(self):
         ''' Every base and each base has length 20 with 40 quality so depth 100 '''
-        s = { 'baseq': [40]*20 }
+        s = { 'baseq': self.hist([40]*20) }
         self.stats2 = {'depth':0}
         for b in 'ACGNT':
             self.stats2['depth'] = len(s['baseq'])
@@ -885,7 +1255,7 @@ class TestUnitInfoStats(Base):
             'bqualsum': 6000,
             'depth': 100,
             'A': {
-                'baseq': [40]*100,
+                'baseq': self.hist([40]*100),
             }
         }
         r = self._C(self.stats2, 'A')
@@ -903,11 +1273,11 @@ class TestUnitInfoStats(Base):
 
     def test_ensure_expected(self):
         ''' Order of the bases must be preserved '''
-        self.stats2['A']['baseq'] = [40]*200
-        self.stats2['C']['baseq'] = [39]*200
-        self.stats2['G']['baseq'] = [38]*42
-        self.stats2['N']['baseq'] = [37]*58
-        self.stats2['T']['baseq'] = [36]*500
+        self.stats2['A']['baseq'] = self.hist([40]*200)
+        self.stats2['C']['baseq'] = self.hist([39]*200)
+        self.stats2['G']['baseq'] = self.hist([38]*42)
+        self.stats2['N']['baseq'] = self.hist([37]*58)
+        self.stats2['T']['baseq'] = self.hist([36]*500)
         self.stats2['depth'] = 1000
         r = self._C(self.stats2, 'A')
         rr = zip(r['AC'], r['PAC'], r['AAQ'], r['bases'])
@@ -922,7 +1292,7 @@ class TestUnitInfoStats(Base):
         #eq_(['C','G','N','T'], r['bases'])
 
     def test_ensure_exclude_ref(self):
-        self.stats2['G']['baseq'] = [10]*20
+        self.stats2['G']['baseq'] = self.hist([10]*20)
         self.stats2['depth'] = 100
         r = self._C(self.stats2, 'G')
         eq_([40]*4, r['AAQ'])
@@ -1100,6 +1470,26 @@ class TestGenerateVCF(BaseInty):
         r = self._C('test.bam','test.ref', 'Ref1:5-7', 'out.vcf', 25, 100, 10, 0.8)
         countvcf(5,3)
 
+    @patch('ngs_mapper.base_caller.SeqIO')
+    @patch('ngs_mapper.base_caller.mpileup')
+    def test_downsample_reports_true_depth(self, mmpileup, mseqio):
+        mseqio.index.return_value = {'Ref1':MagicMock(seq='A'*10,id='Ref1')}
+        depth = 10000
+        bases = 'A'*7000 + 'C'*3000
+        mmpileup.return_value = [
+            self._mock_pileup_str('Ref1', 5, 'A', depth, bases, 'I'*depth, ']'*depth)
+        ]
+        for engine in ('python', 'numpy'):
+            self._C('test.bam', 'test.ref', 'Ref1:5-5', 'out.vcf', 25, 100000, 10, 0.8, 50, 10,
+                self.vcf_head, engine=engine, downsample=1000, seed=1)
+            row = self._split_vcfrow([l for l in open('out.vcf') if not l.startswith('#')][0])
+            info = row['INFO']
+            eq_('10000', info['DP'])
+            eq_(10000, int(info['RC']) + int(info['AC']))
+            ok_(65 <= int(info['PRC']) <= 75)
+            eq_('M', info['CB'])
+            ok_(open('out.vcf').read().rstrip('\n').endswith(';DS'))
+
     #@timed(90)
     @attr('slow')
     def test_fullsample_correct_called_bases_hpoly(self):
@@ -1172,67 +1562,193 @@ class TestGenerateVcfMultithreaded(BaseInty):
                 i += 1
         eq_(numrefs*reflen, linecount)
 
-    #@timed(50.0/3.0)
+    @patch('ngs_mapper.base_caller.mapped_reads')
     @patch('ngs_mapper.base_caller.multiprocessing')
     @patch('__builtin__.open')
-    @patch('ngs_mapper.base_caller.os')
     @patch('ngs_mapper.base_caller.SeqIO')
-    @patch('ngs_mapper.base_caller.mpileup')
-    def test_breaks_up_refs_into_chunks(self, mmpileup, mseqio, mos, mopen, mmultiprocessing):
+    def test_breaks_up_refs_into_chunks(self, mseqio, mopen, mmultiprocessing, mmapped):
         reflen = 100000
-        numrefs = 3
-        refdepth = 100
         threads = 4
-        # Each reference is 1 million bases long
+        mmapped.return_value = {}
         ref1 = Mock(seq='A'*reflen,id='Ref1')
         ref2 = Mock(seq='T'*reflen,id='Ref2')
         ref3 = Mock(seq='G'*reflen,id='Ref3')
-        mseqio.index.return_value = {'Ref1':ref1, 'Ref2': ref2, 'Ref3': ref3}
         mseqio.parse.return_value = iter([ref1, ref2, ref3])
+        pool = mmultiprocessing.Pool.return_value
+        def apply_async(func, args):
+            regionstr = args[0][2]
+            return Mock(get=Mock(return_value=(regionstr + '\n', [])))
+        pool.apply_async.side_effect = apply_async
 
-        # Each reference is 100 reads deep
-        ref1_pile = [self._mock_pileup_str('Ref1', i, 'A', refdepth, 'G'*refdepth, 'I'*refdepth, 'I'*refdepth) for i in range(1,reflen+1)]
-        ref2_pile = [self._mock_pileup_str('Ref2', i, 'T', refdepth, 'T'*refdepth, 'I'*refdepth, 'I'*refdepth) for i in range(1,reflen+1)]
-        ref3_pile = [self._mock_pileup_str('Ref3', i, 'G', refdepth, 'A'*refdepth, 'I'*refdepth, 'I'*refdepth) for i in range(1,reflen+1)]
-        mmpileup.side_effect = [ref1_pile, ref2_pile, ref3_pile]
-
-        with patch('ngs_mapper.base_caller.time') as time:
-            out_vcf = self._C('in.bam', 'in.ref', 'out.vcf', 25, 100000, 10, 0.8, 50, 10, threads)
-
-        expected_regionstr = [
-            ('Ref1:1-25000'),
-            ('Ref1:25001-50000'),
-            ('Ref1:50001-75000'),
-            ('Ref1:75001-100000'),
-            ('Ref2:1-25000'),
-            ('Ref2:25001-50000'),
-            ('Ref2:50001-75000'),
-            ('Ref2:75001-100000'),
-            ('Ref3:1-25000'),
-            ('Ref3:25001-50000'),
-            ('Ref3:50001-75000'),
-            ('Ref3:75001-100000'),
-        ]
-
+        out_vcf = self._C('in.bam', 'in.ref', 'out.vcf', 25, 100000, 10, 0.8, 50, 10, threads)
 
-        i = 0
-        for eregion, rcall in zip(expected_regionstr, mmultiprocessing.Process.call_args_list):
-            # Call from multiprocessing.Process
-            callargs = rcall[1]['args']
+        # Only ever as many workers as threads
+        eq_(threads, mmultiprocessing.Pool.call_args[0][0])
+        # 16 chunks split evenly across the 3 references
+        expected_regionstr = []
+        for ref in ('Ref1','Ref2','Ref3'):
+            for start in range(1, reflen+1, 20000):
+                expected_regionstr.append('{0}:{1}-{2}'.format(ref, start, start+19999))
+        eq_(expected_regionstr, [c[0][1][0][2] for c in pool.apply_async.call_args_list])
+        # Rows are written to the single output file in order
+        fh = mopen.return_value.__enter__.return_value
+        eq_(
+            [call(VCF_HEAD+'\n')] + [call(r + '\n') for r in expected_regionstr],
+            fh.write.call_args_list
+        )
+        pool.close.assert_called_once_with()
+        pool.join.assert_called_once_with()
+
+class TestOrderedResults(Base):
+    functionname = 'ordered_results'
+
+    def test_in_order_within_window(self):
+        pool = Mock()
+        self.inflight = 0
+        self.most = 0
+        def apply_async(func, args):
+            self.inflight += 1
+            self.most = max(self.most, self.inflight)
+            def get():
+                self.inflight -= 1
+                return func(*args)
+            return Mock(get=get)
+        pool.apply_async.side_effect = apply_async
+        r = list(self._C(pool, lambda x: x * 2, iter(range(10)), 3))
+        eq_([x * 2 for x in range(10)], r)
+        eq_(3, self.most)
+
+    def test_no_args(self):
+        eq_([], list(self._C(Mock(), None, [], 3)))
+
+class TestRegionChunks(Base):
+    functionname = 'region_chunks'
+
+    def test_single_thread_one_chunk_per_ref(self):
+        r = self._C([('Ref1',10),('Ref2',5)], 1)
+        eq_(['Ref1:1-10','Ref2:1-5'], r)
+
+    def test_splits_by_length(self):
+        r = self._C([('Ref1',100),('Ref2',60),('Ref3',40)], 2)
+        eq_(
+            ['Ref1:1-25','Ref1:26-50','Ref1:51-75','Ref1:76-100',
+             'Ref2:1-30','Ref2:31-60',
+             'Ref3:1-20','Ref3:21-40'],
+            r
+        )
 
-            # Parse out call info
-            regionstr = callargs[2]
-            tmpfile = callargs[3]
-            
-            # Every process call gets a new tempfile
-            eq_('out.vcf.{0}'.format(i), tmpfile)
-            eq_(eregion, regionstr)
+    def test_splits_by_counts(self):
+        r = self._C([('Ref1',100),('Ref2',100)], 2, {'Ref1': 0, 'Ref2': 1000})
+        eq_('Ref1:1-100', r[0])
+        eq_(9, len(r))
+        eq_('Ref2:1-13', r[1])
+        eq_('Ref2:92-100', r[-1])
+
+    def test_every_ref_covered_once(self):
+        refs = [('Ref{0}'.format(i), i*7+1) for i in range(1, 30)]
+        counts = dict((ref, i % 5) for i, (ref, l) in enumerate(refs))
+        for threads in (1, 2, 8):
+            positions = {}
+            for regionstr in self._C(refs, threads, counts):
+                ref, s, e = parse_regionstring(regionstr)
+                positions.setdefault(ref, []).extend(range(s, e+1))
+            for ref, reflen in refs:
+                eq_(range(1, reflen+1), positions[ref])
+
+    def test_short_refs_not_overchunked(self):
+        r = self._C([('Ref1',2)], 8)
+        eq_(['Ref1:1-1','Ref1:2-2'], r)
+
+    @patch('ngs_mapper.base_caller.MAX_CHUNK_BASES', 4)
+    def test_long_ref_capped_single_thread(self):
+        r = self._C([('Ref1',10),('Ref2',3)], 1)
+        eq_(['Ref1:1-4','Ref1:5-8','Ref1:9-10','Ref2:1-3'], r)
+
+    def test_skips_empty_refs(self):
+        r = self._C([('Ref1',0),('Ref2',5)], 1)
+        eq_(['Ref2:1-5'], r)
+        r = self._C([('Ref1',0),('Ref2',5)], 4, {'Ref1': 10, 'Ref2': 0})
+        eq_('Ref2:1-5', r[0])
+
+class TestMappedReads(Base):
+    functionname = 'mapped_reads'
+
+    def test_counts_from_idxstats(self):
+        r = self._C(self.bam)
+        eq_(set(['Ref1','Ref2','Ref3','*']), set(r))
+        eq_(9, r['Ref1'])
+        eq_(1, r['Ref3'])
+
+    @patch('ngs_mapper.base_caller.idxstats')
+    def test_empty_on_error(self, midxstats):
+        midxstats.side_effect = OSError('samtools missing')
+        eq_({}, self._C('in.bam'))
+
+class TestVcfWriter(Base):
+    functionname = 'VcfWriter'
+
+    def _rows(self):
+        from ngs_mapper.base_caller import blank_vcf_row, VcfRow
+        hpoly = blank_vcf_row('Ref1', 'ACGT', 2, 'N')
+        hpoly.INFO['HPOLY'] = True
+        return [
+            blank_vcf_row('Ref1', 'ACGT', 1),
+            hpoly,
+            VcfRow('Ref1', 3, 'G', ['A','*'], {
+                'AC':[5,2], 'AAQ':[30,20], 'PAC':[25,10], 'DP':20, 'RC':13,
+                'RAQ':35, 'PRC':65, 'CB':'R', 'CBD':18
+            }),
+            vcf.model._Record('Ref1', 4, None, 'T', '.', None, None, {'DP':1,'CB':'T','XX':None}, None, None),
+            VcfRow('Ref1', 5, 'T', '.', {}),
+        ]
 
-            # Increment file count
-            i += 1
+    def test_identical_to_pyvcf(self):
+        from ngs_mapper.base_caller import VCF_HEAD
+        import StringIO as pystringio
+        template = pystringio.StringIO(VCF_HEAD.format('test'))
+        template.name = 'template.vcf'
+        expect = StringIO()
+        writer = vcf.Writer(expect, template=vcf.Reader(template))
+        for row in self._rows():
+            writer.write_record(row)
+        result = StringIO()
+        writer = self._C(result, VCF_HEAD.format('test'))
+        for row in self._rows():
+            writer.write_record(row)
+        eq_(expect.getvalue(), result.getvalue())
+
+    def test_write_blank(self):
+        from ngs_mapper.base_caller import blank_vcf_row
+        expect = StringIO()
+        result = StringIO()
+        ewriter = self._C(expect)
+        rwriter = self._C(result)
+        for pos, hpoly in ((1, False), (2, True)):
+            row = blank_vcf_row('Ref1', 'ACGT', pos, 'N')
+            if hpoly:
+                row.INFO['HPOLY'] = True
+            ewriter.write_record(row)
+            rwriter.write_blank('Ref1', pos, 'ACGT'[pos-1], 'N', hpoly)
+        eq_(expect.getvalue(), result.getvalue())
+
+class TestBgzipIndex(Base):
+    functionname = 'bgzip_index'
+
+    def test_compresses_and_indexes(self):
+        from ngs_mapper.base_caller import VcfWriter, blank_vcf_row
+        vcffile = join(self.tempdir, 'out.vcf')
+        writer = VcfWriter(open(vcffile, 'w'))
+        for pos in range(1, 5):
+            writer.write_record(blank_vcf_row('Ref1', 'ACGT', pos))
+        writer.close()
+        r = self._C(vcffile)
+        eq_(vcffile + '.gz', r)
+        ok_(exists(vcffile + '.gz.tbi'))
+        ok_(not exists(vcffile))
+        eq_([1,2,3,4], [row.POS for row in vcf.Reader(open(r))])
 
 class TestUnitMain(BaseInty):
-    def _C( self, bamfile, reffile, vcf_output_file, regionstr=None, minbq=25, maxd=100000, mind=10, minth=0.8, biasth=50, bias=2, threads=1 ):
+    def _C( self, bamfile, reffile, vcf_output_file, regionstr=None, minbq=25, maxd=100000, mind=10, minth=0.8, biasth=50, bias=2, threads=1, engine='python', pileup_backend='samtools', bgzip=False, gap_blocks=False, qualdepth=None, save_stats=None, from_stats=None, downsample=None, seed=0 ):
         from ngs_mapper.base_caller import main
         args = Mock(
             bamfile=bamfile,
@@ -1245,7 +1761,16 @@ class TestUnitMain(BaseInty):
             minth=minth,
             biasth=biasth,
             bias=bias,
-            threads=threads
+            threads=threads,
+            engine=engine,
+            pileup_backend=pileup_backend,
+            bgzip=bgzip,
+            gap_blocks=gap_blocks,
+            qualdepth=qualdepth,
+            save_stats=save_stats,
+            from_stats=from_stats,
+            downsample=downsample,
+            seed=seed
        )        
         with patch('ngs_mapper.base_caller.parse_args') as margparse:
             margparse.return_value = args
@@ -1264,6 +1789,71 @@ class TestUnitMain(BaseInty):
         r = self._C(self.bam, self.ref, out_vcf, None, 25, 100, 10, 0.8, 50, 2)
         assert self.cmp_vcf(self.vcf, out_vcf)
 
+    def test_qualdepth_same_as_graphsample(self):
+        from ngs_mapper.graphsample import make_json
+        tbam, tbai = self.temp_bam(self.bam, self.bai)
+        out_vcf = join(self.tempdir, tbam + '.vcf')
+        expect = json.load(open(make_json(self.bam, join(self.tempdir, 'expect'))))
+        for threads, regionstr in ((1, None), (2, None), (1, 'Ref1:1-100')):
+            qualdepth = join(self.tempdir, 'qualdepth.json')
+            self._C(self.bam, self.ref, out_vcf, regionstr, 25, 100, 10, 0.8, 50, 2, threads, qualdepth=qualdepth)
+            r = json.load(open(qualdepth))
+            eq_(expect['unmapped_reads'], r['unmapped_reads'])
+            if regionstr is None:
+                eq_(sorted(expect), sorted(r))
+            for ref in [ref for ref in r if ref != 'unmapped_reads']:
+                # Gap positions have a NaN average quality which does not compare equal
+                eq_(repr(expect[ref]), repr(r[ref]))
+
+    def test_gap_blocks_same_consensus(self):
+        from ngs_mapper.vcf_consensus import iter_refs
+        tbam, tbai = self.temp_bam(self.bam, self.bai)
+        out_vcf = join(self.tempdir, tbam + '.vcf')
+        block_vcf = join(self.tempdir, tbam + '.blocks.vcf')
+        for threads in (1, 2):
+            self._C(self.bam, self.ref, out_vcf, None, 25, 100, 10, 0.8, 50, 2, threads)
+            self._C(self.bam, self.ref, block_vcf, None, 25, 100, 10, 0.8, 50, 2, threads, gap_blocks=True)
+            rows = list(vcf.Reader(open(block_vcf)))
+            ok_(any('END' in row.INFO for row in rows))
+            ok_(len(rows) < len(list(vcf.Reader(open(out_vcf)))))
+            eq_(
+                [(s.id, str(s.seq)) for s in iter_refs(out_vcf)],
+                [(s.id, str(s.seq)) for s in iter_refs(block_vcf)]
+            )
+
+    def test_from_stats_same_as_bam(self):
+        tbam, tbai = self.temp_bam(self.bam, self.bai)
+        out_vcf = join(self.tempdir, tbam + '.vcf')
+        stats_vcf = join(self.tempdir, tbam + '.stats.vcf')
+        stats = join(self.tempdir, 'colstats.txt')
+        for threads, regionstr, gap_blocks in ((1, None, False), (2, None, True), (1, 'Ref1:2-8', False)):
+            self._C(self.bam, self.ref, out_vcf, regionstr, threads=threads, gap_blocks=gap_blocks, save_stats=stats)
+            # Other thresholds are called from the statistics
+            for minbq, mind, minth, bias in ((25, 10, 0.8, 2), (10, 2, 0.5, 10), (35, 100, 0.95, 1)):
+                self._C(self.bam, self.ref, out_vcf, regionstr, minbq, 100, mind, minth, 50, bias, threads, gap_blocks=gap_blocks)
+                self._C('missing.bam', self.ref, stats_vcf, None, minbq, 100, mind, minth, 50, bias, gap_blocks=gap_blocks, from_stats=stats)
+                eq_(open(out_vcf).read().replace(basename(self.bam), 'missing.bam'), open(stats_vcf).read())
+
+    def test_downsample_same_for_any_threads(self):
+        tbam, tbai = self.temp_bam(self.bam, self.bai)
+        out_vcf = join(self.tempdir, tbam + '.vcf')
+        results = []
+        for threads in (1, 2):
+            self._C(self.bam, self.ref, out_vcf, None, threads=threads, downsample=5, seed=3)
+            results.append(open(out_vcf).read())
+        eq_(results[0], results[1])
+        rows = list(vcf.Reader(open(out_vcf)))
+        ok_('DS' in vcf.Reader(open(out_vcf)).infos)
+        ok_(any(row.INFO.get('DS') for row in rows))
+
+    def test_bgzip_output(self):
+        tbam, tbai = self.temp_bam(self.bam, self.bai)
+        out_vcf = join(self.tempdir, tbam + '.vcf')
+        self._C(self.bam, self.ref, out_vcf, None, 25, 100, 10, 0.8, 50, 2, bgzip=True)
+        ok_(not exists(out_vcf))
+        ok_(exists(out_vcf + '.gz.tbi'))
+        eq_(24, len(list(vcf.Reader(open(out_vcf + '.gz')))))
+
     def test_runs_single_regionstring(self):
         tbam, tbai = self.temp_bam(self.bam, self.bai)
         out_vcf = join(self.tempdir, tbam + '.vcf')
@@ -1311,7 +1901,7 @@ class TestUnitMain(BaseInty):
         assert self.cmp_vcf(evcf, out_vcf)
 
 class TestIntegrate(BaseInty):
-    def _C(self, bamfile, reffile, vcf_output_file, regionstr=None, minbq=25, maxd=100000, mind=10, minth=0.8, biasth=50, bias=2, threads=2):
+    def _C(self, bamfile, reffile, vcf_output_file, regionstr=None, minbq=25, maxd=100000, mind=10, minth=0.8, biasth=50, bias=2, threads=2, engine='python', pileup_backend='samtools'):
         import subprocess
         script_path = 'base_caller'
         cmd = [script_path, bamfile, reffile]
@@ -1319,7 +1909,7 @@ class TestIntegrate(BaseInty):
             cmd += ['-r', regionstr]
         if vcf_output_file:
             cmd += [vcf_output_file]
-        cmd += ['-minbq', minbq, '-maxd', maxd, '-mind', mind, '-minth', minth, '-biasth', biasth, '-bias', bias, '--threads', threads]
+        cmd += ['-minbq', minbq, '-maxd', maxd, '-mind', mind, '-minth', minth, '-biasth', biasth, '-bias', bias, '--threads', threads, '--engine', engine, '--pileup-backend', pileup_backend]
         cmd = [str(x) for x in cmd]
         #print ' '.join(cmd)
         return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -1384,6 +1974,28 @@ class TestIntegrate(BaseInty):
 
         assert self.cmp_vcf(self.vcf, out_vcf)
 
+    def test_numpy_engine_identical(self):
+        tbam, tbai = self.temp_bam(self.bam, self.bai)
+        out_vcf = join(self.tempdir, tbam + '.vcf')
+        np_vcf = join(self.tempdir, tbam + '.numpy.vcf')
+        p = self._C(self.bam, self.ref, out_vcf, None, 25, 100, 10, 0.8)
+        p.communicate()
+        p = self._C(self.bam, self.ref, np_vcf, None, 25, 100, 10, 0.8, engine='numpy')
+        p.communicate()
+        eq_(0, p.returncode)
+        eq_(open(out_vcf).read(), open(np_vcf).read())
+
+    def test_pysam_backend_identical(self):
+        tbam, tbai = self.temp_bam(self.bam, self.bai)
+        out_vcf = join(self.tempdir, tbam + '.vcf')
+        ps_vcf = join(self.tempdir, tbam + '.pysam.vcf')
+        p = self._C(self.bam, self.ref, out_vcf, None, 25, 100, 10, 0.8)
+        p.communicate()
+        p = self._C(self.bam, self.ref, ps_vcf, None, 25, 100, 10, 0.8, pileup_backend='pysam')
+        p.communicate()
+        eq_(0, p.returncode)
+        eq_(open(out_vcf).read(), open(ps_vcf).read())
+
     def test_nondefault_filesdiffer(self):
         tbam, tbai = self.temp_bam(self.bam, self.bai)
         out_vcf = join(self.tempdir, tbam + '.vcf')
@@ -169,3 +169,57 @@ class TestLines2dFromRegion(Base):
             eq_([0,0], line.get_ydata())
             eq_(1, line.get_linewidth())
             eq_(regiontype, line.get_color())
+
+class TestQualDepth(Base):
+    functionname = 'QualDepth'
+
+    def _col(self, pos, bquals, mquals, ref='Ref1'):
+        from ngs_mapper.samtools import MPileupColumn
+        return MPileupColumn('{0}\t{1}\tN\t{2}\t{3}\t{4}\t{5}'.format(
+            ref, pos, len(bquals), 'A'*len(bquals), bquals, mquals
+        ))
+
+    def test_filters_columns(self):
+        qd = self._C(20, 25)
+        # I=40, 5=20, 5 mapq=20 passes, 4 mapq=19 does not
+        qd.add(self._col(2, 'I5I', '55]'))
+        qd.add(self._col(3, 'II', '44'))
+        qd.add(self._col(4, '55', ']]'))
+        r = qd.qualdepth()
+        eq_(['Ref1'], r.keys())
+        r = r['Ref1']
+        eq_(4, r['length'])
+        eq_([0,2,0,0], r['depths'])
+        eq_('[nan, 40.0, nan, nan]', repr(r['avgquals']))
+        eq_(0, r['mind'])
+        eq_(2, r['maxd'])
+        eq_(40, r['minq'])
+        eq_(40, r['maxq'])
+
+    def test_unmapped_ref_missing(self):
+        qd = self._C(20, 25)
+        qd.add(self._col(1, 'II', '44'))
+        eq_({}, qd.qualdepth())
+
+    def test_update_appends(self):
+        first = self._C(0, 0)
+        first.add(self._col(1, 'I', ']'))
+        second = self._C(0, 0)
+        second.add(self._col(3, '5', ']'))
+        second.add(self._col(1, '?', ']', 'Ref2'))
+        first.update(second)
+        r = first.qualdepth()
+        eq_([1,0,1], r['Ref1']['depths'])
+        eq_(20, r['Ref1']['minq'])
+        eq_(40, r['Ref1']['maxq'])
+        eq_([30.0], r['Ref2']['avgquals'])
+
+    def test_same_as_parse_pileup(self):
+        from ngs_mapper import samtools
+        from ngs_mapper.bqd import parse_pileup
+        bam = join(THIS, 'fixtures', 'base_caller', 'test.bam')
+        expect = parse_pileup(samtools.nogap_mpileup(bam))
+        qd = self._C()
+        for col in samtools.fan_out(samtools.mpileup(bam, None, 0, 0, 100000), [qd]):
+            pass
+        eq_(repr(sorted(expect.items())), repr(sorted(qd.qualdepth().items())))
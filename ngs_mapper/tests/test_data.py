@@ -366,6 +366,57 @@ class TestFileHandle(unittest.TestCase):
             r = data.file_handle('/path/to/file.ext.gz')
             self.assertEqual((mgzip.open.return_value, 'ext'), r)
 
+class TestOpenReads(unittest.TestCase):
+    def test_returns_normal_handle(self):
+        with mock.patch('__builtin__.open') as mopen:
+            r = data.open_reads('/path/to/file.fastq')
+            self.assertEqual(mopen.return_value, r)
+
+    def test_returns_gzip_handle_without_pigz(self):
+        with mock.patch.object(data, 'gzip') as mgzip:
+            with mock.patch.object(data, 'find_executable', return_value=None):
+                r = data.open_reads('/path/to/file.fastq.gz')
+                self.assertEqual(mgzip.open.return_value, r)
+
+    def test_decompresses_with_pigz(self):
+        with mock.patch.object(data, 'find_executable', return_value='/bin/pigz'):
+            with mock.patch.object(data.subprocess, 'Popen') as mpopen:
+                mpopen.return_value.returncode = None
+                mpopen.return_value.wait.return_value = 0
+                r = data.open_reads('/path/to/file.fastq.gz', 4)
+                self.assertEqual(
+                    ['/bin/pigz', '-dc', '-p', '4', '/path/to/file.fastq.gz'],
+                    mpopen.call_args[0][0]
+                )
+                self.assertEqual(mpopen.return_value.stdout.read.return_value, r.read())
+                r.close()
+                mpopen.return_value.stdout.close.assert_called_once_with()
+
+    def test_pigz_error_raises_ioerror(self):
+        with mock.patch.object(data.subprocess, 'Popen') as mpopen:
+            mpopen.return_value.returncode = None
+            mpopen.return_value.wait.return_value = 1
+            r = data.PigzFile('/bin/pigz', '/path/to/file.fastq.gz')
+            self.assertRaises(IOError, r.close)
+
+    def test_pigz_killed_by_sigpipe_not_error(self):
+        with mock.patch.object(data.subprocess, 'Popen') as mpopen:
+            mpopen.return_value.returncode = None
+            mpopen.return_value.wait.return_value = -13
+            r = data.PigzFile('/bin/pigz', '/path/to/file.fastq.gz')
+            r.close()
+
+    def test_pigz_gets_default_sigpipe(self):
+        import signal
+        with mock.patch.object(data.subprocess, 'Popen') as mpopen:
+            data.PigzFile('/bin/pigz', '/path/to/file.fastq.gz')
+        orig = signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+        try:
+            mpopen.call_args[1]['preexec_fn']()
+            self.assertEqual(signal.SIG_DFL, signal.getsignal(signal.SIGPIPE))
+        finally:
+            signal.signal(signal.SIGPIPE, orig)
+
 class TestFilterReadsByPlatform(unittest.TestCase):
     def setUp(self):
         self.patch_seqio = mock.patch('ngs_mapper.data.SeqIO')
@@ -1,4 +1,5 @@
-from ngs_mapper.nfilter import make_filtered, write_filtered, fqs_excluding_indices, write_post_filter, mkdir_p, run_from_config
+from ngs_mapper.nfilter import make_filtered, write_filtered, fqs_excluding_indices, write_post_filter, mkdir_p, run_from_config, \
+    map_to_dir, file_chunks, record_offsets
 
 import os
 import mock
@@ -10,6 +11,7 @@ except ImportError:
         import unittest
 from functools import partial
 from imports import fixtures, join
+from nose.tools import eq_
 
 class TestNGSFilter(unittest.TestCase):
 
@@ -73,6 +75,81 @@ class TestNGSFilter(unittest.TestCase):
             self.assertEquals(len(w), 1)
         #with self.assertRaises(ValueError):
 
+    def test_write_filtered_gzipped(self):
+        import gzip
+        gz = os.path.join(self.outdir, 'in', os.path.basename(self.inputfn) + '.gz')
+        os.mkdir(os.path.dirname(gz))
+        fw = gzip.open(gz, 'wb')
+        fw.write(open(self.inputfn).read())
+        fw.close()
+        outpath = write_filtered(gz, 0, True, outdir=self.outdir)
+        self.assertEquals(self.actualfn, outpath)
+        expected = write_filtered(self.inputfn, 0, True, outdir=os.path.dirname(gz))
+        self.assertFilesEqual(expected, outpath)
+
+    def test_symlink_gzipped_none_filtered(self):
+        gz = os.path.join(self.outdir, 'in.fastq.gz')
+        open(gz, 'w').close()
+        outdir = os.path.join(self.outdir, 'out')
+        os.mkdir(outdir)
+        outpath = write_filtered(gz, 0, False, outdir=outdir)
+        self.assertEquals(os.path.join(outdir, 'in.fastq.gz'), outpath)
+        self.assertTrue(os.path.islink(outpath))
+
+    def test_make_filtered_batches(self):
+        ''' small batches give the same reads and counts as one batch '''
+        whole = list(make_filtered(self.inputfn, 32, True))
+        batches = list(make_filtered(self.inputfn, 32, True, batchsize=1))
+        self.assertEquals(1, len(whole))
+        self.assertEquals(4, len(batches))
+        self.assertEquals(whole[0][:4], tuple(sum(b[i] for b in batches) for i in range(4)))
+        self.assertEquals(whole[0][4], ''.join(b[4] for b in batches))
+
+    def test_make_filtered_lowercase_n(self):
+        fq = os.path.join(self.outdir, 'lower.fastq')
+        with open(fq, 'w') as fh:
+            fh.write('@r1 desc\nACgT\n+r1 desc\nIIII\n@r2\nACnT\n+\nIIII\n')
+        results = list(make_filtered(fq, None, True))
+        eq_([(2, 0, 1, 1, '@r1 desc\nACgT\n+\nIIII\n')], results)
+
+    def test_record_offsets(self):
+        with open(self.inputfn) as fh:
+            lines = fh.readlines()
+        starts = [sum(map(len, lines[:i])) for i in range(0, len(lines), 4)]
+        size = os.path.getsize(self.inputfn)
+        eq_(starts + [size], record_offsets(self.inputfn, 1))
+        eq_(starts + [size], record_offsets(self.inputfn, 1, blocksize=7))
+        eq_([0, starts[3], size], record_offsets(self.inputfn, 3, blocksize=7))
+
+    def test_file_chunks_index_lockstep(self):
+        chunks = file_chunks(self.inputfn, chunksize=1)
+        self.assertEquals(4, len(chunks))
+        index = self.inputfn.replace('_R2_', '_I2_')
+        for readrange, indexrange in chunks:
+            with open(self.inputfn) as fh:
+                fh.seek(readrange[0])
+                read = fh.read(readrange[1] - readrange[0])
+            with open(index) as fh:
+                fh.seek(indexrange[0])
+                idx = fh.read(indexrange[1] - indexrange[0])
+            self.assertEquals(4, len(read.splitlines()))
+            self.assertEquals(read.splitlines()[0], idx.splitlines()[0])
+
+    def test_file_chunks_small_file_not_split(self):
+        eq_([None], file_chunks(self.inputfn))
+
+    def test_map_to_dir_chunked(self):
+        ''' chunks are put back together in order with the same stats '''
+        outpaths = map_to_dir(self.inputdir, 32, True, ['Sanger'], self.outdir, 2, chunksize=1)
+        eq_([self.actualfn], outpaths)
+        self.assertFilesEqual(self.expectedfn, self.actualfn)
+        eq_([os.path.basename(self.actualfn), 'ngs_filter_stats.txt'], sorted(os.listdir(self.outdir)))
+        stats = open(self.statsfile).read()
+        shutil.rmtree(self.outdir)
+        mkdir_p(self.outdir)
+        write_post_filter(self.inputdir, 32, True, ['Sanger'], self.outdir)
+        self.assertEquals(open(self.statsfile).read(), stats)
+
     def test_symlink_file_none_filtered(self):
         write_filtered(self.inputfn, 0, False, outdir=self.outdir)
         self.assertTrue(os.path.islink(self.actualfn))
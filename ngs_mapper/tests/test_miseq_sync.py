@@ -168,7 +168,7 @@ class TestFunctional( FunctionalBase ):
         # Should be links
         rbs = join( readsbysampledir, samplename )
         ok_( exists(rbs), 'Did not create {0}'.format(rbs) )
-        sample_fqs = glob( join( rbs, '{0}_S{1}*.fastq'.format(samplename,sampleid) ) )
+        sample_fqs = glob( join( rbs, '{0}_S{1}*.fastq.gz'.format(samplename,sampleid) ) )
         eq_( 2, len(sample_fqs), 'There were not 2 reads for {0}. Reads found in {1}: {2}'.format(samplename,rbs,sample_fqs) )
         # Every fq in readsbysample should be a link to the runname in readdata
         for fq in sample_fqs:
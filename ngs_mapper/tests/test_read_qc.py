@@ -0,0 +1,100 @@
+from imports import *
+
+class Base(common.BaseClass):
+    modulepath = 'ngs_mapper.read_qc'
+
+    def setUp( self ):
+        super(Base,self).setUp()
+        self.low = ''.join( chr(33 + q) for q in range(20) )
+
+class TestQualityTrim(Base):
+    functionname = 'quality_trim'
+
+    def test_trims_leading_and_trailing( self ):
+        eq_( (2, 5), self._C( '##III##', self.low ) )
+
+    def test_nothing_to_trim( self ):
+        eq_( (0, 4), self._C( 'IIII', self.low ) )
+
+    def test_headcrop_after_quality_trim( self ):
+        eq_( (3, 5), self._C( '##III##', self.low, 1 ) )
+
+    def test_all_low( self ):
+        start, end = self._C( '####', self.low )
+        ok_( start >= end )
+
+class TestTrimRecord(Base):
+    functionname = 'trim_record'
+
+    def test_trims_seq_and_qual( self ):
+        eq_( '@r1 desc\nCGT\n+\nIII\n', self._C( ('@r1 desc', 'ACGTA', '#III#'), self.low ) )
+
+    def test_nothing_left( self ):
+        eq_( None, self._C( ('@r1', 'ACGT', 'IIII'), self.low, 4 ) )
+
+class TestQcReadFiles(Base):
+    functionname = 'qc_read_files'
+
+    def write( self, path, records ):
+        with open( path, 'w' ) as fh:
+            for title, seq, qual in records:
+                fh.write( '@{0}\n{1}\n+\n{2}\n'.format(title, seq, qual) )
+        return path
+
+    def run( self, readpaths, **kwargs ):
+        outpaths = ['F.fq', 'R.fq', 'NP.fq']
+        outfiles = [open(p, 'w') for p in outpaths]
+        stats = self._C( readpaths, outfiles, 20, **kwargs )
+        for fh in outfiles:
+            fh.close()
+        return stats, [open(p).read() for p in outpaths]
+
+    def test_pair_that_loses_a_mate_is_non_paired( self ):
+        f = self.write( 's_R1_.fastq', [('r1', 'AAAA', 'IIII'), ('r2', 'AANA', 'IIII'), ('r3', 'AAAA', '####')] )
+        r = self.write( 's_R2_.fastq', [('r1', 'CCCC', 'IIII'), ('r2', 'CCCC', 'IIII'), ('r3', 'CCCC', 'IIII')] )
+        stats, (F, R, NP) = self.run( [f, r], drop_ns=True )
+        eq_( '@r1\nAAAA\n+\nIIII\n', F )
+        eq_( '@r1\nCCCC\n+\nIIII\n', R )
+        eq_( '@r2\nCCCC\n+\nIIII\n@r3\nCCCC\n+\nIIII\n', NP )
+        eq_( [[3, 0, 1], [3, 0, 0]], stats['filter'] )
+        eq_( [3, 1, 0, 2, 0], stats['trim'] )
+
+    def test_filters_on_index( self ):
+        f = self.write( 's_R1_.fastq', [('r1', 'AAAA', 'IIII'), ('r2', 'AAAA', 'IIII')] )
+        self.write( 's_I1_.fastq', [('r1', 'AA', 'II'), ('r2', 'AA', '#I')] )
+        stats, (F, R, NP) = self.run( [f], idx_qual_min=30, batchsize=1 )
+        eq_( '', F )
+        eq_( '@r1\nAAAA\n+\nIIII\n', NP )
+        eq_( [[2, 1, 0]], stats['filter'] )
+        eq_( [2, 1, 0, 0, 1], stats['trim'] )
+
+    def test_mates_different_lengths( self ):
+        f = self.write( 's_R1_.fastq', [('r1', 'AAAA', 'IIII'), ('r2', 'AAAA', 'IIII')] )
+        r = self.write( 's_R2_.fastq', [('r1', 'CCCC', 'IIII')] )
+        assert_raises( ValueError, self.run, [f, r] )
+
+class TestQcReadsInDir(Base):
+    functionname = 'qc_reads_in_dir'
+
+    def test_writes_read_sets_per_platform( self ):
+        readdir = join( THIS, 'fixtures', 'trim_reads' )
+        r = self._C( readdir, 'trimmed_reads', 20, drop_ns=True )
+        # The only Sanger read has an N and 3 MiSeq pairs lose one mate
+        eq_( sorted(['MiSeq_R1_.fastq', 'MiSeq_R2_.fastq', 'MiSeq.fastq', 'Roche454.fastq']),
+             sorted(basename(p) for p in r) )
+        ok_( exists( join('trimmed_reads', 'ngs_filter_stats.txt') ) )
+        ok_( exists( join('trim_stats', '2952_S14_L001_R1_001_2014_06_13.fastq.trim_stats') ) )
+        for p in r:
+            lines = open(p).read().splitlines()
+            eq_( 0, len(lines) % 4 )
+            for seq, qual in zip(lines[1::4], lines[3::4]):
+                eq_( len(seq), len(qual) )
+                ok_( 'N' not in seq.upper() )
+                ok_( ord(qual[0]) - 33 >= 20 and ord(qual[-1]) - 33 >= 20 )
+        F, R = [open(join('trimmed_reads', 'MiSeq_R{0}_.fastq'.format(i))).read().splitlines()[::4] for i in (1, 2)]
+        eq_( [t.split()[0] for t in F], [t.split()[0] for t in R] )
+
+    def test_only_listed_platforms( self ):
+        readdir = join( THIS, 'fixtures', 'trim_reads' )
+        r = self._C( readdir, 'trimmed_reads', 20, platforms=['Sanger'] )
+        eq_( ['Sanger.fastq'], [basename(p) for p in r] )
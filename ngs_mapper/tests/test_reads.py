@@ -223,6 +223,80 @@ class TestFunctionalCompileReads(Base):
         reads = ['np.sff','np.ab1','np.fastq.gz']
         eq_({'F':None,'R':None,'NP':None}, self._C( [], outputdir ) )
 
+class TestWriteReads(Base):
+    functionname = 'write_reads'
+
+    def setUp( self ):
+        super(TestWriteReads,self).setUp()
+        self.fq = '@r1\nACGT\n+\nIIII\n@r2\nACGT\n+\nIIII\n'
+
+    def test_copies_fastq( self ):
+        with open('in.fastq','w') as fh:
+            fh.write( self.fq )
+        out = StringIO()
+        eq_( 2, self._C( 'in.fastq', out, blocksize=5 ) )
+        eq_( self.fq, out.getvalue() )
+
+    def test_decompresses_gzip( self ):
+        import gzip
+        fh = gzip.open('in.fastq.gz','wb')
+        fh.write( self.fq )
+        fh.close()
+        out = StringIO()
+        eq_( 2, self._C( 'in.fastq.gz', out ) )
+        eq_( self.fq, out.getvalue() )
+
+    def test_adds_missing_newline( self ):
+        with open('in.fastq','w') as fh:
+            fh.write( self.fq[:-1] )
+        out = StringIO()
+        eq_( 2, self._C( 'in.fastq', out ) )
+        eq_( self.fq, out.getvalue() )
+
+    def test_converts_sff( self ):
+        sff = glob( join( fixtures.THIS, 'fixtures', 'reads', '*.sff' ) )[0]
+        out = StringIO()
+        eq_( 100, self._C( sff, out ) )
+        eq_( 400, len( out.getvalue().splitlines() ) )
+
+class TestStreamReads(Base):
+    functionname = 'stream_reads'
+
+    def test_streams_through_pipes( self ):
+        import stat
+        readsdir = join( fixtures.THIS, 'fixtures', 'reads' )
+        sff = glob( join(readsdir,'*.sff') )
+        miseq = tuple( sorted( glob( join(readsdir,'*L001*') ) ) )
+        sanger = glob( join( readsdir, '*0001*' ) )
+        files, streams = self._C( sff + [miseq] + sanger, 'output' )
+        eq_( sorted(['F','R','NP']), sorted(files.keys()) )
+        # Both mates have to be read at once like bwa does
+        fhs = dict( (k, open(files[k])) for k in ('F','R','NP') )
+        for k, fh in fhs.items():
+            ok_( stat.S_ISFIFO( os.stat( files[k] ).st_mode ) )
+        expected = {'F':1000, 'R':1000, 'NP':102}
+        for k, fh in fhs.items():
+            eq_( expected[k]*4, len( fh.read().splitlines() ) )
+            fh.close()
+            eq_( expected[k], streams[k].finish() )
+        eq_( os.stat( miseq[0] ).st_size, streams['F'].size )
+
+    def test_missing_types_are_none( self ):
+        fq = join( fixtures.THIS, 'fixtures', 'reads', 'sample1_F1_1979_01_01_Den2_Den2_0001_A01.fastq' )
+        files, streams = self._C( [fq], 'output' )
+        eq_( None, files['F'] )
+        eq_( None, streams['R'] )
+        with open( files['NP'] ) as fh:
+            fh.read()
+        eq_( 1, streams['NP'].finish() )
+
+    def test_finish_releases_unread_pipe( self ):
+        # More than fits in the pipe buffer
+        fq = join( fixtures.THIS, 'fixtures', 'reads', 'sample1_S1_L001_R1_001_1979_01_01.fastq' )
+        files, streams = self._C( [fq], 'output' )
+        # Nothing ever reads the pipe
+        assert_raises( IOError, streams['NP'].finish )
+
 class TestUnitIsValidRead(Base):
     functionname = 'is_valid_read'
 
@@ -248,6 +322,25 @@ class TestIntegrationCompileReads(Base):
         os.mkdir(outputdir)
         self.run_compile_reads(outputdir)
 
+    def test_compile_reads_gzipped(self):
+        import gzip
+        from ngs_mapper.reads import compile_reads
+        readsdir = join( fixtures.THIS, 'fixtures', 'reads' )
+        miseq = []
+        for fq in sorted( glob( join(readsdir,'*L001*') ) ):
+            gz = basename( fq ) + '.gz'
+            with open( fq, 'rb' ) as fr:
+                fw = gzip.open( gz, 'wb' )
+                fw.write( fr.read() )
+                fw.close()
+            miseq.append( gz )
+        sanger = glob( join( readsdir, '*0001*' ) )
+        result = compile_reads( [tuple(miseq)] + sanger, 'output' )
+        expected_linecounts = {'F': 4000, 'R': 4000, 'NP': 2*4}
+        for k,v in expected_linecounts.items():
+            with open(result[k]) as fh:
+                eq_( v, len(fh.read().splitlines()) )
+
     def run_compile_reads(self,outputdir):
         from ngs_mapper.reads import compile_reads
         readsdir = join( fixtures.THIS, 'fixtures', 'reads' )
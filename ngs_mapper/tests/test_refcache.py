@@ -0,0 +1,132 @@
+from imports import *
+import hashlib
+import time
+
+class Base(BaseClass):
+    modulepath = 'ngs_mapper.refcache'
+
+    def setUp(self):
+        super(Base,self).setUp()
+        self.ref = join(fixtures.THIS, 'fixtures', 'functional', '947.ref.fasta')
+        self.cachedir = join(self.tempdir, 'cache')
+
+    def _entries(self):
+        return [d for d in os.listdir(self.cachedir) if isdir(join(self.cachedir,d))]
+
+class TestFastaSha1(Base):
+    functionname = 'fasta_sha1'
+
+    def test_hashes_contents(self):
+        expect = hashlib.sha1(open(self.ref).read()).hexdigest()
+        eq_(expect, self._C(self.ref))
+        eq_(expect, self._C(self.ref, blocksize=7))
+
+    def test_same_contents_same_key(self):
+        shutil.copy(self.ref, 'other.fasta')
+        eq_(self._C(self.ref), self._C('other.fasta'))
+
+class TestLinkReference(Base):
+    functionname = 'link_reference'
+
+    def test_links_fasta_and_indexes(self):
+        os.mkdir('sample')
+        res = self._C(self.ref, 'sample/ref.fasta', self.cachedir)
+        eq_('sample/ref.fasta', res)
+        eq_(open(self.ref).read(), open(res).read())
+        entry = join(self.cachedir, self._entries()[0])
+        for ext in ('', '.amb', '.ann', '.bwt', '.pac', '.sa', '.fai', '.hpoly3.npz'):
+            ok_(exists(res + ext), 'Missing ' + ext)
+            # Hard linked from the cache instead of copied
+            eq_(os.stat(join(entry, 'reference.fa' + ext)).st_ino, os.stat(res + ext).st_ino)
+
+    def test_reuses_entry(self):
+        self._C(self.ref, 'ref1.fasta', self.cachedir)
+        with patch('ngs_mapper.refcache.build_entry') as build_entry:
+            self._C(self.ref, 'ref2.fasta', self.cachedir)
+            eq_(0, build_entry.call_count)
+        eq_(1, len(self._entries()))
+        ok_(exists('ref2.fasta.bwt'))
+
+    def test_hpoly_index_is_used(self):
+        from ngs_mapper import base_caller
+        self._C(self.ref, 'ref.fasta', self.cachedir)
+        with patch('ngs_mapper.base_caller.hpoly_bitmap') as hpoly_bitmap:
+            base_caller.index_reference('ref.fasta')
+            eq_(0, hpoly_bitmap.call_count)
+
+    def test_replaces_existing_dest(self):
+        shutil.copy(self.ref, 'ref.fasta')
+        self._C('ref.fasta', 'ref.fasta', self.cachedir)
+        eq_(open(self.ref).read(), open('ref.fasta').read())
+        ok_(exists('ref.fasta.sa'))
+
+    def test_compiles_directory(self):
+        os.mkdir('refs')
+        shutil.copy(self.ref, 'refs/ref1.fasta')
+        other = join(fixtures.THIS, 'fixtures', 'functional', '780.ref.fasta')
+        shutil.copy(other, 'refs/ref2.fasta')
+        os.mkdir('sample')
+        res = self._C('refs', 'sample/reference.fa', self.cachedir)
+        eq_(os.stat(self.ref).st_size + os.stat(other).st_size, os.stat(res).st_size)
+        ok_(exists(res + '.bwt'))
+
+    def test_failed_build_leaves_nothing(self):
+        with patch('ngs_mapper.refcache.index_ref', Mock(return_value=False)):
+            assert_raises(ValueError, self._C, self.ref, 'ref.fasta', self.cachedir)
+        eq_([], self._entries())
+
+    def test_evicts_when_maxsize_given(self):
+        shutil.copy(self.ref, 'other.fasta')
+        with open('other.fasta', 'a') as fh:
+            fh.write('>other\nACGT\n')
+        self._C(self.ref, 'ref1.fasta', self.cachedir)
+        first = self._entries()
+        self._C('other.fasta', 'ref2.fasta', self.cachedir, maxsize=1)
+        # Only the entry that was just used is kept
+        eq_(1, len(self._entries()))
+        ok_(first[0] not in self._entries())
+        # Linked files survive eviction
+        ok_(exists('ref1.fasta.bwt'))
+
+class TestEvict(Base):
+    functionname = 'evict'
+
+    def _entry(self, name, size, mtime):
+        entry = join(self.cachedir, name)
+        os.makedirs(entry)
+        with open(join(entry, 'reference.fa'), 'w') as fh:
+            fh.write('A' * size)
+        open(entry + '.lock', 'w').close()
+        os.utime(entry, (mtime, mtime))
+        return entry
+
+    def test_removes_least_recently_used(self):
+        now = time.time()
+        old = self._entry('old', 10, now - 30)
+        mid = self._entry('mid', 10, now - 20)
+        new = self._entry('new', 10, now - 10)
+        eq_([old], self._C(self.cachedir, 20))
+        ok_(not exists(old))
+        ok_(not exists(old + '.lock'))
+        eq_(sorted(['mid', 'new']), sorted(self._entries()))
+
+    def test_under_maxsize(self):
+        now = time.time()
+        self._entry('a', 10, now - 20)
+        self._entry('b', 10, now - 10)
+        eq_([], self._C(self.cachedir, 20))
+        eq_(2, len(self._entries()))
+
+    def test_keeps_most_recent(self):
+        now = time.time()
+        self._entry('a', 10, now - 20)
+        self._entry('b', 10, now - 10)
+        eq_([join(self.cachedir, 'a')], self._C(self.cachedir, 1))
+        eq_(['b'], self._entries())
+
+    def test_ignores_temporary_entries(self):
+        now = time.time()
+        self._entry('.tmpbuilding', 10, now - 30)
+        self._entry('a', 10, now - 10)
+        eq_([], self._C(self.cachedir, 1))
+        ok_(exists(join(self.cachedir, '.tmpbuilding')))
@@ -62,6 +62,60 @@ class TestUnitBWAMem(Base):
         ret = self._C( 'F.fq', ref='ref.fna', output='file.sai', t=8 )
         bwamem_mock.assert_called_with( 'ref.fna', 'F.fq', bwa_path='bwa', t=8 )
 
+class TestUnitStreamBWAMem(Base):
+    def setUp( self ):
+        super(TestUnitStreamBWAMem,self).setUp()
+        from ngs_mapper.run_bwa import StreamBWAMem
+        self.streams = [Mock(readfiles=['F.fq']), Mock(readfiles=['R.fq'])]
+        self.streams[0].finish.return_value = 60
+        self.streams[1].finish.return_value = 40
+        with patch('ngs_mapper.run_bwa.BWAMem.validate_indexed_fasta'):
+            open('F.fq','w').close()
+            open('R.fq','w').close()
+            self.mem = StreamBWAMem( self.streams, 'ref.fa', 'F.fq', 'R.fq', bwa_path='bwa' )
+
+    def test_does_not_read_inputs( self ):
+        from ngs_mapper.run_bwa import StreamBWAMem
+        os.mkfifo( 'P.fq' )
+        with patch('ngs_mapper.run_bwa.BWAMem.validate_indexed_fasta'):
+            # Would block forever if the pipe was opened
+            mem = StreamBWAMem( self.streams, 'ref.fa', 'P.fq', bwa_path='bwa' )
+        eq_( ['ref.fa','P.fq'], mem.args )
+
+    def test_counts_match( self ):
+        stderr = '[M::process] read 80 sequences (100 bp)...\n[M::main_mem] read 20 sequences (10 bp)...\n'
+        eq_( 0, self.mem.bwa_return_code( stderr ) )
+
+    def test_counts_differ( self ):
+        eq_( 1, self.mem.bwa_return_code( '[M::process] read 80 sequences (100 bp)...\n' ) )
+
+    def test_no_reads( self ):
+        self.streams[0].finish.return_value = 0
+        self.streams[1].finish.return_value = 0
+        eq_( 1, self.mem.bwa_return_code( '' ) )
+
+    def test_stream_error( self ):
+        self.streams[1].finish.side_effect = IOError( 32, 'Broken pipe' )
+        stderr = '[M::process] read 100 sequences (100 bp)...\n'
+        eq_( 1, self.mem.bwa_return_code( stderr ) )
+
+class TestUnitMappingJobs(Base):
+    functionname = 'mapping_jobs'
+
+    def test_paired_and_nonpaired( self ):
+        res = self._C( {'F':'F.fq','R':'R.fq','NP':'NP.fq'}, 'out', 'rg' )
+        eq_( [(('F.fq','R.fq'),'out/paired.bam','rg',None),(('NP.fq',),'out/nonpaired.bam','rg',None)], res )
+
+    def test_nonpaired_only( self ):
+        res = self._C( {'F':None,'R':None,'NP':'NP.fq'}, 'out', 'rg' )
+        eq_( [(('NP.fq',),'out/nonpaired.bam','rg',None)], res )
+
+    def test_streams( self ):
+        streams = {'F':'Fs','R':'Rs','NP':'NPs'}
+        res = self._C( {'F':'F.fq','R':'R.fq','NP':'NP.fq'}, 'out', 'rg', streams )
+        eq_( ('Fs','Rs'), res[0][3] )
+        eq_( ('NPs',), res[1][3] )
+
 class TestUnitParseArgs(Base):
     functionname = 'parse_args'
 
@@ -110,7 +164,19 @@ class TestUnitParseArgs(Base):
         res = self._C( ['fake_read', 'fake_ref', '-t', '5'] )
         eq_( res.threads, 5 )
 
+    def test_stream_reads( self ):
+        eq_( False, self._C( ['fake_read', 'fake_ref'] ).stream_reads )
+        eq_( True, self._C( ['fake_read', 'fake_ref', '--stream-reads'] ).stream_reads )
+
+    def test_ref_cache( self ):
+        res = self._C( ['fake_read', 'fake_ref', '--ref-cache', 'cache', '--ref-cache-size', '10'] )
+        eq_( res.ref_cache, 'cache' )
+        eq_( res.ref_cache_size, 10 )
+
 # Pretty sure this isn't the way to do this, but I'm learning here
+@patch('ngs_mapper.run_bwa.get_bam_header', Mock(return_value='@HD\tVN:1.3\n@SQ\tSN:ref\tLN:10\n@RG\tID:MiSeq\tSM:out\tPL:ILLUMINA'))
+@patch('ngs_mapper.run_bwa.index_ref', Mock(return_value=True))
+@patch('os.path.getsize', Mock(return_value=10))
 @patch('shutil.move')
 @patch('shutil.rmtree')
 @patch('ngs_mapper.run_bwa.parse_args')
@@ -118,7 +184,7 @@ class TestUnitParseArgs(Base):
 @patch('ngs_mapper.bam.indexbam')
 @patch('ngs_mapper.bam.samtobam')
 @patch('ngs_mapper.bam.sortbam')
-@patch('ngs_mapper.run_bwa.bwa_mem')
+@patch('ngs_mapper.run_bwa.bwa_mem_bam')
 @patch('ngs_mapper.run_bwa.compile_reads')
 @patch('ngs_mapper.run_bwa.reads_by_plat')
 @patch('ngs_mapper.run_bwa.compile_refs')
@@ -146,18 +212,21 @@ class TestUnitMain(Base):
         compile_reads_mock.return_value = {'F':'F.fq','R':'R.fq','NP':None}
         parse_args.return_value = Mock(
             reads='/reads', reference='/reference.fa', platforms=['MiSeq','Sanger'],
-            keep_temp=False, threads=1, output='tdir/out.bam'
+            keep_temp=False, threads=1, output='tdir/out.bam', SM=None, CN=None, ref_cache=None, stream_reads=False
         )
         bwa_mem_mock.return_value = 'tdir/out.bam'
 
+    # Read groups are given to bwa with escaped tabs
+    miseq_rg = '@RG\\tID:MiSeq\\tSM:out\\tPL:ILLUMINA'
+    sanger_rg = '@RG\\tID:Sanger\\tSM:out\\tPL:CAPILLARY'
+
     def test_paired_readfiles(self, *mocks):
         self._setUp(*mocks)
         res = self._C()
-        eq_( [call('F.fq','R.fq','/reference.fa','tdir/bwa/paired.sai',t=1)], self.bwa_mem_mock.call_args_list )
-        eq_( [call([('r1.fq','r2.fq')],'tdir/bwa/reads')], self.compile_reads_mock.call_args_list )
+        # A single job is sorted straight into the output
+        eq_( [call('F.fq','R.fq','/reference.fa','tdir/out.bam',None,None,t=1,R=self.miseq_rg)], self.bwa_mem_mock.call_args_list )
+        eq_( [call([('r1.fq','r2.fq')],'tdir/bwa/MiSeq/reads')], self.compile_reads_mock.call_args_list )
         eq_( [call('/reads')], self.reads_mock.call_args_list )
-        eq_( self.sort.call_count, 1 )
-        eq_( self.convert.call_count, 1 )
         eq_( self.index.call_count, 1 )
         self.shrmtree.assert_called_with('tdir/bwa')
 
@@ -168,46 +237,95 @@ class TestUnitMain(Base):
         self.compile_reads_mock.return_value = {'F':None,'R':None,'NP':'NP.fq'}
 
         res = self._C()
-        eq_( [call('NP.fq',ref='/reference.fa',output='tdir/bwa/nonpaired.sai',t=1)], self.bwa_mem_mock.call_args_list )
-        eq_( [call(['r1.fq'],'tdir/bwa/reads')], self.compile_reads_mock.call_args_list )
+        eq_( [call('NP.fq',ref='/reference.fa',output='tdir/out.bam',level=None,streams=None,t=1,R=self.sanger_rg)], self.bwa_mem_mock.call_args_list )
+        eq_( [call(['r1.fq'],'tdir/bwa/Sanger/reads')], self.compile_reads_mock.call_args_list )
         eq_( [call('/reads')], self.reads_mock.call_args_list )
-        eq_( self.sort.call_count, 1 )
-        eq_( self.convert.call_count, 1 )
         eq_( self.index.call_count, 1 )
         self.shrmtree.assert_called_with('tdir/bwa')
     
     def test_paired_and_nonpaired_readfiles(self, *mocks):
         self._setUp(*mocks)
         self.reads_mock.return_value = {'MiSeq':[('r1.fq','r2.fq')],'Sanger':['r3.fq']}
-        self.compile_reads_mock.return_value = {'F':'F.fq','R':'R.fq','NP':'NP.fq'}
+        self.compile_reads_mock.side_effect = [
+            {'F':'F.fq','R':'R.fq','NP':None},
+            {'F':None,'R':None,'NP':'NP.fq'}
+        ]
+        self.bwa_mem_mock.side_effect = lambda *args, **kwargs: kwargs['output'] if 'output' in kwargs else args[3]
         res = self._C()
 
-        eq_( [call('F.fq','R.fq','/reference.fa','tdir/bwa/paired.sai',t=1),call('NP.fq',ref='/reference.fa',output='tdir/bwa/nonpaired.sai',t=1)], self.bwa_mem_mock.call_args_list )
-        eq_( [call([('r1.fq','r2.fq'),'r3.fq'],'tdir/bwa/reads')], self.compile_reads_mock.call_args_list )
+        eq_( [call('F.fq','R.fq','/reference.fa','tdir/bwa/MiSeq/paired.bam',1,None,t=1,R=self.miseq_rg),call('NP.fq',ref='/reference.fa',output='tdir/bwa/Sanger/nonpaired.bam',level=1,streams=None,t=1,R=self.sanger_rg)], self.bwa_mem_mock.call_args_list )
+        eq_( [call([('r1.fq','r2.fq')],'tdir/bwa/MiSeq/reads'),call(['r3.fq'],'tdir/bwa/Sanger/reads')], self.compile_reads_mock.call_args_list )
         eq_( [call('/reads')], self.reads_mock.call_args_list )
-        eq_( 2, self.sort.call_count )
-        eq_( 2, self.convert.call_count )
         eq_( 1, self.index.call_count )
-        eq_( 1, self.merge.call_count )
+        eq_( [call(['tdir/bwa/MiSeq/paired.bam','tdir/bwa/Sanger/nonpaired.bam'],'tdir/out.bam','tdir/bwa/header.sam',1)], self.merge.call_args_list )
+        # Header keeps both read groups
+        eq_(
+            '@HD\tVN:1.3\n@SQ\tSN:ref\tLN:10\n' \
+            '@RG\tID:MiSeq\tSM:out\tPL:ILLUMINA\n@RG\tID:Sanger\tSM:out\tPL:CAPILLARY\n',
+            open('tdir/bwa/header.sam').read()
+        )
         self.shrmtree.assert_called_with('tdir/bwa')
 
+    def test_sets_sm_and_cn(self, *mocks):
+        self._setUp(*mocks)
+        self.parse_args.return_value.SM = 'sample1'
+        self.parse_args.return_value.CN = 'center'
+        res = self._C()
+        eq_(
+            '@RG\\tID:MiSeq\\tSM:sample1\\tCN:center\\tPL:ILLUMINA',
+            self.bwa_mem_mock.call_args[1]['R']
+        )
+
+    @patch('ngs_mapper.run_bwa.refcache.link_reference')
+    def test_uses_ref_cache(self, *mocks):
+        link_reference = mocks[0]
+        self._setUp(*mocks[1:])
+        link_reference.return_value = 'tdir/bwa/reference.fa'
+        self.parse_args.return_value.ref_cache = 'cache'
+        self.parse_args.return_value.ref_cache_size = 1
+        res = self._C()
+        link_reference.assert_called_once_with( '/reference.fa', 'tdir/bwa/reference.fa', 'cache', 1024*1024 )
+        eq_( 'tdir/bwa/reference.fa', self.bwa_mem_mock.call_args[0][2] )
+
+    @patch('ngs_mapper.run_bwa.stream_reads')
+    def test_streams_reads(self, *mocks):
+        stream_reads = mocks[0]
+        self._setUp(*mocks[1:])
+        self.compile_reads_mock.side_effect = AssertionError("Should not compile reads when streaming")
+        F, R = Mock(size=30), Mock(size=30)
+        stream_reads.return_value = (
+            {'F':'F.fq','R':'R.fq','NP':None},
+            {'F':F,'R':R,'NP':None}
+        )
+        self.parse_args.return_value.stream_reads = True
+        res = self._C()
+        eq_( [call([('r1.fq','r2.fq')],'tdir/bwa/MiSeq/reads')], stream_reads.call_args_list )
+        eq_( [call('F.fq','R.fq','/reference.fa','tdir/out.bam',None,(F,R),t=1,R=self.miseq_rg)], self.bwa_mem_mock.call_args_list )
+
     def test_keeptemp(self, *mocks):
         self._setUp(*mocks)
         self.shrmtree.side_effect = AssertionError("Should not remove files with keeptemp option")
-        self.parse_args.return_value = Mock(reads='/reads', reference='/reference.fa', platforms=['MiSeq','Sanger'], keep_temp=True, threads=1, output='tdir/out.bam')
+        self.parse_args.return_value = Mock(reads='/reads', reference='/reference.fa', platforms=['MiSeq','Sanger'], keep_temp=True, threads=1, output='tdir/out.bam', SM=None, CN=None, ref_cache=None, stream_reads=False)
         res = self._C()
         eq_( 0, self.shrmtree.call_count )
 
     def test_utilizes_thread_arg(self, *mocks):
         self._setUp(*mocks)
         self.reads_mock.return_value = {'MiSeq':[('r1.fq','r2.fq')],'Sanger':['r3.fq']}
-        self.compile_reads_mock.return_value = {'F':'F.fq','R':'R.fq','NP':'NP.fq'}
-        self.parse_args.return_value = Mock(reads='reads', reference='reference.fa', platforms=['MiSeq','Sanger'], keep_temp=False, threads=8, output='tdir/out.bam')
+        self.compile_reads_mock.side_effect = [
+            {'F':'F.fq','R':'R.fq','NP':None},
+            {'F':None,'R':None,'NP':'NP.fq'}
+        ]
+        self.parse_args.return_value = Mock(reads='reads', reference='reference.fa', platforms=['MiSeq','Sanger'], keep_temp=False, threads=8, output='tdir/out.bam', SM=None, CN=None, ref_cache=None, stream_reads=False)
         res = self._C()
-        self.bwa_mem_mock.assert_called_with('NP.fq', ref='reference.fa', output='tdir/bwa/nonpaired.sai', t=8)
+        # Threads are split by read size(paired job has twice the reads)
+        self.bwa_mem_mock.assert_any_call('F.fq', 'R.fq', 'reference.fa', 'tdir/bwa/MiSeq/paired.bam', 1, None, t=5, R=self.miseq_rg)
+        self.bwa_mem_mock.assert_any_call('NP.fq', ref='reference.fa', output='tdir/bwa/Sanger/nonpaired.bam', level=1, streams=None, t=3, R=self.sanger_rg)
+        eq_( 8, self.merge.call_args[0][3] )
 
     @attr('current')
     def test_bwa_error_should_raise_exception(self,*args):
+        self._setUp(*args)
         with patch('ngs_mapper.run_bwa.os') as os:
             from ngs_mapper.run_bwa import BWAError
             bwa_mem_mock = args[4]
@@ -302,6 +420,23 @@ class TestIntegrateMainArgs(Base):
         assert not os.path.exists( 'sampledir/bwa' ), "Temp directory still exists"
         assert os.path.exists( 'sampledir/out.bam.bai' )
 
+    def test_stream_reads(self):
+        sff = glob( join( fixtures.THIS, 'fixtures', 'reads', '*.sff' ) )[0]
+        shutil.copy( sff, 'expected/reads' )
+        ff = self.fixture_files
+        res = 'sampledir/out.bam'
+        argv = ['expected/reads', ff['REF'], '--stream-reads', '--output', res]
+        self._CM( argv )
+        out = compat.check_output( ['samtools', 'view', res] )
+        eq_( 100, out.count( 'IA52U1' ), 'Sff file reads did not make it into bam file' )
+        # Same reads as compiling them first
+        os.unlink( join( 'expected', 'reads', basename( sff ) ) )
+        res = 'sampledir/out2.bam'
+        self._CM( ['expected/reads', ff['REF'], '--stream-reads', '--output', res] )
+        expected = compat.check_output( ['samtools', 'view', ff['merged.bam']] )
+        out = compat.check_output( ['samtools', 'view', res] )
+        eq_( len( expected.splitlines() ), len( out.splitlines() ) )
+
     def test_output_path(self):
         ff = self.fixture_files
         res = 'merged.bam'
@@ -142,6 +142,7 @@ class TestFunctional(Base):
         efiles.append( (f,join( outdir, 'flagstats.txt') ) )
         efiles.append( (f,join( outdir, prefix + '.std.log') ) )
         efiles.append( (f,join( outdir, prefix + '.log') ) )
+        efiles.append( (f,join( outdir, 'checkpoints.json') ) )
         efiles.append( (f,bamfile + '.vcf') )
         efiles.append( (d,join( outdir, 'qualdepth') ) )
         efiles.append( (d,join( outdir, 'trimmed_reads' )) )
@@ -164,7 +165,7 @@ class TestFunctional(Base):
         projdir = 'outdir'
         prefix = 'testsample'
         from ngs_mapper.config import make_example_config
-        configfile = make_example_config()
+        configfile = make_example_config(self.tempdir)
 
         out,ret = self._run_runsample( self.reads_by_sample, self.ref, prefix, projdir, configfile )
         print out
@@ -226,6 +227,37 @@ class TestFunctional(Base):
         assert isdir( 'outdir' )
         self._ensure_expected_output_files( 'outdir', 'tests' )
 
+    def test_resume_only_runs_stale_stages( self ):
+        out,ret = self._run_runsample( self.reads_by_sample, self.ref, 'tests', 'outdir' )
+        eq_( 0, ret )
+        cmd = 'runsample {0} {1} tests -od outdir --resume -minth 0.9'.format(self.reads_by_sample, self.ref)
+        compat.check_output( shlex.split(cmd), stderr=subprocess.STDOUT )
+        self._ensure_expected_output_files( 'outdir', 'tests' )
+        log = open( join('outdir', 'tests.log') ).read()
+        # ngs_filter runs again because its symlinks point into the directory of the first run
+        for stage in ('convert_formats', 'trim_reads', 'run_bwa_on_samplename', 'flagstat', 'fqstats'):
+            ok_( 'Skipping {0} because it is up to date'.format(stage) in log, stage )
+        for stage in ('base_caller', 'graphsample', 'vcf_consensus'):
+            eq_( 2, log.count( 'Finished stage {0} '.format(stage) ), stage )
+
+    def test_resume_unfinished( self ):
+        out,ret = self._run_runsample( self.reads_by_sample, self.ref, 'tests', 'outdir' )
+        eq_( 0, ret )
+        # Looks like a run that died after mapping
+        tdir = join( 'outdir', 'testsXYZrunsample' )
+        os.mkdir( tdir )
+        for f in os.listdir( 'outdir' ):
+            if f != basename(tdir):
+                shutil.move( join('outdir', f), tdir )
+        os.unlink( join(tdir, 'tests.bam.consensus.fasta') )
+        cmd = 'runsample {0} {1} tests -od outdir --resume'.format(self.reads_by_sample, self.ref)
+        compat.check_output( shlex.split(cmd), stderr=subprocess.STDOUT )
+        self._ensure_expected_output_files( 'outdir', 'tests' )
+        ok_( not exists( tdir ) )
+        log = open( join('outdir', 'tests.log') ).read()
+        eq_( 2, log.count( 'Finished stage vcf_consensus ' ) )
+        eq_( 1, log.count( 'Finished stage base_caller ' ) )
+
     def test_ensure_proper_log( self ):
         # Just check that logfile gets stuff in it
         outdir = 'outdir'
@@ -312,3 +344,48 @@ class TestUnitArgs(unittest.TestCase):
         res = runsample.parse_args(args)
         args, qsub_args = res
         eq_(args.drop_ns, True)
+
+    def test_ref_cache(self):
+        args = [
+            'ReadsBySample','Reference.fasta','Sample1',
+            '--ref-cache', 'refcache', '--ref-cache-size', '100'
+        ]
+        args, qsub_args = runsample.parse_args(args)
+        eq_(args.ref_cache, 'refcache')
+        eq_(args.ref_cache_size, 100)
+
+    def test_resume(self):
+        args = [
+            'ReadsBySample','Reference.fasta','Sample1', '--resume'
+        ]
+        args, qsub_args = runsample.parse_args(args)
+        eq_(args.resume, True)
+
+    def test_threads(self):
+        args = [
+            'ReadsBySample','Reference.fasta','Sample1', '--threads', '4'
+        ]
+        args, qsub_args = runsample.parse_args(args)
+        eq_(args.threads, 4)
+        eq_(
+            set(['ngs_filter', 'trim_reads', 'run_bwa_on_samplename', 'base_caller']),
+            set(args.stage_threads)
+        )
+
+class TestResumeDir(Base):
+    functionname = 'resume_dir'
+
+    def test_no_unfinished_run( self ):
+        os.mkdir( 'outdir' )
+        eq_( None, self._C( 'outdir', 'sample' ) )
+
+    def test_skips_empty( self ):
+        os.makedirs( join('outdir', 'sampleABCrunsample') )
+        eq_( None, self._C( 'outdir', 'sample' ) )
+
+    def test_newest( self ):
+        for i, d in enumerate( ('sampleAAArunsample', 'sampleBBBrunsample') ):
+            os.makedirs( join('outdir', d) )
+            open( join('outdir', d, 'sample.log'), 'w' ).close()
+            os.utime( join('outdir', d), (i, i) )
+        eq_( join('outdir', 'sampleBBBrunsample'), self._C( 'outdir', 'sample' ) )
@@ -0,0 +1,112 @@
+from imports import *
+
+class Base(common.BaseClass):
+    modulepath = 'ngs_mapper.runsamplesheet'
+
+class TestReadSamplesheet(Base):
+    functionname = 'read_samplesheet'
+
+    def test_reads_pairs( self ):
+        open( 'ref.fasta', 'w' ).close()
+        with open( 'samplesheet.tsv', 'w' ) as fh:
+            fh.write( '#sample\treference\n' )
+            fh.write( 's1\tref.fasta\r\n' )
+            fh.write( 's2 ref.fasta\n' )
+            fh.write( '\n' )
+            fh.write( 's3\n' )
+            fh.write( 's4\tmissing.fasta\n' )
+        eq_( [('s1', 'ref.fasta'), ('s2', 'ref.fasta')], self._C( 'samplesheet.tsv' ) )
+
+class TestSamplesAtOnce(Base):
+    functionname = 'samples_at_once'
+
+    def test_limited_by_memory( self ):
+        eq_( 2, self._C( 8, 4096, 2048 ) )
+
+    def test_limited_by_cores( self ):
+        eq_( 4, self._C( 4, 65536, 2048 ) )
+
+    def test_no_memory_limit( self ):
+        eq_( 4, self._C( 4, None, 2048 ) )
+
+    def test_at_least_one( self ):
+        eq_( 1, self._C( 4, 1024, 2048 ) )
+
+class TestSampleStatus(Base):
+    functionname = 'sample_status'
+
+    def test_new( self ):
+        eq_( 'new', self._C( 's1' ) )
+        os.mkdir( 's1' )
+        eq_( 'new', self._C( 's1' ) )
+
+    def test_done( self ):
+        os.mkdir( 's1' )
+        open( join('s1', 's1.log'), 'w' ).close()
+        eq_( 'done', self._C( 's1' ) )
+
+    def test_partial( self ):
+        os.makedirs( join('s1', 's1abcdrunsample') )
+        eq_( 'partial', self._C( 's1' ) )
+
+class TestRunSamplesheet(Base):
+    functionname = 'run_samplesheet'
+
+    @patch('ngs_mapper.runsamplesheet.POLL_INTERVAL', 0)
+    @patch('ngs_mapper.runsamplesheet.subprocess')
+    def test_runs_samples_that_did_not_finish( self, msubprocess ):
+        os.makedirs( join('Projects', 'done') )
+        open( join('Projects', 'done', 'done.log'), 'w' ).close()
+        msubprocess.Popen.return_value.poll.return_value = 0
+        r = self._C( 'reads', [('done', 'ref.fasta'), ('new', 'ref.fasta')], 'Projects', 4, 2, ['-minth', '0.9'] )
+        eq_( {'new': 0}, r )
+        eq_( 1, msubprocess.Popen.call_count )
+        cmd = msubprocess.Popen.call_args[0][0]
+        eq_( ['runsample', join('reads','new'), 'ref.fasta', 'new', '-od', join('Projects','new'),
+              '--threads', '4', '-minth', '0.9'], cmd )
+        ok_( 'NGS_MAPPER_BUDGET' in msubprocess.Popen.call_args[1]['env'] )
+
+    @patch('ngs_mapper.runsamplesheet.POLL_INTERVAL', 0)
+    @patch('ngs_mapper.runsamplesheet.subprocess')
+    def test_resumes( self, msubprocess ):
+        os.makedirs( join('Projects', 'done') )
+        open( join('Projects', 'done', 'done.log'), 'w' ).close()
+        os.makedirs( join('Projects', 'partial', 'partialabcrunsample') )
+        msubprocess.Popen.return_value.poll.return_value = 0
+        r = self._C( 'reads', [('done', 'ref.fasta'), ('partial', 'ref.fasta')], 'Projects', 4, 2 )
+        eq_( {'partial': 0}, r )
+        ok_( '--resume' in msubprocess.Popen.call_args[0][0] )
+        r = self._C( 'reads', [('done', 'ref.fasta')], 'Projects', 4, 2, resume=True )
+        eq_( {'done': 0}, r )
+        ok_( '--resume' in msubprocess.Popen.call_args[0][0] )
+
+    @patch('ngs_mapper.runsamplesheet.POLL_INTERVAL', 0)
+    @patch('ngs_mapper.runsamplesheet.subprocess')
+    def test_refills_budget_after_killed_sample( self, msubprocess ):
+        from ngs_mapper.stages import SharedBudget
+        free = []
+        def popen( cmd, env ):
+            budget = SharedBudget( env['NGS_MAPPER_BUDGET'] )
+            free.append( budget.acquire( 4 ) )
+            os.close( budget.fd )
+            p = Mock()
+            # First sample is killed while it holds all of the threads
+            p.poll.return_value = -9 if len(free) == 1 else 0
+            return p
+        msubprocess.Popen.side_effect = popen
+        r = self._C( 'reads', [('s1', 'ref.fasta'), ('s2', 'ref.fasta')], 'Projects', 4, 1 )
+        eq_( {'s1': -9, 's2': 0}, r )
+        eq_( [4, 4], free )
+
+class TestStageThroughput(Base):
+    functionname = 'stage_throughput'
+
+    def test_summarizes_stages( self ):
+        for sample, secs in (('s1', 10.0), ('s2', 30.0)):
+            os.mkdir( sample )
+            with open( join(sample, sample + '.log'), 'w' ) as fh:
+                fh.write( '2016-01-01 00:00:00,000 -- INFO -- runsample Finished stage base_caller in {0:.1f} seconds\n'.format(secs) )
+                fh.write( '2016-01-01 00:00:00,000 -- INFO -- runsample Finished stage flagstat in 1.0 seconds\n' )
+        r = self._C( ['s1', 's2'] )
+        eq_( ('base_caller', 2, 40.0, 20.0, 180.0), r[0] )
+        eq_( ('flagstat', 2, 2.0, 1.0, 3600.0), r[1] )
@@ -8,6 +8,21 @@ from mock import MagicMock, patch, Mock, call
 from os.path import *
 import os
 
+def quals( hist ):
+    ''' Sorted list of the qualities in a qual_hist '''
+    import numpy as np
+    from ngs_mapper.samtools import QUALS
+    return np.repeat( QUALS, hist ).tolist()
+
+def plain_stats( stats ):
+    ''' base_stats with the histograms turned into lists so they compare '''
+    plain = {}
+    for k, v in stats.items():
+        if isinstance( v, dict ):
+            v = dict( (sk, getattr(sv, 'tolist', lambda: sv)()) for sk, sv in v.items() )
+        plain[k] = v
+    return plain
+
 class Base(common.BaseBaseCaller):
     modulepath = 'ngs_mapper.samtools'
 
@@ -101,6 +116,15 @@ class TestProp(Base):
         eq_( 5, a.a )
         eq_( 5.1, a.b )
 
+    def test_slots( self ):
+        class A(object):
+            __slots__ = ('_a',)
+            a = self._C( '_a', int )
+        a = A()
+        a.a = '5'
+        eq_( 5, a.a )
+        eq_( 5, a._a )
+
 ########### SamRow Tests ################
 class SamRowBase(Base):
     functionname = 'SamRow'
@@ -132,6 +156,16 @@ class TestSamRow(SamRowBase):
         r = self._C( self.row[:-1] )
         eq_( '', r._tags )
 
+    def test_no_instance_dict( self ):
+        r = self._C( self.row[:-1] )
+        ok_( not hasattr( r, '__dict__' ) )
+        r.POS = '5'
+        eq_( 5, r.POS )
+
+    def test_qual_array( self ):
+        r = self._C( self.row[:-1] )
+        eq_( [40]*8, r.qual_array.tolist() )
+
 class TestUnitSamRowStr(SamRowBase):
     def test_samestring_notags( self ):
         r = self._C( self.row[:-1] )
@@ -273,6 +307,20 @@ class TestNoGapMpileup(MpileupBase):
         for ex, re in zip(expected,list(r)):
             eq_(ex.split(), re.split())
 
+class TestFaidx(Base):
+    functionname = 'faidx'
+
+    def test_indexes_fasta(self):
+        import shutil
+        shutil.copy(join(fixtures.THIS, 'fixtures', 'functional', '947.ref.fasta'), 'ref.fasta')
+        eq_('ref.fasta.fai', self._C('ref.fasta'))
+        ok_(exists('ref.fasta.fai'))
+        eq_('Den4/AY618992_1/Thailand/2001/Den4_1', open('ref.fasta.fai').read().split('\t')[0])
+
+    @raises(ValueError)
+    def test_invalid_fasta(self):
+        self._C('missing.fasta')
+
 class TestUnitCharToQual(Base):
     functionname = 'char_to_qual'
 
@@ -288,6 +336,108 @@ class TestUnitCharToQual(Base):
     def check_correct( self, e, c ):
         eq_( e, self._C( c ) )
 
+class TestQualHist(Base):
+    functionname = 'qual_hist'
+
+    def test_counts_qualities( self ):
+        from ngs_mapper.samtools import MAX_QUAL, hist_count, hist_sum
+        r = self._C( [40,10,40,0] )
+        eq_( (MAX_QUAL+1,), r.shape )
+        eq_( [1,1,2], [r[0], r[10], r[40]] )
+        eq_( 4, hist_count( r ) )
+        eq_( 90, hist_sum( r ) )
+
+    def test_caps_at_max_qual( self ):
+        from ngs_mapper.samtools import MAX_QUAL
+        r = self._C( [93, 120, 255] )
+        eq_( (MAX_QUAL+1,), r.shape )
+        eq_( 3, r[MAX_QUAL] )
+
+    def test_empty( self ):
+        eq_( 0, self._C( [] ).sum() )
+
+class TestBaseHists(Base):
+    functionname = 'base_hists'
+
+    def test_first_appearance_order( self ):
+        import numpy as np
+        bases = np.frombuffer( 'CCAC*', dtype=np.uint8 )
+        codes, first, hists = self._C( bases, np.array([20,40,0,40,20], dtype=np.uint8) )
+        eq_( 'CA*', ''.join( map(chr, codes) ) )
+        eq_( [0,2,4], first.tolist() )
+        eq_( [20,40,40], quals( hists[0] ) )
+        eq_( [0], quals( hists[1] ) )
+        eq_( [20], quals( hists[2] ) )
+
+    def test_empty( self ):
+        import numpy as np
+        codes, first, hists = self._C( np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.uint8) )
+        eq_( (0, 94), hists.shape )
+
+class TestDownsampleColumn(Base):
+    functionname = 'downsample_column'
+
+    def col( self, bases='A'*700 + 'C'*300, mquals=True ):
+        from ngs_mapper.samtools import MPileupColumn
+        depth = len(bases)
+        s = 'Ref1\t5\tA\t{0}\t{1}\t{2}\t{3}'.format(depth, bases, '5I'*(depth//2), ']'*depth if mquals else '')
+        return MPileupColumn( s )
+
+    def test_shallow_column_unchanged( self ):
+        col = self.col()
+        ok_( col is self._C( col, 1000 ) )
+
+    def test_keeps_maxdepth_in_order( self ):
+        col = self.col( 'ACGT'*250 )
+        r = self._C( col, 100 )
+        eq_( ('Ref1', 5, 100), (r.ref, r.pos, r.depth) )
+        eq_( 100, len(r.bquals) )
+        eq_( [60]*100, r.mquals )
+        # Picked bases are in the order they are in the column
+        it = iter( col )
+        for b, q, m in r:
+            ok_( any( (b, q) == (b2, q2) for b2, q2, m2 in it ) )
+
+    def test_keeps_frequencies( self ):
+        r = self._C( self.col(), 200 )
+        ok_( 120 <= r.bases.count( 'A' ) <= 160 )
+
+    def test_same_seed_same_bases( self ):
+        col = self.col()
+        eq_( str(self._C( col, 100, 1 )), str(self._C( self.col(), 100, 1 )) )
+        ok_( str(self._C( col, 100, 1 )) != str(self._C( col, 100, 2 )) )
+
+    def test_missing_mquals( self ):
+        r = self._C( self.col( mquals=False ), 10 )
+        eq_( [0]*10, r.mquals )
+
+    def test_most_of_column( self ):
+        col = self.col()
+        r = self._C( col, 900 )
+        eq_( 900, r.depth )
+        ok_( 600 <= r.bases.count( 'A' ) <= 660 )
+
+    def test_bam_column( self ):
+        import numpy as np
+        from ngs_mapper.samtools import BamPileupColumn
+        col = self.col()
+        bcol = BamPileupColumn(
+            col.ref, col.pos, col.base_array, col.bqual_array, np.array( col.mquals, dtype=np.uint8 )
+        )
+        eq_( str(self._C( col, 100, 1 )), str(self._C( bcol, 100, 1 )) )
+
+class TestTake(Base):
+    functionname = 'MPileupColumn'
+
+    def test_picked_bases_only( self ):
+        import numpy as np
+        col = self._C( 'Ref1\t5\tA\t4\t^]C.$+1Ag,\t!5I~\t]]?]' )
+        r = col.take( np.array([1, 2]) )
+        eq_( ('Ref1', 5, 2), (r.ref, r.pos, r.depth) )
+        eq_( 'AG', r.bases )
+        eq_( [20, 40], r.bquals )
+        eq_( [60, 30], r.mquals )
+
 ########### MPileupColumn Tests ################
 class MpileupBase(Base):
     functionname = 'MPileupColumn'
@@ -308,13 +458,59 @@ class TestUnitBases(MpileupBase):
         r = self._C( str )
         eq_( 'G*AGAAAAAA', r.bases )
 
+    def test_readstart_mapq_looks_like_indel( self ):
+        str = 'Ref1	1	A	4	^+A^-.$^2C+1g,	IIII	]]]]'
+        r = self._C( str )
+        eq_( 'AACA', r.bases )
+        eq_( [('+', 'g')], r.indels )
+
     def test_endreadbeginread( self ):
         str = 'Ref1	1	N	10	A^]A$AAAAAAAA	IIIIIIIIII	]]]]]]]]]]'
         r = self._C( str )
         eq_( 'AAAAAAAAAA', r.bases )
 
+    def test_readstart_mapq_looks_like_token( self ):
+        str = 'Ref1	1	A	4	^+.^$,^^A^1C	IIII	]]]]'
+        r = self._C( str )
+        eq_( 'AAAC', r.bases )
+
+    def test_long_indels( self ):
+        str = 'Ref1	1	A	3	.+12ACGTACGTACGT,-10acgtacgtac$A	III	]]]'
+        r = self._C( str )
+        eq_( 'AAA', r.bases )
+        eq_( [('+','ACGTACGTACGT'),('-','acgtacgtac')], r.indels )
+
+    def test_indels( self ):
+        str = 'Ref1	1	A	10	G+2AA-2AA*.G,.....	IIIIIIIIII	]]]]]]]]]]'
+        r = self._C( str )
+        eq_( [('+','AA'),('-','AA')], r.indels )
+
+    def test_parsed_once( self ):
+        str = 'Ref1	1	A	2	.+2AC,	II	]]'
+        r = self._C( str )
+        with patch('ngs_mapper.samtools.parse_bases') as parse_bases:
+            parse_bases.return_value = ('AA', [('+','AC')])
+            r.bases
+            r.indels
+            r.base_stats()
+            list( r )
+        eq_( 1, parse_bases.call_count )
+
 class TestUnitBQuals(MpileupBase):
-    pass
+    def test_no_instance_dict( self ):
+        r = self._C( 'Ref1	1	N	2	AA	I5	]]' )
+        ok_( not hasattr( r, '__dict__' ) )
+        r.depth = '3'
+        eq_( 3, r.depth )
+
+    def test_array_cached_and_readonly( self ):
+        r = self._C( 'Ref1	1	N	2	AA	I5	]]' )
+        ok_( r.bqual_array is r.bqual_array )
+        ok_( not r.bqual_array.flags.writeable )
+        eq_( [40,20], r.bquals )
+        # Lists handed out can still be changed without affecting the column
+        r.bquals.append( 1 )
+        eq_( [40,20], r.bquals )
 
 class TestUnitMQuals(MpileupBase):
     def test_mquals_eq_bquals_len( self ):
@@ -370,7 +566,7 @@ class TestUnitBaseStats(MpileupBase):
         # mapq should be all set to 0
         str = 'Den3/KDC0070A/Thailand/2010/Den3_1	88	N	36	*********A*********AAAA*********AAAt	CA?<=;=??;B?;;?;==<;;;D==<???=?;H;;:'
         r = self._CA( str )
-        eq_( [0]*8, r['A']['mapq'] )
+        eq_( [0]*8, quals( r['A']['mapq'] ) )
 
     def test_qualsums_set( self ):
         str = 'Ref1	1	N	10	AAAAAAAAAA	IIIIIIIIII	]]]]]]]]]]'
@@ -388,8 +584,17 @@ class TestUnitBaseStats(MpileupBase):
     def test_bases_set( self ):
         str = 'Ref1	1	A	14	Aa.,CcGgTtNn*$C^]	EDCBAIHGFEDCBA	ABCDEFGHIABCDE'
         r = self._CA( str )
-        eq_( r['A']['baseq'], [36,35,34,33] )
-        eq_( r['A']['mapq'], [32,33,34,35] )
+        eq_( quals( r['A']['baseq'] ), [33,34,35,36] )
+        eq_( quals( r['A']['mapq'] ), [32,33,34,35] )
+        eq_( 36, r['A']['firstq'] )
+
+    def test_deep_column_same_size( self ):
+        from ngs_mapper.samtools import MAX_QUAL
+        str = 'Ref1	1	N	10000	{0}	{1}	{2}'.format( 'A'*10000, 'I5'*5000, ']'*10000 )
+        r = self._CA( str )
+        eq_( (MAX_QUAL+1,), r['A']['baseq'].shape )
+        eq_( 5000, r['A']['baseq'][40] )
+        eq_( 5000, r['A']['baseq'][20] )
 
 class TestUnitAvgQuals(MpileupBase):
     def test_avgbqual_set( self ):
@@ -507,6 +712,117 @@ class TestUnitPileupColumnInit(MpileupBase):
         eq_( ']'*10, r._mquals )
         eq_( 'A'*10, r.bases )
 
+########### pysam backend Tests ################
+class TestPysamBackend(Base):
+    functionname = 'mpileup'
+
+    def _cols( self, backend, minmq, minbq ):
+        from ngs_mapper.samtools import pileup_column
+        return [
+            pileup_column(p) for p in self._C(self.bam, None, minmq, minbq, 100000, backend)
+        ]
+
+    def test_same_columns_as_samtools( self ):
+        for minmq, minbq in ((0,0),(20,25),(0,30)):
+            expect = self._cols('samtools', minmq, minbq)
+            result = self._cols('pysam', minmq, minbq)
+            eq_( len(expect), len(result) )
+            for e, r in zip(expect, result):
+                eq_( (e.ref, e.pos, e.depth, e.bases, e.bquals), (r.ref, r.pos, r.depth, r.bases, r.bquals) )
+                eq_( e.bqual_array.tolist(), r.bqual_array.tolist() )
+                eq_( len(r.bquals), len(r.mquals) )
+
+    def test_region( self ):
+        ref = self._cols('pysam', 0, 0)[0].ref
+        result = list(self._C(self.bam, ref+':3-6', 0, 0, 100000, 'pysam'))
+        eq_( range(3,7), [r.pos for r in result] )
+
+    @raises(ValueError)
+    def test_invalid_backend( self ):
+        self._C(self.bam, None, 0, 0, 100000, 'bam')
+
+    @raises(ImportError)
+    @patch('ngs_mapper.samtools.pysam', None)
+    def test_pysam_missing( self ):
+        list(self._C(self.bam, None, 0, 0, 100000, 'pysam'))
+
+    def test_nogap_mpileup( self ):
+        from ngs_mapper.samtools import nogap_mpileup, pileup_column
+        def cols( *args ):
+            return [
+                (c.ref, c.pos, c.depth, c.bases, c.bquals)
+                for c in map(pileup_column, nogap_mpileup(self.bam, None, 0, 25, 100000, *args))
+            ]
+        eq_( cols(), cols('pysam') )
+
+class TestUnitBamPileupColumn(Base):
+    functionname = 'BamPileupColumn'
+
+    def _make( self ):
+        import numpy as np
+        return self._C(
+            'Ref1', 3,
+            np.frombuffer('AC*A', dtype=np.uint8),
+            np.array([40,30,20,10], dtype=np.uint8),
+            np.array([60,60,0,60], dtype=np.uint8)
+        )
+
+    def test_sets_attributes( self ):
+        r = self._make()
+        eq_( 'Ref1', r.ref )
+        eq_( 3, r.pos )
+        eq_( 'N', r.refbase )
+        eq_( 4, r.depth )
+        eq_( 'AC*A', r.bases )
+        eq_( [40,30,20,10], r.bquals )
+        eq_( [60,60,0,60], r.mquals )
+
+    def test_base_stats( self ):
+        r = self._make()
+        s = r.base_stats()
+        eq_( 100.0, s['bqualsum'] )
+        eq_( 180.0, s['mqualsum'] )
+        eq_( ([10,40], [60,60], 40), (quals(s['A']['baseq']), quals(s['A']['mapq']), s['A']['firstq']) )
+        eq_( ([20], [0], 20), (quals(s['*']['baseq']), quals(s['*']['mapq']), s['*']['firstq']) )
+
+    def test_str_parses_to_same_column( self ):
+        from ngs_mapper.samtools import MPileupColumn
+        r = self._make()
+        s = str(r)
+        eq_( 'Ref1\t3\tN\t4\tAC*A\tI?5+\t]]!]', s )
+        eq_( plain_stats( r.base_stats() ), plain_stats( MPileupColumn(s).base_stats() ) )
+
+class TestUnitPileupColumn(Base):
+    functionname = 'pileup_column'
+
+    def test_parses_string( self ):
+        r = self._C( 'Ref1	1	N	2	Aa	II	]]' )
+        eq_( 'AA', r.bases )
+
+    def test_returns_column( self ):
+        from ngs_mapper.samtools import MPileupColumn
+        col = MPileupColumn( 'Ref1	1	N	2	Aa	II	]]' )
+        ok_( col is self._C( col ) )
+
+class TestUnitFanOut(Base):
+    functionname = 'fan_out'
+
+    def test_every_consumer_sees_every_column( self ):
+        from ngs_mapper.samtools import MPileupColumn
+        consumers = [Mock(), Mock()]
+        piles = ['Ref1	1	N	2	Aa	II	]]', MPileupColumn('Ref1	2	N	1	C	I	]')]
+        r = self._C( piles, consumers )
+        # Nothing happens until the columns are consumed
+        eq_( 0, consumers[0].add.call_count )
+        r = list( r )
+        eq_( [1,2], [c.pos for c in r] )
+        ok_( r[1] is piles[1] )
+        for consumer in consumers:
+            eq_( [call(c) for c in r], consumer.add.call_args_list )
+
+    def test_no_consumers( self ):
+        eq_( ['AA'], [c.bases for c in self._C( ['Ref1	1	N	2	Aa	II	]]'], [] )] )
+
 class TestUnitParseRegionString(Base):
     functionname = 'parse_regionstring'
 
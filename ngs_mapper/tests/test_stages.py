@@ -0,0 +1,224 @@
+from imports import *
+import threading
+import time
+
+from ngs_mapper.stages import Stage
+
+def run_cmd( cmdstr, stdout=None, stderr=None, script_dir=None ):
+    return subprocess.Popen( shlex.split(cmdstr), stdout=stdout, stderr=stderr )
+
+class Base(common.BaseClass):
+    modulepath = 'ngs_mapper.stages'
+
+class TestStageOrder(Base):
+    functionname = 'stage_order'
+
+    def test_deps_come_first( self ):
+        stages = [Stage('c', 'true', deps=['b']), Stage('a', 'true'), Stage('b', 'true', deps=['a'])]
+        eq_( ['a', 'b', 'c'], [s.name for s in self._C( stages )] )
+
+    def test_keeps_given_order( self ):
+        stages = [Stage('b', 'true'), Stage('a', 'true'), Stage('c', 'true', deps=['a', 'b'])]
+        eq_( ['b', 'a', 'c'], [s.name for s in self._C( stages )] )
+
+    def test_missing_dep( self ):
+        assert_raises( ValueError, self._C, [Stage('a', 'true', deps=['b'])] )
+
+    def test_cycle( self ):
+        assert_raises( ValueError, self._C, [Stage('a', 'true', deps=['b']), Stage('b', 'true', deps=['a'])] )
+
+    def test_cmd_or_func( self ):
+        assert_raises( ValueError, Stage, 'a' )
+        assert_raises( ValueError, Stage, 'a', 'true', func=lambda: None )
+
+class TestRunStages(Base):
+    functionname = 'run_stages'
+
+    def setUp( self ):
+        super(TestRunStages,self).setUp()
+        self.logger = Mock()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most = 0
+
+    def counted( self ):
+        with self.lock:
+            self.running += 1
+            self.most = max( self.most, self.running )
+        time.sleep( 0.2 )
+        with self.lock:
+            self.running -= 1
+
+    def test_independent_stages_run_together( self ):
+        started = threading.Event()
+        def first():
+            if not started.wait( 5 ):
+                raise Exception( 'second did not start' )
+        stages = [Stage('first', func=first), Stage('second', func=started.set)]
+        eq_( {'first': 0, 'second': 0}, self._C( stages, 2, run_cmd, self.logger ) )
+
+    def test_stays_within_cpus( self ):
+        stages = [Stage(str(i), func=self.counted, threads=2) for i in range(4)]
+        self._C( stages, 5, run_cmd, self.logger )
+        eq_( 2, self.most )
+
+    def test_too_many_threads_runs_alone( self ):
+        stages = [Stage('big', func=self.counted, threads=8), Stage('small', func=self.counted)]
+        eq_( {'big': 0, 'small': 0}, self._C( stages, 2, run_cmd, self.logger ) )
+        eq_( 1, self.most )
+
+    def test_deps_finish_first( self ):
+        done = []
+        stages = [
+            Stage('b', func=lambda: done.append('b'), deps=['a']),
+            Stage('a', func=lambda: (time.sleep(0.2), done.append('a'))),
+        ]
+        self._C( stages, 4, run_cmd, self.logger )
+        eq_( ['a', 'b'], done )
+
+    def test_failed_stage_skips_dependents( self ):
+        stages = [
+            Stage('a', 'false'),
+            Stage('b', 'true', deps=['a']),
+            Stage('c', 'true', deps=['b']),
+            Stage('d', 'true'),
+        ]
+        eq_( {'a': 1, 'b': None, 'c': None, 'd': 0}, self._C( stages, 1, run_cmd, self.logger ) )
+
+    def test_fatal_stage_stops_pipeline( self ):
+        stages = [
+            Stage('a', 'false', fatal=True),
+            Stage('b', 'true'),
+        ]
+        eq_( {'a': 1, 'b': None}, self._C( stages, 1, run_cmd, self.logger ) )
+
+    def test_func_raises( self ):
+        def fail():
+            raise IOError( 'failed' )
+        eq_( {'a': 1}, self._C( [Stage('a', func=fail)], 1, run_cmd, self.logger ) )
+
+    def test_stdout_path( self ):
+        self._C( [Stage('a', 'echo test', stdout='out.txt')], 1, run_cmd, self.logger )
+        eq_( 'test\n', open('out.txt').read() )
+
+    def test_cmd_made_when_started( self ):
+        stages = [
+            Stage('a', 'touch made'),
+            Stage('b', lambda: 'ls ' + ' '.join(glob('mad*')), deps=['a'], stdout='ls.txt'),
+        ]
+        self._C( stages, 1, run_cmd, self.logger )
+        eq_( 'made\n', open('ls.txt').read() )
+
+    def test_shared_budget( self ):
+        from ngs_mapper.stages import make_shared_budget, SharedBudget
+        budget = make_shared_budget( 'budget', 2 )
+        other = SharedBudget( 'budget' )
+        # Another process is using both threads
+        ok_( other.acquire( 2 ) )
+        t = threading.Timer( 0.3, other.release, [2] )
+        t.start()
+        with patch('ngs_mapper.stages.POLL_INTERVAL', 0.1):
+            eq_( {'a': 0}, self._C( [Stage('a', 'true', threads=2)], 2, run_cmd, self.logger, budget ) )
+        # Threads were given back
+        ok_( other.acquire( 2 ) )
+
+    def test_shared_budget_starts_with_part( self ):
+        from ngs_mapper.stages import make_shared_budget, SharedBudget
+        budget = make_shared_budget( 'budget', 4 )
+        other = SharedBudget( 'budget' )
+        # Another process keeps 1 thread for the whole run
+        eq_( 1, other.acquire( 1 ) )
+        eq_( {'a': 0}, self._C( [Stage('a', 'true', threads=4)], 4, run_cmd, self.logger, budget ) )
+        # Only the 3 threads it took were given back
+        eq_( 3, other.acquire( 4 ) )
+
+class TestSharedBudget(Base):
+    def test_takes_part_above_floor( self ):
+        from ngs_mapper.stages import make_shared_budget, SharedBudget
+        make_shared_budget( 'budget', 3 )
+        budget = SharedBudget( 'budget' )
+        eq_( 3, budget.acquire( 4 ) )
+        budget.release( 3 )
+        eq_( 2, budget.acquire( 2 ) )
+        # Only 1 of 4 is free which is below half
+        eq_( 0, budget.acquire( 4 ) )
+        eq_( 1, budget.acquire( 2 ) )
+        eq_( 0, budget.acquire( 1 ) )
+        budget.release( 3 )
+        eq_( 3, budget.acquire( 3 ) )
+
+    def test_reset( self ):
+        from ngs_mapper.stages import make_shared_budget, SharedBudget
+        make_shared_budget( 'budget', 3 )
+        budget = SharedBudget( 'budget' )
+        eq_( 2, budget.acquire( 2 ) )
+        budget.reset( 4 )
+        eq_( 4, budget.acquire( 8 ) )
+        eq_( 0, budget.acquire( 1 ) )
+
+class TestCheckpoints(Base):
+    def setUp( self ):
+        super(TestCheckpoints,self).setUp()
+        self.logger = Mock()
+        os.mkdir( 'root' )
+        with open( 'in.txt', 'w' ) as fh:
+            fh.write( 'input' )
+
+    def stages( self, param=1 ):
+        return [
+            Stage( 'a', 'cp in.txt root/a.txt', inputs=['in.txt'], outputs=['root/a.txt'], params=param ),
+            Stage( 'b', 'cp root/a.txt root/b.txt', deps=['a'], inputs=['root/a.txt'], outputs=['root/b.txt'] ),
+        ]
+
+    def run( self, stages ):
+        from ngs_mapper.stages import Checkpoints, run_stages
+        checkpoints = Checkpoints( join('root', 'checkpoints.json'), 'root' )
+        self.logger.reset_mock()
+        results = run_stages( stages, 1, run_cmd, self.logger, checkpoints=checkpoints )
+        started = [c[0][0] for c in self.logger.info.call_args_list if c[0][0].startswith('Started')]
+        return results, started
+
+    def test_skips_up_to_date( self ):
+        eq_( ({'a': 0, 'b': 0}, ['Started a', 'Started b']), self.run( self.stages() ) )
+        eq_( ({'a': 0, 'b': 0}, []), self.run( self.stages() ) )
+
+    def test_changed_input_reruns_rest( self ):
+        self.run( self.stages() )
+        with open( 'in.txt', 'w' ) as fh:
+            fh.write( 'changed' )
+        eq_( ['Started a', 'Started b'], self.run( self.stages() )[1] )
+        eq_( 'changed', open('root/b.txt').read() )
+
+    def test_changed_params( self ):
+        self.run( self.stages() )
+        eq_( ['Started a', 'Started b'], self.run( self.stages(2) )[1] )
+
+    def test_missing_output( self ):
+        self.run( self.stages() )
+        os.unlink( 'root/b.txt' )
+        eq_( ['Started b'], self.run( self.stages() )[1] )
+
+    def test_failed_stage_runs_again( self ):
+        stages = self.stages()
+        stages[1].cmd = 'false'
+        self.run( stages )
+        eq_( ['Started b'], self.run( self.stages() )[1] )
+
+    def test_root_can_move( self ):
+        from ngs_mapper.stages import Checkpoints
+        stages = [Stage( 'a', 'touch {0}'.format(abspath('root/a.txt')), outputs=['root/a.txt'] )]
+        self.run( stages )
+        os.rename( 'root', 'moved' )
+        checkpoints = Checkpoints( join('moved', 'checkpoints.json'), 'moved' )
+        stage = Stage( 'a', 'touch {0}'.format(abspath('moved/a.txt')), outputs=['moved/a.txt'] )
+        ok_( checkpoints.is_current( stage, checkpoints.signature( stage ) ) )
+
+    def test_broken_links_are_stale( self ):
+        from ngs_mapper.stages import Checkpoints
+        cmd = 'sh -c "mkdir root/links && ln -s {0} root/links/in.txt"'.format(abspath('in.txt'))
+        stage = Stage( 'a', cmd, outputs=['root/links'] )
+        self.run( [stage] )
+        checkpoints = Checkpoints( join('root', 'checkpoints.json'), 'root' )
+        ok_( checkpoints.is_current( stage, checkpoints.signature( stage ) ) )
+        os.unlink( 'in.txt' )
+        ok_( not checkpoints.is_current( stage, checkpoints.signature( stage ) ) )
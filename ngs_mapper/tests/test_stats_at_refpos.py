@@ -55,12 +55,13 @@ class TestCompileStats(Base):
     functionname = 'compile_stats'
 
     def test_func_works( self ):
+        from ngs_mapper.samtools import qual_hist
         stats = {
             'depth': 1000,
             'mqualsum': 50*900+60*100,
             'bqualsum': 30*900+40*100,
-            'G': {'mapq': [50]*900, 'baseq': [30]*900},
-            'A': {'mapq': [60]*100, 'baseq': [40]*100}
+            'G': {'mapq': qual_hist([50]*900), 'baseq': qual_hist([30]*900)},
+            'A': {'mapq': qual_hist([60]*100), 'baseq': qual_hist([40]*100)}
         }
         res = self._C( stats )
 
@@ -100,7 +101,8 @@ class TestMain(StatsAtPos):
             bamfile='somefile.bam',
             minmq=0,
             minbq=0,
-            maxd=100000
+            maxd=100000,
+            pileup_backend='samtools'
         )
         self._C()
 
@@ -110,7 +112,8 @@ class TestMain(StatsAtPos):
             regionstr='Den1/U88535_1/WestPac/1997/Den1_1:6109-6109',
             minmq=0,
             minbq=0,
-            maxd=100000
+            maxd=100000,
+            pileup_backend='samtools'
         )
         eb = OrderedDict([
                 ('G',{'AvgBaseQ':37.73,'AvgMapQ':60.0,'Depth':11,'PctTotal':84.62}),
@@ -132,7 +135,8 @@ class TestMain(StatsAtPos):
             regionstr='Den1/U88535_1/WestPac/1997/Den1_1:6109-6109',
             minmq=61,
             minbq=0,
-            maxd=100000
+            maxd=100000,
+            pileup_backend='samtools'
         )
         res = self._C()
         #Den1/U88535_1/WestPac/1997/Den1_1  6109    N   13  GgnGgggggtGgg   CB#GHHHHG2GHH
@@ -155,7 +159,8 @@ class TestMain(StatsAtPos):
             regionstr='Den1/U88535_1/WestPac/1997/Den1_1:6109-6109',
             minmq=0,
             minbq=30,
-            maxd=100000
+            maxd=100000,
+            pileup_backend='samtools'
         )
         res = self._C()
         #Den1/U88535_1/WestPac/1997/Den1_1  6109    N   13  GgnGgggggtGgg   CB#GHHHHG2GHH
@@ -171,3 +176,31 @@ class TestMain(StatsAtPos):
             'TotalDepth': 11
         }
         self._doit( res, eb, e )
+
+class TestParseArgs(common.BaseClass):
+    modulepath = 'ngs_mapper.stats_at_refpos'
+    functionname = 'parse_args'
+
+    def setUp( self ):
+        super(TestParseArgs,self).setUp()
+        self.patch_config = patch('ngs_mapper.config.load_default_config')
+        self.mock_config = self.patch_config.start()
+        self.mock_config.return_value = {'PILEUP_BACKEND': 'samtools'}
+
+    def tearDown( self ):
+        super(TestParseArgs,self).tearDown()
+        self.patch_config.stop()
+
+    def test_pileup_backend_from_config( self ):
+        self.mock_config.return_value = {'PILEUP_BACKEND': 'pysam'}
+        args = self._C( ['in.bam', 'Ref1:1-1'] )
+        eq_( 'pysam', args.pileup_backend )
+
+    def test_pileup_backend_default( self ):
+        args = self._C( ['in.bam', 'Ref1:1-1'] )
+        eq_( 'samtools', args.pileup_backend )
+
+    def test_pileup_backend_arg( self ):
+        self.mock_config.return_value = {'PILEUP_BACKEND': 'pysam'}
+        args = self._C( ['in.bam', 'Ref1:1-1', '--pileup-backend', 'samtools'] )
+        eq_( 'samtools', args.pileup_backend )
@@ -108,6 +108,26 @@ class TestUnitGetRGForRead(Base):
             rg = self._C( read )
             eq_( 'IonTorrent', rg )
 
+    def test_cached_by_name_shape( self ):
+        read = self.mock_read()
+        read.QNAME = 'M99999:99:CACHE-TEST:9:9999:9999:9999'
+        eq_( 'MiSeq', self._C( read ) )
+        read.QNAME = 'M12345:67:ABCDE-FGHI:1:2345:6789:1234'
+        with patch( 'ngs_mapper.tagreads.ID_MAP', [] ):
+            eq_( 'MiSeq', self._C( read ) )
+        # Different shape is not cached
+        read.QNAME = 'M12345:67:abcde-FGHI:1:2345:6789:1234'
+        with patch( 'ngs_mapper.tagreads.ID_MAP', [] ):
+            assert_raises( Exception, self._C, read )
+
+    def test_shape_does_not_change_platform( self ):
+        read = self.mock_read()
+        # Same shape as a MiSeq read except for the M
+        read.QNAME = 'A02261:4:000000000-A6FWH:1:2106:7558:24138'
+        eq_( 'Sanger', self._C( read ) )
+        read.QNAME = 'M02261:4:000000000-A6FWH:1:2106:7558:24138'
+        eq_( 'MiSeq', self._C( read ) )
+
 class TestUnitGetHeader(Base):
     functionname = 'get_bam_header'
 
@@ -179,6 +199,34 @@ class TestUnitTagReads(Base):
         eq_( 1, counts['Sanger'] )
         eq_( 996, counts['MiSeq'] )
 
+    def test_sorted_input_is_not_resorted( self ):
+        from ngs_mapper.tagreads import get_rg_headers
+        self.temp_copy_files()
+        hdr = get_rg_headers( self.bam )
+        with patch( 'ngs_mapper.tagreads.sortbam' ) as sortbam:
+            self._C( self.bam, hdr )
+        eq_( 0, sortbam.call_count )
+        eq_( 996, self.count_rg( self.bam )['MiSeq'] )
+        eq_( [], glob( join( self.tempdir, '*.sam' ) ) )
+
+    def test_unsorted_input_is_sorted( self ):
+        from ngs_mapper.tagreads import get_rg_headers
+        # Reverse the reads so they are out of order
+        sam = compat.check_output( ['samtools', 'view', '-h', self.bam] ).splitlines()
+        hdr = [l for l in sam if l.startswith('@')]
+        reads = [l for l in sam if not l.startswith('@')]
+        unsorted = join( self.tempdir, 'unsorted.sam' )
+        with open( unsorted, 'w' ) as fh:
+            fh.write( '\n'.join( hdr + reads[::-1] ) + '\n' )
+        bam = join( self.tempdir, 'unsorted.bam' )
+        subprocess.check_call( ['samtools', 'view', '-bS', '-o', bam, unsorted] )
+        self._C( bam, get_rg_headers( bam ) )
+        positions = [int(l.split('\t')[3]) for l in compat.check_output( ['samtools', 'view', bam] ).splitlines()]
+        eq_( sorted(positions), positions )
+        eq_( len(reads), len(positions) )
+        ok_( exists( bam + '.bai' ) )
+        ok_( not exists( bam + '.tagged.bam' ) )
+
 class TestUnitTagReadGroup(Base):
     functionname = 'tag_readgroup'
 
@@ -369,6 +417,15 @@ class TestUnitGetRGHeaders(Base):
         for rg in readgroups:
             ok_( 'seqcenter' in rg, 'Samplename was not set to filename correctly' )
 
+class TestUnitRGLine(Base):
+    functionname = 'rg_line'
+
+    def test_no_cn( self ):
+        eq_( '@RG\tID:MiSeq\tSM:sample1\tPL:ILLUMINA', self._C( 'MiSeq', 'sample1' ) )
+
+    def test_cn( self ):
+        eq_( '@RG\tID:Sanger\tSM:sample1\tCN:center\tPL:CAPILLARY', self._C( 'Sanger', 'sample1', 'center' ) )
+
 class TestIntegrate(Base):
     def _C( self, bamfiles, options=[] ):
         cmd = ['tagreads'] + bamfiles + options
@@ -29,6 +29,7 @@ class TestTrimReadsInDir(TrimBase):
 
     @attr('current')
     @patch('ngs_mapper.trim_reads.os', MagicMock())
+    @patch('ngs_mapper.trim_reads.getsize', Mock(return_value=1))
     @patch('__builtin__.open')
     @patch('ngs_mapper.trim_reads.data')
     def test_skips_miseq_index_reads(self, mdata, mopen):
@@ -54,6 +55,7 @@ class TestTrimReadsInDir(TrimBase):
                 assert '_I', call[0][0] not in 'Did not skip MiSeq Index {0}'.format(call[0][0])
 
     @patch('ngs_mapper.trim_reads.os', MagicMock())
+    @patch('ngs_mapper.trim_reads.getsize', Mock(return_value=1))
     @patch('__builtin__.open')
     @patch('ngs_mapper.trim_reads.data')
     def test_only_does_listed_platforms(self, mdata, mopen):
@@ -75,6 +77,7 @@ class TestTrimReadsInDir(TrimBase):
             assert set(reads['Sanger']) - set(posargs) == set(), "Sanger reads found in call args"
 
     @patch('ngs_mapper.trim_reads.os', MagicMock())
+    @patch('ngs_mapper.trim_reads.getsize', Mock(return_value=1))
     @patch('__builtin__.open')
     @patch('ngs_mapper.trim_reads.data')
     def test_skips_ab1_first_read(self, mdata, mopen):
@@ -93,6 +96,7 @@ class TestTrimReadsInDir(TrimBase):
             #eq_([_call], mtrim_read.call_args_list)
 
     @patch('ngs_mapper.trim_reads.os', MagicMock())
+    @patch('ngs_mapper.trim_reads.getsize', Mock(return_value=1))
     @patch('__builtin__.open')
     @patch('ngs_mapper.trim_reads.data')
     def test_skips_ab1_not_first_read(self, mdata, mopen):
@@ -113,6 +117,31 @@ class TestTrimReadsInDir(TrimBase):
             eq_(sorted(expected_args[0]), sorted(mtrim_read.call_args_list[0][0]))
             eq_(sorted(expected_args[1]), sorted(mtrim_read.call_args_list[1][0]))
 
+    @patch('ngs_mapper.trim_reads.os', MagicMock())
+    @patch('__builtin__.open')
+    @patch('ngs_mapper.trim_reads.data')
+    def test_splits_threads_between_files(self, mdata, mopen):
+        mdata.reads_by_plat.return_value = {
+            'Sanger': ['a.fastq', 'b.fastq'],
+            'Roche454': ['c.sff']
+        }
+
+        sizes = {'a.fastq': 10, 'b.fastq': 10, 'c.sff': 20}
+        with patch('ngs_mapper.trim_reads.trim_read') as mtrim_read:
+            with patch('ngs_mapper.trim_reads.getsize', sizes.get):
+                mtrim_read.return_value = ['out.fastq']
+                self._C('/path/to/reads', 20, '/path/to/outdir', threads=7)
+            eq_( 3, mtrim_read.call_count )
+            threads = dict( (c[0][0], c[1]['threads']) for c in mtrim_read.call_args_list )
+            eq_( {'a.fastq': 2, 'b.fastq': 2, 'c.sff': 3}, threads )
+
+    def test_concurrent_files_same_output( self ):
+        self._C( self.read_dir, 20, 'serial' )
+        self._C( self.read_dir, 20, 'concurrent', threads=4 )
+        eq_( sorted(os.listdir('serial')), sorted(os.listdir('concurrent')) )
+        for f in os.listdir('serial'):
+            eq_( open(join('serial',f)).read(), open(join('concurrent',f)).read() )
+
     def test_does_not_create_empty_unpaired( self ):
         outdir = 'filtered_reads'
         readsdir = 'reads'
@@ -281,6 +310,18 @@ class TestTrimRead(TrimBase):
         ok_( exists( expected_trimfile ), '{0} was not created'.format(expected_trimfile) )
 
 
+class TestTrimmedName(TrimBase):
+    functionname = 'trimmed_name'
+
+    def test_keeps_fastq( self ):
+        eq_( 'a_R1_.fastq', self._C( '/path/a_R1_.fastq' ) )
+
+    def test_sff_to_fastq( self ):
+        eq_( 'a.fastq', self._C( '/path/a.sff' ) )
+
+    def test_drops_gz( self ):
+        eq_( 'a_R1_.fastq', self._C( '/path/a_R1_.fastq.gz' ) )
+
 class TestRunCutadapt(TrimBase):
     functionname = 'run_cutadapt'
 
@@ -35,3 +35,25 @@ class TestBuildDatafiles(unittest.TestCase):
             ],
             r
         )
+
+class TestSplitThreads(unittest.TestCase):
+    def test_split_by_size(self):
+        self.assertEqual([5, 3], util.split_threads([20, 10], 8))
+
+    def test_leftover_to_largest_remainder(self):
+        self.assertEqual([2, 1], util.split_threads([100, 1], 3))
+        self.assertEqual([4, 3, 1], util.split_threads([50, 50, 0], 8))
+
+    def test_leftover_to_largest_size(self):
+        self.assertEqual([1, 3], util.split_threads([1, 3], 4))
+        self.assertEqual([3, 2], util.split_threads([10, 10], 5))
+        self.assertEqual([3, 2, 2], util.split_threads([10, 10, 10], 7))
+
+    def test_at_least_one_each(self):
+        self.assertEqual([1, 1, 1], util.split_threads([10, 10, 10], 2))
+
+    def test_empty_reads(self):
+        self.assertEqual([2, 2], util.split_threads([0, 0], 4))
+
+    def test_no_jobs(self):
+        self.assertEqual([], util.split_threads([], 4))
@@ -70,6 +70,18 @@ class TestUnitIterRefs(VCFBase):
             # Correct sequence field
             eq_( ref, str(row.seq) )
 
+    def test_gap_block_rows( self ):
+        self.writer.close()
+        from ngs_mapper.base_caller import VcfWriter, VCF_HEAD, gap_block_header
+        writer = VcfWriter( open(self.fp,'w'), gap_block_header(VCF_HEAD.format('test')) )
+        writer.write_record( self.br( 'Ref1', 'ACGTA', 1, 'A' ) )
+        writer.write_blank( 'Ref1', 2, 'C', '-', end=4 )
+        writer.write_record( self.br( 'Ref1', 'ACGTA', 5, 'A' ) )
+        writer.write_blank( 'Ref2', 1, 'A', 'N', end=2 )
+        writer.close()
+        r = [str(s.seq) for s in self._C( self.fp )]
+        eq_( ['A---A', 'NN'], r )
+
     def test_correct_consensus_fastaidset( self ):
         ref = self.make_vcf()
         for i, row in enumerate( self._C( self.fp, 'samplename' ) ):
@@ -159,6 +171,14 @@ class TestIntegrate(VCFBase):
         r = self._C( self.fp )
         ok_( exists( self.fp.replace('.vcf','.fasta') ), "Did not create correct output name" )
 
+    def test_outputname_not_provided_bgzip( self ):
+        from ngs_mapper.base_caller import bgzip_index
+        self.writer.write_record( self.br( 'Ref1', 'A', 1, 'A' ) )
+        self.writer.close()
+        r = self._C( bgzip_index( self.fp ) )
+        ok_( exists( self.fp.replace('.vcf','.fasta') ), "Did not create correct output name" )
+        eq_( 'A', str(SeqIO.read( self.fp.replace('.vcf','.fasta'), 'fasta' ).seq) )
+
     def test_outputname_provided( self ):
         self.writer.close()
         r = self._C( self.fp, o=self.fp+'.fasta' )
@@ -6,18 +6,24 @@ import subprocess
 import os
 import argparse
 import sys
-from os.path import basename, join, isdir, dirname, expandvars
+import shutil
+from multiprocessing.pool import ThreadPool
+from os.path import basename, join, isdir, dirname, expandvars, getsize
 from glob import glob
 import tempfile
 import reads
 import shlex
 import data
 from ngs_mapper import compat
+from ngs_mapper.util import split_threads
 
 import log
 lconfig = log.get_config()
 logger = log.setup_logger( 'trim_reads', lconfig )
 
+# Buffer size used to copy the unpaired files into unpaired_trimmed.fastq
+COPY_BUFSIZE = 1024 * 1024
+
 def main():
     args = parse_args()
     trim_reads_in_dir(
@@ -26,6 +32,7 @@ def main():
         args.outputdir,
         head_crop=args.headcrop,
         platforms=args.platforms,
+        threads=args.threads,
         primer_info=[args.primer_file, args.primer_seed, args.palindrom_clip, args.simple_clip]
     )
 
@@ -39,6 +46,8 @@ def trim_reads_in_dir( *args, **kwargs ):
         :param str out_path: Output directory path
         :param int head_crop: How many bases to crop off ends
         :param list platforms: List of platform's reads to use
+        :param int threads: How many threads to split between the read files
+            that are trimmed at the same time and their Trimmomatic -threads
     '''
     readdir = args[0]
     qual_th = args[1]
@@ -46,6 +55,7 @@ def trim_reads_in_dir( *args, **kwargs ):
     headcrop = kwargs.get('head_crop', 0)
     platforms = kwargs.get('platforms', None)
     primer_info = kwargs.get('primer_info')
+    threads = int(kwargs.get('threads', 1))
     logger.info(
         "Only accepting the following platform's read files: {0}".format(
             platforms
@@ -58,8 +68,8 @@ def trim_reads_in_dir( *args, **kwargs ):
     # Make out_path
     if not isdir( out_path ):
         os.mkdir( out_path )
-    # Trim all the reads
-    unpaired = []
+    # Find all the reads to trim
+    jobs = []
     for plat, reads in platreads.iteritems():
         if platforms is None or plat in platforms:
             for r in reads:
@@ -68,28 +78,59 @@ def trim_reads_in_dir( *args, **kwargs ):
                     continue
                 inreads = None
                 if isinstance(r,str):
-                    # Only accept .sff and .fastq
-                    if r.endswith('.sff') or r.endswith('.fastq'):
+                    # Only accept .sff, .fastq and .fastq.gz
+                    if r.endswith( ('.sff', '.fastq', '.fastq.gz') ):
                         inreads = r
-                        outreads = join(out_path, basename(r).replace('.sff','.fastq'))
+                        outreads = join(out_path, trimmed_name(r))
                 else:
                     inreads = r
-                    outreads = [join(out_path, basename(pr)) for pr in r]
+                    outreads = [join(out_path, trimmed_name(pr)) for pr in r]
                 # Sometimes inreads not set because .ab1 files
                 if inreads is None:
                     continue
-                try:
-                    r = trim_read( inreads, qual_th, outreads, head_crop=headcrop, primer_info=primer_info )
-                    logger.debug("Output from trim_read {0}".format(r))
-                    unpaired += r[1::2]
-                    logger.debug("Added {0} to unpaired list".format(r[1::2]))
-                except subprocess.CalledProcessError as e:
-                    print e.output
-                    raise e
+                jobs.append( (inreads, outreads) )
         else:
             logger.info("{0} are being excluded as they are not in {1}".format(
                 reads,platforms
             ))
+    # Trim the read files
+    # Larger read files get more Trimmomatic threads
+    sizes = []
+    for inreads, outreads in jobs:
+        if isinstance(inreads, str):
+            inreads = [inreads]
+        sizes.append( sum( getsize(r) for r in inreads ) )
+    jobthreads = split_threads( sizes, threads )
+    workers = max( 1, min( threads, len(jobs) ) )
+    logger.info(
+        "Trimming {0} read files {1} at a time with {2} Trimmomatic threads".format(
+            len(jobs), workers, jobthreads
+        )
+    )
+    def trim( job ):
+        (inreads, outreads), trim_threads = job
+        return trim_read(
+            inreads, qual_th, outreads, head_crop=headcrop, primer_info=primer_info, threads=trim_threads
+        )
+    jobs = zip( jobs, jobthreads )
+    try:
+        if workers > 1:
+            pool = ThreadPool( workers )
+            try:
+                results = pool.map( trim, jobs )
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map( trim, jobs )
+    except subprocess.CalledProcessError as e:
+        print e.output
+        raise e
+    unpaired = []
+    for r in results:
+        logger.debug("Output from trim_read {0}".format(r))
+        unpaired += r[1::2]
+        logger.debug("Added {0} to unpaired list".format(r[1::2]))
     #!!
     # Combine all *.fastq.unpaired into one file for mapping as SE
     #!!
@@ -101,22 +142,35 @@ def trim_reads_in_dir( *args, **kwargs ):
         with open( out_unpaired, 'w' ) as fw:
             for up in notempty:
                 with open(up) as fr:
-                    fw.write( fr.read() )
+                    shutil.copyfileobj( fr, fw, COPY_BUFSIZE )
     else:
         logger.debug("All unpaired trimmed files are empty")
     # Remove the read now as it is no longer needed
     for up in unpaired:
         os.unlink( up )
 
+def trimmed_name( readpath ):
+    '''
+        Name of the trimmed fastq for readpath
+        Trimmomatic reads .fastq.gz directly but the trimmed reads are written
+        uncompressed
+
+        @param readpath - Path to read file
+
+        @returns basename of readpath as a .fastq
+    '''
+    return basename(readpath).replace('.sff','.fastq').replace('.fastq.gz','.fastq')
+
 def trim_read( *args, **kwargs ):
     '''
         Trims the given readpath file and places it in out_path
         If out_path not given then just put it in current directory with the same basename
 
-        @param readpaths - Path to the read to trim .fastq and .sff support only. Can be a tuple of paired reads
+        @param readpaths - Path to the read to trim .fastq(.gz) and .sff support only. Can be a tuple of paired reads
         @param qual_th - Quality threshold to trim reads on
         @param out_paths - Where to put the trimmed file[s]
         @param head_crop - How many bases to trim off the front
+        @param threads - How many threads Trimmomatic uses
 
         @returns path to the trimmed fastq file
     '''
@@ -134,12 +188,13 @@ def trim_read( *args, **kwargs ):
         out_paths = (None,None)
     headcrop = kwargs.get('head_crop', 0)
     primer_info = kwargs.get('primer_info')
+    threads = kwargs.get('threads', 1)
 
     from Bio import SeqIO
     tfile = None
     for i, out_path in enumerate(out_paths):
         if out_path is None:
-            out_paths[i] = basename( readpaths[i] ).replace('.sff','.fastq')
+            out_paths[i] = trimmed_name( readpaths[i] )
         logger.debug( "Using {0} as the output path".format(out_path) )
 
     # Keep the original name for later( Have to copy otherwise we are dealing with a pointer )
@@ -163,7 +218,12 @@ def trim_read( *args, **kwargs ):
     trim_stats_dir = join( dirname(dirname(out_paths[0])), 'trim_stats' )
     stats_file = join( trim_stats_dir, basename(orig_readpaths[0]) + '.trim_stats' )
     if not isdir(dirname(stats_file)):
-        os.makedirs( dirname(stats_file) )
+        try:
+            os.makedirs( dirname(stats_file) )
+        except OSError:
+            # Another file being trimmed at the same time created it first
+            if not isdir(dirname(stats_file)):
+                raise
 
     #run_cutadapt( readpath, stats=stats_file, o=out_path, q=qual_th )
     retpaths = []
@@ -172,14 +232,14 @@ def trim_read( *args, **kwargs ):
         output = run_trimmomatic(
             'SE', readpaths[0], out_paths[0],
             ('LEADING',qual_th), ('TRAILING',qual_th), ('HEADCROP',headcrop),
-            threads=1, trimlog=stats_file, primer_info=primer_info
+            threads=threads, trimlog=stats_file, primer_info=primer_info
         )
     else:
         retpaths = [out_paths[0],out_paths[0]+'.unpaired',out_paths[1],out_paths[1]+'.unpaired']
         output = run_trimmomatic(
             'PE', readpaths[0], readpaths[1], out_paths[0], out_paths[0]+'.unpaired', out_paths[1], out_paths[1]+'.unpaired',
             ('LEADING',qual_th), ('TRAILING',qual_th), ('HEADCROP',headcrop),
-            threads=1, trimlog=stats_file, primer_info=primer_info
+            threads=threads, trimlog=stats_file, primer_info=primer_info
         )
 
     # Prepend stats file with stdout from trimmomatic
@@ -314,6 +374,15 @@ def parse_args( args=sys.argv[1:] ):
         help=defaults['platforms']['help']
     )
 
+    parser.add_argument(
+        '-t',
+        '--threads',
+        dest='threads',
+        type=int,
+        default=defaults['threads']['default'],
+        help=defaults['threads']['help']
+    )
+
     parser.add_argument(
         '--primer-file',
         dest='primer_file',
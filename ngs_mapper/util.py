@@ -17,3 +17,26 @@ def build_datafiles(prefix, datadir):
         _prefix = os.path.normpath(root.replace(datadir, prefix))
         manifest.append((_prefix, [os.path.join(root,f) for f in files]))
     return manifest
+
+def split_threads(sizes, threads):
+    '''
+    Split threads between jobs that run at the same time in proportion to their
+    sizes. Every job gets at least one thread and the total is never more than
+    max(threads, len(sizes)). Threads that are left over after flooring go to the
+    jobs with the largest remainders and then the largest sizes
+
+    :param list sizes: Size of every job(such as bytes of reads)
+    :param int threads: Thread budget for all jobs
+    :return: list of thread counts in the same order as sizes
+    '''
+    spare = max(0, threads - len(sizes))
+    total = float(sum(sizes)) or 1.0
+    shares = [spare * size / total for size in sizes]
+    extra = [int(share) for share in shares]
+    left = spare - sum(extra)
+    order = sorted(
+        range(len(sizes)), key=lambda i: (shares[i] - extra[i], sizes[i]), reverse=True
+    )
+    for i in order[:left]:
+        extra[i] += 1
+    return [1 + e for e in extra]
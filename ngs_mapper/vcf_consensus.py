@@ -73,7 +73,8 @@ def iter_refs( vcffile, fastaid=None ):
             consensus = ''
 
         # Add to the consensus
-        consensus += row.INFO['CB']
+        # Gap block rows(base_caller --gap-blocks) cover POS through END
+        consensus += row.INFO['CB'] * (int(row.INFO.get('END', row.POS)) - row.POS + 1)
 
     # Setup the correct id and description
     # based on the fastaid argument
@@ -120,7 +121,11 @@ def parse_args( args=sys.argv[1:] ):
     pa = parser.parse_args( args )
 
     if pa.output_file is None:
-        pa.output_file = pa.vcffile.replace('.vcf','.fasta')
+        vcffile = pa.vcffile
+        # bgzip compressed vcf
+        if vcffile.endswith('.gz'):
+            vcffile = vcffile[:-3]
+        pa.output_file = vcffile.replace('.vcf','.fasta')
 
     return pa
 
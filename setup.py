@@ -32,8 +32,10 @@ setup(
             'graph_times = ngs_mapper.graph_times:main',
             'miseq_sync = ngs_mapper.miseq_sync:main',
             'rename_sample = ngs_mapper.rename_sample:main',
+            'read_qc = ngs_mapper.read_qc:main',
             'run_bwa_on_samplename = ngs_mapper.run_bwa:main',
             'runsample = ngs_mapper.runsample:main',
+            'runsamplesheet = ngs_mapper.runsamplesheet:main',
             'sanger_sync = ngs_mapper.sanger_sync:main',
             'stats_at_refpos = ngs_mapper.stats_at_refpos:main',
             'tagreads = ngs_mapper.tagreads:main',